@@ -21,12 +21,17 @@ See http://acid.readthedocs.org/
 """
 
 from __future__ import absolute_import
+import array
+import bisect
+import collections
 import functools
 import itertools
 import operator
 import os
+import struct
 import sys
 import threading
+import time
 import warnings
 
 from acid import encoders
@@ -44,6 +49,51 @@ KIND_INDEX = 1
 KIND_ENCODER = 2
 KIND_COUNTER = 3
 KIND_STRUCT = 4
+KIND_COMPACTOR = 5
+KIND_ZDICT = 6
+
+#: First byte of a batch record value that stores its member keys front coded
+#: in the value, rather than in the physical key. Values of batch records in
+#: the original format begin with their member count, which is at least 2.
+BATCH_FRONT_CODED = '\x00'
+
+#: First byte of a front coded batch record value whose members are compressed
+#: in independent blocks, so that a single member may be fetched without
+#: decompressing the entire batch.
+BATCH_BLOCKED = '\x01'
+
+#: First bytes of a front coded batch record value whose members, encoded by
+#: :py:func:`acid.encoders.make_schema_encoder`, are stored as one compressed
+#: column per field, so a scan may decompress only the fields it needs. Every
+#: byte value from 2 may begin an original format record, so this is
+#: distinguished from :py:data:`BATCH_FRONT_CODED` by the member count that
+#: follows it, which is otherwise at least 2.
+BATCH_COLUMNAR = '\x00\x00'
+
+#: Layout of a :py:data:`BATCH_COLUMNAR` column holding the encoded value of
+#: each field.
+COLUMN_FIELDS = 0
+
+#: Layout of a :py:data:`BATCH_COLUMNAR` column holding field values as a
+#: little-endian :py:mod:`array`.
+COLUMN_ARRAY = 1
+
+#: Map field kinds to the typecode of their :py:data:`COLUMN_ARRAY` layout.
+#: Python 2 lacks a 64-bit integer typecode where C long is 32 bits, so there
+#: integer columns use :py:data:`COLUMN_FIELDS`.
+COLUMN_TYPECODES = {keylib.FIELD_BOOL: 'B', keylib.FIELD_DOUBLE: 'd'}
+if array.array('l').itemsize == 8:
+    COLUMN_TYPECODES[keylib.FIELD_INTEGER] = 'l'
+
+#: First bytes of a physical record value whose members were encoded by a
+#: record encoder other than the one recorded for its collection, followed by
+#: that encoder's prefix and then the value as it would otherwise appear. It is
+#: written while :py:meth:`Collection.reencode` is incomplete. Individual
+#: record values otherwise begin with a compressor prefix, which is at least 1,
+#: and batch record values never describe a single member.
+ENCODER_TAG = '\x00\x01'
+
+_DOUBLE = struct.Struct('>d')
 
 
 def open(engine, **kwargs):
@@ -81,6 +131,199 @@ def decode_offsets(s):
         out.append(out[-1] + i)
     return out, pos
 
+def read_varint(s, pos):
+    """Decode the varint starting at `pos` in the string or buffer `s`,
+    returning `(value, pos)` where `pos` is the offset following it."""
+    ba = bytearray(buffer(s, pos, 9))
+    v, n = keylib.read_int(ba, 0, len(ba), 0)
+    return v, pos + n
+
+def split_fields(s):
+    """Split a record produced by :py:func:`acid.keylib.pack_fields` into a
+    list of `(tag, value)` pairs, where `value` is the bytestring encoding the
+    field's value."""
+    inp = bytearray(s)
+    length = len(inp)
+    out = []
+    pos = 0
+    while pos < length:
+        tag, start = keylib.read_int(inp, pos, length, 0)
+        kind = tag & 7
+        if start == length:
+            raise ValueError('truncated field')
+        if kind <= keylib.FIELD_INTEGER:
+            _, pos = keylib.read_int(inp, start, length, 0)
+        elif kind == keylib.FIELD_DOUBLE:
+            pos = start + 8
+        elif kind <= keylib.FIELD_TIME:
+            n, pos = keylib.read_int(inp, start, length, 0)
+            pos += n
+        else:
+            raise ValueError('bad field kind %d; record corrupt?' % (kind,))
+        if pos > length:
+            raise ValueError('truncated field')
+        out.append((tag, str(inp[start:pos])))
+    return out
+
+def _field_value(kind, s):
+    """Decode the encoded value `s` of a numeric field of kind `kind`."""
+    if kind == keylib.FIELD_DOUBLE:
+        return _DOUBLE.unpack(s)[0]
+    v, _ = keylib.read_int(bytearray(s), 0, len(s), 0)
+    if kind == keylib.FIELD_INTEGER:
+        return -((v + 1) >> 1) if v & 1 else (v >> 1)
+    return v
+
+def _field_bytes(kind, v):
+    """Inverse of :py:func:`_field_value`."""
+    if kind == keylib.FIELD_DOUBLE:
+        return _DOUBLE.pack(v)
+    if kind == keylib.FIELD_INTEGER:
+        v = (v << 1) if v >= 0 else ((-v << 1) - 1)
+    return keylib.encode_int(v)
+
+def encode_column(kind, count, present, values):
+    """Return the encoding of a :py:data:`BATCH_COLUMNAR` column for fields of
+    kind `kind`, in a batch of `count` members. `present` lists the ascending
+    indices of members having the field, and `values` their encoded values as
+    produced by :py:func:`split_fields`."""
+    out = bytearray(keylib.encode_int(len(present)))
+    if len(present) < count:
+        prev = -1
+        for i in present:
+            out.extend(keylib.encode_int(i - prev - 1))
+            prev = i
+    arr = None
+    typecode = COLUMN_TYPECODES.get(kind)
+    if typecode:
+        try:
+            arr = array.array(typecode, [_field_value(kind, v) for v in values])
+        except OverflowError:
+            pass
+    if arr is not None:
+        out.append(COLUMN_ARRAY)
+        if sys.byteorder != 'little':
+            arr.byteswap()
+        out.extend(arr.tostring())
+    else:
+        out.append(COLUMN_FIELDS)
+        for v in values:
+            out.extend(keylib.encode_int(len(v)))
+        for v in values:
+            out.extend(v)
+    return str(out)
+
+def decode_column(kind, count, s):
+    """Decode the column `s` produced by :py:func:`encode_column`, returning
+    `(present, values)`, where `values` is an :py:class:`array.array` for the
+    :py:data:`COLUMN_ARRAY` layout, otherwise a list of encoded values."""
+    inp = bytearray(s)
+    length = len(inp)
+    n, pos = keylib.read_int(inp, 0, length, 0)
+    if n < count:
+        present = []
+        prev = -1
+        for _ in xrange(n):
+            gap, pos = keylib.read_int(inp, pos, length, 0)
+            prev += gap + 1
+            present.append(prev)
+    else:
+        present = range(count)
+    layout = inp[pos]
+    pos += 1
+    if layout == COLUMN_ARRAY:
+        values = array.array(COLUMN_TYPECODES[kind])
+        values.fromstring(buffer(s, pos))
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return present, values
+
+    sizes = []
+    for _ in xrange(n):
+        size, pos = keylib.read_int(inp, pos, length, 0)
+        sizes.append(size)
+    values = []
+    for size in sizes:
+        values.append(str(inp[pos:pos + size]))
+        pos += size
+    return present, values
+
+def split_columns(items):
+    """Return the sorted list of `(tag, column)` pairs forming the columns of
+    a :py:data:`BATCH_COLUMNAR` record for the list of `(key, data)` pairs
+    `items`, or ``None`` if some member is not a record produced by
+    :py:func:`acid.keylib.pack_fields`, or has a repeated field."""
+    cols = {}
+    try:
+        for i, (_, data) in enumerate(items):
+            for tag, v in split_fields(data):
+                col = cols.get(tag)
+                if col is None:
+                    col = cols[tag] = ([], [])
+                elif col[0][-1] == i:
+                    return None
+                col[0].append(i)
+                col[1].append(v)
+    except (IndexError, ValueError):
+        return None
+    return [(tag, encode_column(tag & 7, len(items), present, values))
+            for tag, (present, values) in sorted(cols.iteritems())]
+
+def column_values(tag, col):
+    """Given `col` as returned by :py:func:`decode_column` for the field
+    `tag`, return `(present, values)` with each value decoded."""
+    present, values = col
+    if isinstance(values, array.array):
+        values = values.tolist()
+        if (tag & 7) == keylib.FIELD_BOOL:
+            values = map(bool, values)
+        return present, values
+    fields = {tag: 'v'}
+    prefix = keylib.encode_int(tag)
+    return present, [keylib.unpack_fields(fields, prefix + v)['v']
+                     for v in values]
+
+def column_pieces(tag, col):
+    """Given `col` as returned by :py:func:`decode_column` for the field
+    `tag`, return the encoded field, including its tag, of each member
+    having the field."""
+    present, values = col
+    prefix = keylib.encode_int(tag)
+    if isinstance(values, array.array):
+        kind = tag & 7
+        return [prefix + _field_bytes(kind, v) for v in values]
+    return [prefix + v for v in values]
+
+def _time_calls(func, args, min_time=0.02):
+    """Invoke `func(arg)` for every element of `args`, repeating until at least
+    `min_time` seconds pass, returning `(results, seconds)`, where `results`
+    lists the return values of the final pass, and `seconds` is the mean
+    duration of a pass."""
+    passes = 0
+    t0 = time.time()
+    while True:
+        results = map(func, args)
+        passes += 1
+        elapsed = time.time() - t0
+        if elapsed >= min_time:
+            return results, elapsed / passes
+
+def iter_chunks(it, size=64):
+    """Yield lists of up to `size` elements from the iterable `it`. The first
+    list contains a single element, with the length of each subsequent list
+    doubling until `size` is reached. This allows batch decoding of keys via
+    :py:func:`acid.keylib.unpacks_many` without reading far beyond the end of
+    a short range, such as during :py:meth:`Collection.get`."""
+    it = iter(it)
+    n = 1
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+        if n < size:
+            n <<= 1
+
 def next_greater(s):
     """Given a bytestring `s`, return the most compact bytestring that is
     greater than any value prefixed with `s`, but lower than any other value.
@@ -105,6 +348,17 @@ def __kcmp(fn, o):
     return fn(o[1])
 _kcmp = functools.partial(functools.partial, __kcmp)
 
+def _bisect_pred(seq, pred, lo, hi):
+    """Return the first index in `seq[lo:hi]` for which `pred()` is false,
+    or `hi`, given that `pred()` holds for some prefix of the slice."""
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if pred(seq[mid]):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
 
 class PhysicalIterator(object):
     """Abstract iteration of the storage engine.
@@ -137,7 +391,8 @@ class PhysicalIterator(object):
     def init(self, key, reverse, remain=-1):
         """Initialize the iterator by seeking to `key`, and updating
         :py:attr:`key` and :py:attr:`value` as appropriate."""
-        self.it = self.engine.iter(Key(key).to_raw(self.prefix), reverse)
+        _, raw = keylib.key_cache.get(self.prefix, key)
+        self.it = self.engine.iter(raw, reverse)
         self.step()
         if reverse and not self.keys:
             # Initial <= seek on reverse iterator may yield one result beyond
@@ -161,6 +416,372 @@ class PhysicalIterator(object):
             self.step()
 
 
+class BatchSizer(object):
+    """Track the size of the value :py:meth:`Collection._prepare_batch` would
+    produce for a list of items as it grows, so :py:meth:`Collection.batch`
+    can test `max_bytes` after each append. If `packer` has a `compressobj`,
+    members are compressed once as they are appended, and the final size is
+    found by flushing a copy of the compressor; otherwise the members of the
+    current block are recompressed each time."""
+    def __init__(self, packer, packer_prefix, block_size=None):
+        self.packer = packer
+        self.packer_prefix = packer_prefix
+        self.block_size = block_size
+        self.reset()
+
+    def reset(self):
+        """Forget all items."""
+        self.count = 0
+        self.first = None
+        self.prev = ''
+        # Bytes used by member sizes, and by the front coded keys.
+        self.sizes = 0
+        self.keys = 0
+        # Closed blocks, and bytes used by their table entries and contents.
+        self.blocks = 0
+        self.table = 0
+        self._new_block()
+
+    def _new_block(self):
+        self.block_count = 0
+        self.block_len = 0
+        self.pending = []
+        self.obj = self.packer.compressobj and self.packer.compressobj()
+        self.out = 0
+
+    def _block_size(self, obj):
+        """Return the compressed size of the current block, including the
+        packer prefix. `obj` is the compressor to flush."""
+        if obj:
+            return len(self.packer_prefix) + self.out + len(obj.flush())
+        return len(self.packer_prefix) + \
+            len(self.packer.pack(''.join(self.pending)))
+
+    def append(self, key, data):
+        """Append a `(key, data)` item, where `data` is a bytestring."""
+        raw = key.to_raw('')
+        prev = self.prev
+        shared = 0
+        end = min(len(prev), len(raw))
+        while shared < end and prev[shared] == raw[shared]:
+            shared += 1
+        self.keys += (len(keylib.encode_int(shared)) + len(raw) - shared +
+                      len(keylib.encode_int(len(raw) - shared)))
+        self.sizes += len(keylib.encode_int(len(data)))
+        self.prev = raw
+        self.count += 1
+        if self.count == 1:
+            self.first = data
+
+        if self.obj:
+            self.out += len(self.obj.compress(data))
+        else:
+            self.pending.append(data)
+        self.block_count += 1
+        self.block_len += len(data)
+        if self.block_size and self.block_len >= self.block_size:
+            size = self._block_size(self.obj)
+            self.blocks += 1
+            self.table += (len(keylib.encode_int(self.block_count)) +
+                           len(keylib.encode_int(size)) + size)
+            self._new_block()
+
+    def size(self):
+        """Return the size of the batch value for the current items."""
+        if self.count == 1:
+            return len(self.packer_prefix) + len(self.packer.pack(self.first))
+        size = (1 + len(keylib.encode_int(self.count)) + self.sizes +
+                len(keylib.encode_int(self.keys)) + self.keys)
+        if self.block_count:
+            body = self._block_size(self.obj and self.obj.copy())
+        else:
+            body = 0
+        if not self.block_size:
+            return size + body
+        blocks = self.blocks + (1 if self.block_count else 0)
+        size += 2 * len(keylib.encode_int(blocks)) + self.table
+        if self.block_count:
+            size += (len(keylib.encode_int(self.block_count)) +
+                     len(keylib.encode_int(body)) + body)
+        return size
+
+
+class BatchCache(object):
+    """Bounded least-recently-used cache of decompressed batch record data,
+    allowing repeated reads from a hot batch to decompress it only once. Each
+    :py:class:`Store` has one, available as :py:attr:`Store.batch_cache`.
+
+    Entries are keyed by physical key, with the blocks of a
+    :py:data:`BATCH_BLOCKED` record held under the same entry, and are
+    invalidated when a batch record is rewritten through the same store. Since
+    writes from elsewhere, or a transaction abort, cannot be observed, each
+    block also records a token made from the length and the leading and
+    trailing bytes of the compressed data it was produced from, and is only
+    used if the token is unchanged. Compressed streams generally end with a
+    checksum of their content, so the token detects rewrites without reading
+    the whole record.
+    """
+    #: Number of leading and trailing bytes of compressed data included in
+    #: each validation token.
+    TOKEN_BYTES = 16
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        #: Maximum combined size in bytes of decompressed data held by the
+        #: cache. ``0`` disables the cache.
+        self.max_bytes = max_bytes
+        #: Combined size in bytes of currently cached data.
+        self.size = 0
+        #: Number of lookups satisfied from the cache.
+        self.hits = 0
+        #: Number of lookups that required data to be decompressed.
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups satisfied from the cache, or ``0.0`` if no
+        lookups have occurred."""
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def clear(self):
+        """Discard all entries and reset :py:attr:`hits` and
+        :py:attr:`misses`."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _discard(self, blocks):
+        for _, data in blocks.itervalues():
+            self.size -= len(data)
+
+    def invalidate(self, key):
+        """Discard any entry for the physical key `key`, including all of its
+        blocks."""
+        with self._lock:
+            blocks = self._entries.pop(key, None)
+            if blocks:
+                self._discard(blocks)
+
+    def _token(self, packed):
+        n = self.TOKEN_BYTES
+        if len(packed) <= (2 * n):
+            return str(packed)
+        return len(packed), packed[:n], packed[-n:]
+
+    def get(self, key, packed, func, block=0):
+        """Return the decompressed form of `packed`, the compressed data of
+        block number `block` stored under `key`, invoking `func(packed)` to
+        produce it if it is not cached."""
+        token = self._token(packed)
+        with self._lock:
+            blocks = self._entries.pop(key, None)
+            if blocks is not None:
+                self._entries[key] = blocks
+                ent = blocks.get(block)
+                if ent and ent[0] == token:
+                    self.hits += 1
+                    return ent[1]
+            self.misses += 1
+
+        data = func(packed)
+        if len(data) > self.max_bytes:
+            return data
+
+        with self._lock:
+            blocks = self._entries.get(key)
+            if blocks is None:
+                blocks = self._entries[key] = {}
+            old = blocks.get(block)
+            if old:
+                self.size -= len(old[1])
+            blocks[block] = token, data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, blocks = self._entries.popitem(last=False)
+                self._discard(blocks)
+        return data
+
+
+class Compactor(object):
+    """Incrementally batch compresses collections on a background thread,
+    replacing a periodic job that invokes :py:meth:`Collection.batch`
+    manually. Writes made through the store are tracked per collection, and
+    only the key range below the lowest recently written key is considered
+    cold enough to compress. Progress for each collection is kept in the
+    store's metadata, so compaction resumes where it left off when the store
+    is reopened.
+
+    Each pass runs in its own short write transaction visiting at most
+    `max_phys` physical records, and passes are throttled to `phys_per_sec`,
+    limiting their impact on foreground transactions.
+
+        `store`:
+            :py:class:`Store` whose collections are compacted. The compactor
+            installs itself as :py:attr:`Store.compactor`.
+
+        `cold_secs`:
+            Keys written within approximately this many seconds are hot, and
+            no key at or above the lowest hot key is compacted.
+
+        `max_phys`:
+            Maximum physical records visited by a single pass.
+
+        `phys_per_sec`:
+            Maximum average physical records visited per second, or ``None``
+            for no limit.
+
+        `interval`:
+            Seconds to wait when no collection had records to compact.
+
+    ::
+
+        compactor = acid.core.Compactor(store, cold_secs=3600)
+        compactor.add('logs', max_recs=100, packer=acid.encoders.ZLIB)
+        compactor.start()
+    """
+    def __init__(self, store, cold_secs=300, max_phys=1000,
+                 phys_per_sec=10000, interval=60):
+        self.store = store
+        self.cold_secs = cold_secs
+        self.max_phys = max_phys
+        self.phys_per_sec = phys_per_sec
+        self.interval = interval
+        #: Exception raised by the most recent failed pass, or ``None``.
+        self.last_error = None
+        self._colls = {}
+        # name -> [window start, lowest key in window, lowest in previous]
+        self._hot = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        store.compactor = self
+
+    def add(self, name, **kwargs):
+        """Compact the collection `name`, passing `kwargs` to
+        :py:meth:`Collection.batch`. At least one of `max_recs` or
+        `max_bytes` is required."""
+        assert kwargs.get('max_recs') or kwargs.get('max_bytes'), \
+            'max_bytes and/or max_recs is required.'
+        self._colls[name] = kwargs
+
+    def note_write(self, name, key):
+        """Record that the :py:class:`Key` `key` of the collection `name` was
+        written. Invoked by :py:class:`Collection`."""
+        if name not in self._colls:
+            return
+        now = time.time()
+        with self._lock:
+            ent = self._hot.get(name)
+            if ent is None or (now - ent[0]) >= self.cold_secs:
+                prev = None
+                if ent and (now - ent[0]) < (2 * self.cold_secs):
+                    prev = ent[1]
+                self._hot[name] = [now, key, prev]
+            elif key < ent[1]:
+                ent[1] = key
+
+    def hot_key(self, name):
+        """Return the lowest :py:class:`Key` of the collection `name` written
+        within approximately `cold_secs`, or ``None``."""
+        with self._lock:
+            ent = self._hot.get(name)
+        if ent:
+            age = time.time() - ent[0]
+            if age < self.cold_secs and ent[2] is not None:
+                return min(ent[1], ent[2])
+            elif age < (2 * self.cold_secs):
+                return ent[1]
+
+    def progress(self, name):
+        """Return the last :py:class:`Key` of the collection `name` visited by
+        compaction, which resumes from the following key, or ``None`` if it
+        will start from the lowest key."""
+        raw = self.store.get_info2(KIND_COMPACTOR, name).get('progress')
+        if raw is not None:
+            return keylib.Key.from_raw('', raw)
+
+    def compact(self, name):
+        """Run a single pass over the collection `name`, returning the
+        `(found, made, last_key)` tuple from :py:meth:`Collection.batch`. The
+        pass begins following :py:meth:`progress` and ends before
+        :py:meth:`hot_key`. Once a pass reaches the end of the collection
+        without visiting any keys, progress is reset so the next pass starts
+        again from the lowest key, picking up batches since split by
+        writes."""
+        kwargs = self._colls[name]
+        with self.store.begin(write=True):
+            coll = self.store[name]
+            progress = self.store.get_info2(KIND_COMPACTOR, name)
+            lo = progress.get('progress')
+            if lo is not None:
+                # The last visited key extended by None is the lowest key
+                # greater than it.
+                lo = keylib.Key.from_raw('', lo) + (None,)
+            hi = self.hot_key(name)
+            if lo is not None and hi is not None and lo >= hi:
+                found, made, last = 0, 0, None
+            else:
+                found, made, last = coll.batch(lo=lo, hi=hi, include=False,
+                                               max_phys=self.max_phys,
+                                               **kwargs)
+            if last is not None:
+                progress['progress'] = last.to_raw('')
+                self.store.set_info2(KIND_COMPACTOR, name, progress)
+            elif hi is None and progress:
+                self.store.set_info2(KIND_COMPACTOR, name, {})
+        return found, made, last
+
+    def run_once(self):
+        """Run a single pass over every collection, returning the total number
+        of records combined."""
+        return sum(self.compact(name)[0] for name in list(self._colls))
+
+    def start(self):
+        """Start the background thread."""
+        assert self._thread is None, 'Compactor already started.'
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='acid compactor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, waiting for any running pass to
+        finish."""
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            t0 = time.time()
+            try:
+                found = self.run_once()
+                self.last_error = None
+            except Exception, e:
+                self.last_error = e
+                warnings.warn('compaction failed: %r' % (e,))
+                found = 0
+
+            if not found:
+                delay = self.interval
+            elif self.phys_per_sec:
+                delay = (float(self.max_phys) / self.phys_per_sec) - \
+                        (time.time() - t0)
+            else:
+                delay = 0
+            if delay > 0:
+                self._stop.wait(delay)
+
+
 class Index(object):
     """Provides query and manipulation access to a single index on a
     Collection. You should not create this class directly, instead use
@@ -194,10 +815,11 @@ class Index(object):
     def _iter(self, key, lo, hi, reverse, max, include):
         """Setup a woeful chain of iterators that yields index entries.
         """
+        get = keylib.key_cache.get
         if lo is None:
             lo = self.prefix
         else:
-            lo = keylib.Key(lo).to_raw(self.prefix)
+            _, lo = get(self.prefix, lo)
 
         if hi is None:
             hi = next_greater(self.prefix)
@@ -207,18 +829,23 @@ class Index(object):
             # This is a broken mess. When doing reverse queries we must account
             # for the key tuple of the index key. next_greater() may fail if
             # the last byte of the index tuple is FF. Needs a better solution.
-            hi = next_greater(keylib.Key(hi).to_raw(self.prefix)) # TODO WTF
+            hi = next_greater(get(self.prefix, hi)[1]) # TODO WTF
             assert hi
 
         if key is not None:
             if reverse:
-                hi = next_greater(keylib.Key(key).to_raw(self.prefix)) # TODO
+                hi = next_greater(get(self.prefix, key)[1]) # TODO
                 assert hi
                 include = False
             else:
-                lo = keylib.Key(key).to_raw(self.prefix)
+                _, lo = get(self.prefix, key)
 
-        it = self.store._txn_context.get().iter(hi, reverse)
+        txn = self.store._txn_context.get()
+        it = itertools.imap(ITEMGETTER_0, txn.iter(hi if reverse else lo,
+                                                   reverse))
+        if getattr(txn, 'notifier', None):
+            # Engine yields buffers, which don't compare with strings.
+            it = itertools.imap(str, it)
         if reverse:
             pred = lo.__le__
         else:
@@ -226,11 +853,11 @@ class Index(object):
         it = itertools.takewhile(pred, it)
         if max is not None:
             it = itertools.islice(it, max)
-        for key, _ in it:
-            lst = keylib.KeyList.from_raw(self.prefix, key)
-            if not lst:
-                break
-            yield lst
+        for chunk in iter_chunks(it):
+            for lst in keylib.unpacks_many(self.prefix, chunk):
+                if not lst:
+                    return
+                yield lst
 
     def count(self, args=None, lo=None, hi=None, max=None, include=False):
         """Return a count of index entries matching the parameter
@@ -346,6 +973,7 @@ class Collection(object):
 
         self.encoder = encoder or encoders.PICKLE
         self.encoder_prefix = self.store.add_encoder(self.encoder)
+        self._set_old_encoder(info.get('old_encoder'))
         #: Dict mapping indices added using :py:meth:`Collection.add_index` to
         #: :py:class:`Index` instances representing them.
         #:
@@ -355,6 +983,18 @@ class Collection(object):
         #:      assert coll.indices['some index'] is idx
         self.indices = {}
 
+    def _set_old_encoder(self, name):
+        """Prepare to read records lacking an :py:data:`ENCODER_TAG` using the
+        registered encoder `name`, and to tag records written using
+        :py:attr:`encoder`, or if `name` is ``None``, to read and write
+        untagged records using :py:attr:`encoder`."""
+        self._old_encoder = None
+        self._tag = ''
+        if name is not None:
+            self._tag = ENCODER_TAG + self.encoder_prefix
+            if name != self.encoder.name:
+                self._old_encoder = self.store._find_encoder(name)
+
     def set_blind(self, blind):
         """Set the default blind write behaviour to `blind`.. If ``True``,
         indicates the key function never reassigns the same key twice, for
@@ -362,8 +1002,9 @@ class Collection(object):
         records with the same key may be safely skipped, significantly
         improving performance.
 
-        This mode is always active when a collection has no indices defined,
-        and does not need explicitly set in that case.
+        This mode is always active when a collection has no key function,
+        since keys are then assigned from a counter. It applies only to keys
+        produced by the key function, not those passed to :py:meth:`put`.
         """
         self.info['blind'] = bool(blind)
         self.store.set_info2(KIND_TABLE, self.info['name'], self.info)
@@ -419,11 +1060,26 @@ class Collection(object):
         self.indices[name] = index
         return index
 
-    def _logical_iter(self, it, reverse, prefix_s, prefix):
+    def _logical_iter(self, it, reverse, prefix_s, prefix, notifier=None,
+                      columns=None, whole=False):
         """Generator that wraps a database engine iterator to yield logical
         records. For compressed records, each physical record may contain
         multiple physical records. This job's function is to make the
-        distinction invisible to reads."""
+        distinction invisible to reads.
+
+        If the engine yields buffers, `notifier` is the engine transaction's
+        :py:class:`acid.keylib.Notifier`, allowing keys of non-batch records
+        to borrow the buffer rather than copying it.
+
+        If `columns` is a tuple of field tags, members of
+        :py:data:`BATCH_COLUMNAR` records are yielded as `(None, key, values)`,
+        where `values` is a tuple of the member's value for each tag, or
+        ``None`` if absent, and only those columns are decompressed. If
+        `whole` is also ``True``, each such record is instead yielded once as
+        `(None, keys, cols)`, where `keys` is its
+        :py:class:`acid.keylib.KeyList` and `cols` maps each tag present to
+        its column as produced by :py:func:`decode_column`, without filtering
+        members by `prefix`."""
         #   * When iterating forward, if first yielded key lacks collection
         #     prefix, result of iteration is empty.
         #   * When iterating reverse, if first yielded key lacks collection
@@ -436,32 +1092,82 @@ class Collection(object):
         tup = next(it, None)
         if tup and tup[0][:len(prefix_s)] == prefix_s:
             it = itertools.chain((tup,), it)
+        plen = len(prefix_s)
         for key, value in it:
-            keys = keylib.unpacks(prefix_s, key)
-            if not keys:
+            if prefix and len(key) > plen and key[plen] >= '\x80':
+                # prefix_s ends partway through a string element, as with
+                # prefix ('ab',) and key ('ab\x01',), see Key.startswith().
+                # Such keys sort after every key within the prefix.
+                if reverse:
+                    continue
+                return
+            offsets = keylib.tuple_offsets(prefix_s, key)
+            if not offsets:
                 return
 
-            lenk = len(keys)
-            if lenk == 1:
-                key = keylib.Key(*(prefix + keys[0]))
-                yield False, key, self._decompress(value)
+            if len(offsets) == 2:
+                key = keylib.Key.from_raw(self.prefix, key, notifier)
+                yield False, key, self._record_data(key, value)
             else: # Batch record.
-                offsets, dstart = decode_offsets(value)
-                data = self._decompress(buffer(value, dstart))
+                phys = str(key)
+                encoder, value = self._untag(value)
+                front, keys, offsets, dstart = self._batch_header(phys, value)
+                lenk = len(keys)
+                # Blocks are decompressed when their first member is yielded.
+                if value[0] == BATCH_BLOCKED:
+                    firsts, starts = self._block_table(value, dstart)
+                else:
+                    firsts = [0, lenk]
+                    starts = [dstart, len(value)]
+                data = None
+                lo = hi = 0
+                cols = None
+                if value[:2] == BATCH_COLUMNAR:
+                    hi = lenk
+                    base = 0
+                    if columns is None or encoder is not None:
+                        # Column tags describe the fields of self.encoder.
+                        data = self._column_data(phys, value, dstart, lenk)
+                    elif whole:
+                        yield None, keys, dict(self._columns(phys, value,
+                            dstart, lenk, columns))
+                        continue
+                    else:
+                        data = cols = self._column_tuples(phys, value, dstart,
+                                                          lenk, columns)
                 if reverse:
                     stop = -1
                     step = -1
-                    i = lenk
+                    i = lenk - 1
                 else:
                     stop = lenk
                     step = 1
                     i = 0
                 while i != stop:
-                    key = keys[-1 - i]
+                    # Original format physical keys list members in reverse.
+                    key = keys[i if front else (lenk - 1 - i)]
+                    if prefix and not key.startswith(prefix):
+                        i += step
+                        continue
+                    if cols is not None:
+                        yield None, key, cols[i]
+                        i += step
+                        continue
+                    if data is None or not (lo <= i < hi):
+                        b = bisect.bisect_right(firsts, i) - 1
+                        lo = firsts[b]
+                        hi = firsts[b+1]
+                        data = self._cached_decompress(phys,
+                            buffer(value, starts[b], starts[b+1] - starts[b]),
+                            b)
+                        base = offsets[lo]
                     offs = offsets[i]
                     size = offsets[i+1] - offs
-                    key = keylib.Key(*(prefix + key))
-                    yield True, key, buffer(data, offs, size)
+                    if encoder is None:
+                        yield True, key, buffer(data, offs - base, size)
+                    else:
+                        yield True, key, self._transcode(encoder, key,
+                            buffer(data, offs - base, size))
                     i += step
 
     # -----------------------------------------------------------
@@ -478,9 +1184,11 @@ class Collection(object):
     # -----------------------------------------------------------
     # _iter(, , , False): lokey=prefix, hikey=ng(prefix)
     #                     startpred=lokey, endpred=
-    def _iter(self, key, lo, hi, prefix, reverse, max_, include, max_phys):
+    def _bounds(self, key, lo, hi, prefix, reverse, include):
+        """Return `(prefix_s, startkey, startpred, endpred)` describing the
+        range selected by the arguments of :py:meth:`_iter`."""
+        get = keylib.key_cache.get
         if key is not None:
-            key = keylib.Key(key)
             if reverse:
                 hi = key
                 include = True
@@ -488,22 +1196,20 @@ class Collection(object):
                 lo = key
 
         if prefix:
-            prefix_s = keylib.Key(prefix).to_raw(self.prefix)
+            _, prefix_s = get(self.prefix, prefix)
         else:
             prefix_s = self.prefix
 
         if lo is None:
             lokey = prefix_s
         else:
-            lo = keylib.Key(lo)
-            lokey = lo.to_raw(self.prefix)
+            lo, lokey = get(self.prefix, lo)
 
         if hi is None:
             hikey = next_greater(prefix_s)
             include = False
         else:
-            hi = keylib.Key(hi)
-            hikey = hi.to_raw(self.prefix)
+            hi, hikey = get(self.prefix, hi)
 
         if reverse:
             startkey = hikey
@@ -511,20 +1217,27 @@ class Collection(object):
             endpred = lo and lo.__ge__
         else:
             startkey = lokey
-            startpred = None
+            startpred = lo and lo.__gt__
             endpred = hi and (hi.__ge__ if include else hi.__gt__)
+        return prefix_s, startkey, startpred, endpred
 
-        it = self.store._txn_context.get().iter(startkey, reverse)
+    def _iter(self, key, lo, hi, prefix, reverse, max_, include, max_phys,
+              columns=None):
+        prefix_s, startkey, startpred, endpred = \
+            self._bounds(key, lo, hi, prefix, reverse, include)
+        txn = self.store._txn_context.get()
+        it = txn.iter(startkey, reverse)
         if max_phys is not None:
             it = itertools.islice(it, max_phys)
 
-        it = self._logical_iter(it, reverse, prefix_s, prefix)
-        if max_ is not None:
-            it = itertools.islice(it, max_)
+        it = self._logical_iter(it, reverse, prefix_s, prefix,
+                                getattr(txn, 'notifier', None), columns)
         if startpred:
             it = itertools.dropwhile(_kcmp(startpred), it)
         if endpred:
             it = itertools.takewhile(_kcmp(endpred), it)
+        if max_ is not None:
+            it = itertools.islice(it, max_)
         return it
 
     def __getitem__(self, index):
@@ -534,17 +1247,204 @@ class Collection(object):
         compressor = self.store.get_encoder(s[0])
         return compressor.unpack(buffer(s, 1))
 
-    def _index_keys(self, key, obj):
+    def _untag(self, value):
+        """Split any :py:data:`ENCODER_TAG` from the physical record value
+        `value`, returning `(encoder, value)`, where `encoder` is the record
+        encoder of its members, or ``None`` if it is :py:attr:`encoder`."""
+        if value[:2] != ENCODER_TAG:
+            return self._old_encoder, value
+        prefix = value[2]
+        if prefix == self.encoder_prefix:
+            return None, buffer(value, 3)
+        return self.store.get_encoder(prefix), buffer(value, 3)
+
+    def _transcode(self, encoder, key, data):
+        """Return the record `key` encoded by `encoder` as `data`, re-encoded
+        using :py:attr:`encoder`."""
+        return str(self.encoder.pack(encoder.unpack(key, data)))
+
+    def _record_data(self, key, value):
+        """Return the data of the individual record `(key, value)`, encoded
+        using :py:attr:`encoder`."""
+        if value[0] != ENCODER_TAG[0] and self._old_encoder is None:
+            return self._decompress(value)
+        encoder, value = self._untag(value)
+        data = self._decompress(value)
+        if encoder is not None:
+            data = self._transcode(encoder, key, data)
+        return data
+
+    def _cached_decompress(self, phys, s, block=0):
+        """Like :py:meth:`_decompress`, but consult the store's
+        :py:class:`BatchCache` for block number `block` of the batch record
+        `phys`. Uncompressed data is never cached."""
+        if self.store.get_encoder(s[0]) is encoders.PLAIN:
+            return self._decompress(s)
+        return self.store.batch_cache.get(phys, s, self._decompress, block)
+
+    def _batch_header(self, phys, value):
+        """Decode the header of the batch record `(phys, value)`, returning
+        `(front, keys, offsets, pos)`, where `front` is ``True`` if `keys`
+        appear in key order rather than reversed, `offsets` is the list of
+        member offsets into the decompressed data, and `pos` is the offset in
+        `value` following the header."""
+        if value[0] not in (BATCH_FRONT_CODED, BATCH_BLOCKED):
+            offsets, pos = decode_offsets(value)
+            return False, keylib.KeyList.from_raw(self.prefix, phys), \
+                   offsets, pos
+        start = len(BATCH_COLUMNAR) if value[:2] == BATCH_COLUMNAR else 1
+        offsets, pos = decode_offsets(buffer(value, start))
+        klen, pos = read_varint(value, pos + start)
+        keys = keylib.KeyList.from_front(buffer(value, pos, klen))
+        return True, keys, offsets, pos + klen
+
+    def _block_table(self, value, pos):
+        """Decode the block table of the :py:data:`BATCH_BLOCKED` record
+        `value` starting at `pos`, returning `(firsts, starts)`, where
+        `firsts` lists the index of the first member of each block, and
+        `starts` lists the offset in `value` of each block's compressed data,
+        both followed by a final element marking the end.
+        """
+        firsts, n = decode_offsets(buffer(value, pos))
+        pos += n
+        starts, n = decode_offsets(buffer(value, pos))
+        pos += n
+        return firsts, [pos + start for start in starts]
+
+    def _iter_blocks(self, phys, value, pos):
+        """Yield the decompressed data of each block of the
+        :py:data:`BATCH_BLOCKED` record `(phys, value)`."""
+        _, starts = self._block_table(value, pos)
+        for i in xrange(len(starts) - 1):
+            yield self._cached_decompress(phys,
+                buffer(value, starts[i], starts[i+1] - starts[i]), i)
+
+    def _column_table(self, value, pos):
+        """Decode the column table of the :py:data:`BATCH_COLUMNAR` record
+        `value` starting at `pos`, returning `(tags, starts)`, where `tags`
+        lists the field tag of each column, and `starts` lists the offset in
+        `value` of each column's compressed data, followed by a final element
+        marking the end."""
+        ncols, pos = read_varint(value, pos)
+        tags = []
+        for _ in xrange(ncols):
+            tag, pos = read_varint(value, pos)
+            tags.append(tag)
+        starts = [0]
+        for _ in xrange(ncols):
+            size, pos = read_varint(value, pos)
+            starts.append(starts[-1] + size)
+        return tags, [pos + start for start in starts]
+
+    def _columns(self, phys, value, pos, count, tags=None):
+        """Return `(tag, (present, values))` as produced by
+        :py:func:`decode_column` for each column of the
+        :py:data:`BATCH_COLUMNAR` record `(phys, value)` of `count` members
+        whose column table starts at `pos`, or only for those whose tag
+        appears in `tags`. Only the chosen columns are decompressed."""
+        all_tags, starts = self._column_table(value, pos)
+        out = []
+        for b, tag in enumerate(all_tags):
+            if tags is None or tag in tags:
+                data = self._cached_decompress(phys,
+                    buffer(value, starts[b], starts[b+1] - starts[b]), b)
+                out.append((tag, decode_column(tag & 7, count, data)))
+        return out
+
+    def _column_rows(self, phys, value, pos, count):
+        """Return the concatenated members of the :py:data:`BATCH_COLUMNAR`
+        record `(phys, value)`, reassembled from its columns."""
+        rows = [[] for _ in xrange(count)]
+        for tag, col in self._columns(phys, value, pos, count):
+            for i, piece in itertools.izip(col[0], column_pieces(tag, col)):
+                rows[i].append(piece)
+        return ''.join(''.join(row) for row in rows)
+
+    def _column_data(self, phys, value, pos, count):
+        """Like :py:meth:`_column_rows`, but consult the store's
+        :py:class:`BatchCache` unless the columns are uncompressed."""
+        _, starts = self._column_table(value, pos)
+        if len(starts) == 1 or \
+                self.store.get_encoder(value[starts[0]]) is encoders.PLAIN:
+            return self._column_rows(phys, value, pos, count)
+        func = lambda _: self._column_rows(phys, value, pos, count)
+        return self.store.batch_cache.get(phys, buffer(value, pos), func, -1)
+
+    def _column_tuples(self, phys, value, pos, count, tags):
+        """Return a list containing a tuple for each member of the
+        :py:data:`BATCH_COLUMNAR` record `(phys, value)`, of its decoded value
+        for each field tag in `tags`, or ``None`` where absent."""
+        found = dict(self._columns(phys, value, pos, count, tags))
+        lists = []
+        for tag in tags:
+            col = found.get(tag)
+            if col is None:
+                lists.append([None] * count)
+                continue
+            present, values = column_values(tag, col)
+            if len(present) < count:
+                full = [None] * count
+                for i, v in itertools.izip(present, values):
+                    full[i] = v
+                values = full
+            lists.append(values)
+        return zip(*lists)
+
+    def _get_member(self, key, phys, value):
+        """Return the data of the member `key` from the batch record `(phys,
+        value)`, encoded using :py:attr:`encoder`, or ``None`` if it is not a
+        member."""
+        encoder, value = self._untag(value)
+        data = self._find_member(key, phys, value)
+        if data is not None and encoder is not None:
+            data = self._transcode(encoder, key, data)
+        return data
+
+    def _find_member(self, key, phys, value):
+        """Return the data of the member `key` from the untagged batch record
+        `(phys, value)`, or ``None`` if it is not a member. Members are located
+        by binary search, and for :py:data:`BATCH_BLOCKED` records only the
+        block containing the member is decompressed."""
+        front, keys, offsets, pos = self._batch_header(phys, value)
+        if not front:
+            for i in xrange(len(keys)):
+                if keys[i] == key:
+                    i = len(keys) - 1 - i
+                    data = self._cached_decompress(phys, buffer(value, pos))
+                    return buffer(data, offsets[i], offsets[i+1] - offsets[i])
+            return
+
+        i = bisect.bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            return
+        if value[:2] == BATCH_COLUMNAR:
+            data = self._column_data(phys, value, pos, len(keys))
+            return buffer(data, offsets[i], offsets[i+1] - offsets[i])
+        if value[0] == BATCH_FRONT_CODED:
+            data = self._cached_decompress(phys, buffer(value, pos))
+            return buffer(data, offsets[i], offsets[i+1] - offsets[i])
+
+        firsts, starts = self._block_table(value, pos)
+        b = bisect.bisect_right(firsts, i) - 1
+        data = self._cached_decompress(phys,
+            buffer(value, starts[b], starts[b+1] - starts[b]), b)
+        start = offsets[i] - offsets[firsts[b]]
+        return buffer(data, start, offsets[i+1] - offsets[i])
+
+    def _index_keys(self, key, obj, indices=None):
         """Generate a list of encoded keys representing index entries for `obj`
-        existing under `key`."""
+        existing under `key`. If `indices` is not ``None``, only entries for
+        the named indices are produced."""
         idx_keys = []
-        for idx in self.indices.itervalues():
+        for name, idx in self.indices.iteritems():
+            if indices is not None and name not in indices:
+                continue
             lst = idx.func(obj)
             if lst:
                 if type(lst) is not list:
                     lst = [lst]
-                for idx_key in lst:
-                    idx_keys.append(keylib.packs(idx.prefix, [idx_key, key]))
+                idx_keys.extend(keylib.packs_many(idx.prefix,
+                    [[idx_key, key] for idx_key in lst]))
         return idx_keys
 
     def items(self, key=None, lo=None, hi=None, prefix=None, reverse=False,
@@ -562,13 +1462,50 @@ class Collection(object):
         return itertools.imap(ITEMGETTER_1, it)
 
     def values(self, key=None, lo=None, hi=None, prefix=None, reverse=None,
-               max=None, include=False, raw=False):
-        """Yield record values in key order."""
+               max=None, include=False, raw=False, fields=None):
+        """Yield record values in key order. If `fields` is a sequence of
+        field names, yield only those fields of each record, as produced by
+        the encoder's :py:attr:`unpack_fields
+        <acid.encoders.RecordEncoder>`, which may avoid decoding the remainder
+        of each record. Only the columns for `fields` are decompressed from
+        batches written with `columnar=True`."""
+        if fields is not None and not raw:
+            fields = tuple(fields)
+            if self.encoder.fields is not None:
+                return self._iter_fields(key, lo, hi, prefix, reverse, max,
+                                         include, fields)
         it = self._iter(key, lo, hi, prefix, reverse, max, include, None)
         if raw:
-            return itertools.imap(ITEMGETTER_2, it)
+            return (str(data) for _, _, data in it)
+        if fields is not None:
+            unpack_fields = self.encoder.unpack_fields
+            return (unpack_fields(key_, data, fields) for _, key_, data in it)
         return (self.encoder.unpack(key_, data) for _, key_, data in it)
 
+    def _field_spec(self, names):
+        """Return the `(field_id, kind, name)` tuples of the collection's
+        schema encoder describing the fields in `names`."""
+        return [f for f in self.encoder.fields if f[2] in names]
+
+    def _iter_fields(self, key, lo, hi, prefix, reverse, max, include, names):
+        """Implement :py:meth:`values` with `fields` for collections using a
+        schema encoder, reading only the needed columns of columnar batches,
+        whose values are re-encoded for the encoder's `unpack_fields`."""
+        spec = self._field_spec(names)
+        spec_names = [name for _, _, name in spec]
+        tags = tuple((field_id << 3) | kind for field_id, kind, _ in spec)
+        it = self._iter(key, lo, hi, prefix, reverse, max, include, None,
+                        tags)
+        unpack_fields = self.encoder.unpack_fields
+        pack_fields = keylib.pack_fields
+        izip = itertools.izip
+
+        def project(batch, key_, data):
+            if batch is None:
+                data = pack_fields(spec, dict(izip(spec_names, data)))
+            return unpack_fields(key_, data, names)
+        return (project(batch, key_, data) for batch, key_, data in it)
+
     def find(self, key=None, lo=None, hi=None, prefix=None, reverse=None,
              include=False, raw=None, default=None):
         """Return the first matching record, or None. Like ``next(itervalues(),
@@ -576,39 +1513,161 @@ class Collection(object):
         it = self._iter(key, lo, hi, prefix, reverse, None, include, None)
         for _, key_, data in it:
             if raw:
-                return data
+                return str(data)
             return self.encoder.unpack(key_, data)
         return default
 
-    def get(self, key, default=None, raw=False):
+    def get(self, key, default=None, raw=False, fields=None):
         """Fetch a record given its key. If `key` is not a tuple, it is wrapped
         in a 1-tuple. If the record does not exist, return ``None`` or if
-        `default` is provided, return it instead."""
-        it = self._iter(None, key, key, None, False, None, True, None)
-        for _, key_, data in it:
-            if raw:
-                return data
-            return self.encoder.unpack(key_, data)
-        return default
+        `default` is provided, return it instead. If `fields` is a sequence of
+        field names, return only those fields, as for :py:meth:`values`."""
+        key, rawkey = keylib.key_cache.get(self.prefix, key)
+        phys, value, batch = self._find_phys(rawkey)
+        if phys is None:
+            return default
+        if batch:
+            data = self._get_member(key, phys, value)
+            if data is None:
+                return default
+        else:
+            data = self._record_data(key, value)
+        if raw:
+            return str(data)
+        if fields is not None:
+            return self.encoder.unpack_fields(key, data, tuple(fields))
+        return self.encoder.unpack(key, data)
+
+    def aggregate(self, field, key=None, lo=None, hi=None, prefix=None,
+                  include=False):
+        """Return a dict with ``count``, ``sum``, ``min`` and ``max`` keys
+        describing the values of `field` among matching records, ignoring
+        records lacking the field. Only the column for `field` is decompressed
+        from batches written with `columnar=True`. ``sum`` is ``None`` for
+        string and time fields, and ``min`` and ``max`` are ``None`` if no
+        record has the field.
+
+        The collection must use an encoder produced by
+        :py:func:`acid.encoders.make_schema_encoder`. Other arguments are as
+        for :py:meth:`values`.
+
+        ::
+
+            stats = coll.aggregate('age', lo=100, hi=200)
+            print 'Mean age:', stats['sum'] / float(stats['count'] or 1)
+        """
+        if self.encoder.fields is None:
+            raise ValueError('aggregate() requires a schema encoder.')
+        spec = self._field_spec((field,))
+        if not spec:
+            raise ValueError('%r is not a field of the schema.' % (field,))
+        (field_id, kind, _), = spec
+        tag = (field_id << 3) | kind
+        tags = {tag: field}
+        numeric = kind not in (keylib.FIELD_STRING, keylib.FIELD_TIME)
+
+        prefix_s, startkey, startpred, endpred = \
+            self._bounds(key, lo, hi, prefix, False, include)
+        pkey = prefix and keylib.key_cache.get(self.prefix, prefix)[0]
+
+        def before(k):
+            return bool((startpred and startpred(k)) or (pkey and pkey > k))
+
+        def within(k):
+            return (not endpred or endpred(k)) and \
+                   (not pkey or k.startswith(prefix))
+
+        count = 0
+        total = 0
+        lo_ = hi_ = None
+        unpack_fields = keylib.unpack_fields
+        txn = self.store._txn_context.get()
+        it = self._logical_iter(txn.iter(startkey, False), False, prefix_s,
+                                prefix, getattr(txn, 'notifier', None),
+                                (tag,), True)
+        for batch, k, data in it:
+            if batch is not None:
+                if before(k):
+                    continue
+                if not within(k):
+                    break
+                v = unpack_fields(tags, data, False).get(field)
+                if v is None:
+                    continue
+                vals = (v,)
+                end = False
+            else:
+                # Columnar batch: reduce the slice of the column in range.
+                n = len(k)
+                a = _bisect_pred(k, before, 0, n)
+                b = _bisect_pred(k, within, a, n)
+                end = b < n
+                col = data.get(tag)
+                if col is None:
+                    if end:
+                        break
+                    continue
+                present, values = col
+                vals = values[bisect.bisect_left(present, a):
+                              bisect.bisect_left(present, b)]
+                if not vals:
+                    if end:
+                        break
+                    continue
+                vals = column_values(tag, (None, vals))[1]
+            vmin = min(vals)
+            vmax = max(vals)
+            if count:
+                lo_ = min(lo_, vmin)
+                hi_ = max(hi_, vmax)
+            else:
+                lo_ = vmin
+                hi_ = vmax
+            count += len(vals)
+            if numeric:
+                total += sum(vals)
+            if end:
+                break
+        return {'count': count, 'sum': total if numeric else None,
+                'min': lo_, 'max': hi_}
+
+    def _find_phys(self, rawkey):
+        """Return `(phys, value, batch)` for the physical record that contains
+        the record with encoded key `rawkey` if it exists, or `(None, None,
+        False)`. `batch` is ``True`` if the physical record is a batch, in
+        which case membership must still be tested."""
+        txn = self.store._txn_context.get()
+        for phys, value in txn.iter(rawkey, False):
+            phys = str(phys)
+            offsets = keylib.tuple_offsets(self.prefix, phys)
+            if offsets and len(offsets) > 2:
+                return phys, value, True
+            elif offsets and phys == rawkey:
+                return phys, value, False
+            break
+        return None, None, False
 
     def batch(self, lo=None, hi=None, prefix=None, max_recs=None,
               max_bytes=None, max_keylen=None, preserve=True, packer=None,
-              max_phys=None, grouper=None):
+              max_phys=None, grouper=None, block_size=None, include=True,
+              columnar=False):
         """
         Search the key range *lo..hi* for individual records, combining them
         into a batches.
 
         Returns `(found, made, last_key)` indicating the number of records
-        combined, the number of batches produced, and the last key visited
-        before `max_phys` was exceeded.
+        combined into batches of more than one record, the number of such
+        batches produced, and the last key visited, or ``None`` if no keys
+        were visited. Records left alone, or rewritten unchanged as individual
+        records, are not counted.
 
         Batch size is controlled via `max_recs` and `max_bytes`; at least one
         must not be ``None``. Larger sizes may cause pathological behaviour in
-        the storage engine (for example, space inefficiency). Since batches are
-        fully decompressed before any member may be accessed via
-        :py:meth:`get() <Collection.get>` or :py:meth:`iteritems()
-        <Collection.iteritems>`, larger sizes may slow decompression, waste IO
-        bandwidth, and temporarily use more RAM.
+        the storage engine (for example, space inefficiency). Unless
+        `block_size` is set, batches are fully decompressed before any member
+        may be accessed via :py:meth:`get() <Collection.get>` or
+        :py:meth:`iteritems() <Collection.iteritems>`, so larger sizes may slow
+        decompression, waste IO bandwidth, and temporarily use more RAM.
 
             `lo`:
                 Lowest search key.
@@ -624,11 +1683,12 @@ class Collection(object):
             `max_bytes`:
                 Maximum size in bytes of the batch record's value after
                 compression, or ``None`` for no maximum size. When not
-                ``None``, values are recompressed after each member is
-                appended, in order to test if `maxbytes` has been reached. This
-                is inefficient, but provides the best guarantee of final record
-                size. Single records are skipped if they exceed this size when
-                compressed individually.
+                ``None``, the exact compressed size is tested after each member
+                is appended. If `packer` provides `compressobj`, this costs
+                little more than compressing the batch once; otherwise the
+                batch is recompressed after each append, which is slow for
+                large batches. Single records are skipped if they exceed this
+                size when compressed individually.
 
             `max_keylen`:
                 Maximum size in bytes of the batch record's key part, or
@@ -661,79 +1721,522 @@ class Collection(object):
                 record's value. A new batch is triggered each time the
                 function's return value changes.
 
+            `block_size`:
+                If not ``None``, compress batch members in independent blocks
+                of at least this many bytes before compression, allowing
+                :py:meth:`get() <Collection.get>` to decompress only the block
+                containing the requested member. Smaller blocks speed up
+                lookups at the cost of compression ratio.
+
+            `include`:
+                If ``False``, records whose key equals `hi` are excluded.
+
+            `columnar`:
+                If ``True``, store each field of the batch's members as a
+                separately compressed column, so :py:meth:`values` with
+                `fields` and :py:meth:`aggregate` decompress only the columns
+                they need. Numeric columns are stored as arrays. Requires an
+                encoder produced by :py:func:`acid.encoders.make_schema_encoder`
+                and overrides `block_size`. Reading whole records requires
+                reassembling them from every column, so columnar batches suit
+                scans of a few fields rather than lookups. `max_bytes` is
+                tested against the size the batch would have if not columnar.
+                Batches whose members are not valid schema records are
+                written normally.
+
         """
         assert max_keylen is None, 'max_keylen is not implemented.'
         assert max_bytes or max_recs, 'max_bytes and/or max_recs is required.'
+        if columnar and self.encoder.fields is None:
+            raise ValueError('columnar batches require a schema encoder.')
         txn = self.store._txn_context.get()
         packer = packer or encoders.PLAIN
-        it = self._iter(None, lo, hi, prefix, False, None, True, max_phys)
+        if max_bytes:
+            sizer = BatchSizer(packer, self._packer_prefix(packer), block_size)
+        it = self._iter(None, lo, hi, prefix, False, None, include, max_phys)
         groupval = None
         items = []
+        # Physical keys of the individual records in items.
+        loose = []
+        exploded = None
+        key = None
+        counts = [0, 0]
+
+        def flush():
+            if max_bytes:
+                sizer.reset()
+            if len(items) == 1 and loose:
+                # A lone individual record is left as it is.
+                del items[:], loose[:]
+                return
+            for rawkey in loose:
+                txn.delete(rawkey)
+            del loose[:]
+            n = self._write_batch(txn, items, packer, block_size, columnar)
+            if n > 1:
+                counts[0] += n
+                counts[1] += 1
 
         for batch, key, data in it:
             if preserve and batch:
-                self._write_batch(txn, items, packer)
+                flush()
             else:
-                txn.delete(key.to_raw(self.prefix))
+                if not batch:
+                    loose.append(key.to_raw(self.prefix))
+                elif exploded is None or key > exploded:
+                    # First member of an exploded batch: delete the batch.
+                    # Its physical key begins with its last member's key.
+                    phys, value, _ = self._find_phys(key.to_raw(self.prefix))
+                    self._explode_batch(txn, phys, value, key, hi, prefix,
+                                        include)
+                    exploded = keylib.KeyList.from_raw(self.prefix, phys)[0]
+                data = str(data)
                 items.append((key, data))
                 if max_bytes:
-                    _, encoded = self._prepare_batch(items, packer)
-                    if len(encoded) > max_bytes:
+                    sizer.append(key, data)
+                    if sizer.size() > max_bytes:
                         items.pop()
-                        self._write_batch(txn, items, packer)
+                        rawkey = None if batch else loose.pop()
+                        flush()
                         items.append((key, data))
+                        sizer.append(key, data)
+                        if rawkey:
+                            loose.append(rawkey)
                 done = max_recs and len(items) == max_recs
                 if (not done) and grouper:
                     val = grouper(self.encoder.unpack(key, data))
                     done = val != groupval
                     groupval = val
                 if done:
-                    self._write_batch(txn, items, packer)
-        self._write_batch(txn, items, packer)
-
-    def _write_batch(self, txn, items, packer):
-        if items:
-            phys, data = self._prepare_batch(items, packer)
+                    flush()
+        flush()
+        return counts[0], counts[1], key
+
+    def _explode_batch(self, txn, phys, value, key, hi, prefix, include):
+        """Delete the batch record `(phys, value)`, whose members from `key`
+        onwards are being rebatched by :py:meth:`batch`. Members falling
+        outside the range described by `key`, `hi`, `prefix` and `include` are
+        not visited by :py:meth:`batch`, so they are rewritten as batches of
+        their own, one preceding and one following the range."""
+        items, packer, block_size, columnar = self._batch_items(phys, value)
+        txn.delete(phys)
+        self.store.batch_cache.invalidate(phys)
+        if hi is not None:
+            hi = keylib.Key(hi)
+        before = []
+        after = []
+        for item in items:
+            k = item[0]
+            if k < key:
+                before.append(item)
+            elif (hi is not None and (k > hi or (k == hi and not include))) \
+                    or (prefix and not k.startswith(prefix)):
+                after.append(item)
+        self._write_batch(txn, before, packer, block_size, columnar)
+        self._write_batch(txn, after, packer, block_size, columnar)
+
+    def _write_batch(self, txn, items, packer, block_size=None,
+                     columnar=False):
+        """Write `items` as a physical record and empty the list, returning the
+        number of items written."""
+        n = len(items)
+        if n:
+            phys, data = self._prepare_batch(items, packer, block_size,
+                                             columnar)
+            self.store.batch_cache.invalidate(phys)
             txn.put(phys, data)
             del items[:]
+        return n
 
-    def _prepare_batch(self, items, packer):
+    def _packer_prefix(self, packer):
+        """Return the prefix of the compressor `packer`, registering it if
+        necessary."""
         packer_prefix = self.store._encoder_prefix.get(packer)
         if not packer_prefix:
             packer_prefix = self.store.add_encoder(packer)
-        keytups = [key for key, _ in reversed(items)]
-        phys = keylib.packs(self.prefix, keytups)
-        out = bytearray()
-
+        return packer_prefix
+
+    def _prepare_batch(self, items, packer, block_size=None, columnar=False):
+        """Return `(phys, value)` for a physical record containing the sorted
+        list of `(key, data)` pairs `items`. For more than one item, the
+        physical key contains the last and first member keys, while every
+        member key is front coded in the value, followed by the size of each
+        member and finally the compressed concatenation of members. If
+        `block_size` is not ``None``, members are instead compressed in blocks
+        of at least `block_size` bytes, preceded by a table describing each
+        block. If `columnar` is ``True`` and every member is a schema record,
+        members are instead split into one compressed column per field,
+        preceded by a table describing each column. Values are preceded by an
+        :py:data:`ENCODER_TAG` while :py:meth:`reencode` is incomplete."""
+        packer_prefix = self._packer_prefix(packer)
         if len(items) == 1:
-            out.extend(packer_prefix)
-            out.extend(packer.pack(items[0][1]))
+            key, data = items[0]
+            return (key.to_raw(self.prefix),
+                    self._tag + packer_prefix + packer.pack(data))
+
+        raws = [key.to_raw('') for key, _ in items]
+        phys = ''.join((self.prefix, raws[-1], chr(keylib.KIND_SEP), raws[0]))
+        keys = keylib.encode_keys(raws)
+        columns = split_columns(items) if columnar else None
+        out = bytearray(self._tag)
+        if columns is not None:
+            out.extend(BATCH_COLUMNAR)
         else:
-            keylib.write_int(len(items), out.append, 0)
-            for _, data in items:
-                keylib.write_int(len(data), out.append, 0)
+            out.extend(BATCH_BLOCKED if block_size else BATCH_FRONT_CODED)
+        out.extend(keylib.pack_int('', len(items)))
+        for _, data in items:
+            out.extend(keylib.pack_int('', len(data)))
+        out.extend(keylib.pack_int('', len(keys)))
+        out.extend(keys)
+        if columns is not None:
+            packed = [packer_prefix + packer.pack(col) for _, col in columns]
+            out.extend(keylib.pack_int('', len(columns)))
+            for tag, _ in columns:
+                out.extend(keylib.pack_int('', tag))
+            for col in packed:
+                out.extend(keylib.pack_int('', len(col)))
+            for col in packed:
+                out.extend(col)
+            return phys, str(out)
+        if not block_size:
             out.extend(packer_prefix)
             concat = ''.join(data for _, data in items)
             out.extend(packer.pack(concat))
+            return phys, str(out)
+
+        blocks = []
+        block = []
+        size = 0
+        for i, (_, data) in enumerate(items):
+            block.append(data)
+            size += len(data)
+            if size >= block_size or i == (len(items) - 1):
+                blocks.append((len(block),
+                               packer_prefix + packer.pack(''.join(block))))
+                block = []
+                size = 0
+        # Member counts, then compressed sizes, each as an offsets array.
+        out.extend(keylib.pack_int('', len(blocks)))
+        for count, _ in blocks:
+            out.extend(keylib.pack_int('', count))
+        out.extend(keylib.pack_int('', len(blocks)))
+        for _, packed in blocks:
+            out.extend(keylib.pack_int('', len(packed)))
+        for _, packed in blocks:
+            out.extend(packed)
         return phys, str(out)
 
-    def _split_batch(self, key):
-        """Find the batch `key` belongs to and split it, saving all records
-        individually except for `key`."""
-        assert False
-        it = self._iter(key, None, None, None, None, None, None, None)
-        keys, data = next(it, (None, None))
-        assert len(keys) > 1 and key in keys, \
-            'Physical key missing: %r' % (key,)
-
-        self.store._txn_context.get().delete(phys)
-        objs = self.encoder.loads_many(self._decompress(data))
-        for i, obj in enumerate(objs):
-            this_key = keys[-(1 + i)]
-            if this_key != key:
-                self.put(obj, key=this_key)
-
-    def put(self, rec, packer=None, key=None, blind=False):
+    def migrate_batches(self, max_batches=None):
+        """Rewrite batch records in the original format, where the physical
+        key contains every member key, to the current format, where it
+        contains only the last and first member keys. Each batch keeps its
+        compressor. Return the number of batch records rewritten.
+
+            `max_batches`:
+                If not ``None``, stop after rewriting this many batches, so
+                migration may be split across several transactions by calling
+                :py:meth:`migrate_batches` until it returns less than
+                `max_batches`.
+        """
+        txn = self.store._txn_context.get()
+        done = 0
+        lo = self.prefix
+        while max_batches is None or done < max_batches:
+            found = []
+            for key, value in txn.iter(lo, False):
+                key = str(key)
+                if not key.startswith(self.prefix) or len(found) == 64:
+                    break
+                if key == lo:
+                    continue
+                offsets = keylib.tuple_offsets(self.prefix, key)
+                if offsets and len(offsets) > 2 and \
+                        value[0] not in (BATCH_FRONT_CODED, BATCH_BLOCKED):
+                    found.append((key, str(value)))
+                    if (done + len(found)) == max_batches:
+                        break
+            if not found:
+                break
+
+            for phys, value in found:
+                items, packer, _, _ = self._batch_items(phys, value)
+                txn.delete(phys)
+                self.store.batch_cache.invalidate(phys)
+                txn.put(*self._prepare_batch(items, packer))
+            done += len(found)
+            lo = found[-1][0]
+        return done
+
+    def train_compressor(self, max_recs=1000, size=32768, level=6):
+        """Train a preset dictionary from up to `max_recs` encoded records of
+        the collection using :py:func:`acid.encoders.train_zdict`, and return
+        the compressor produced by :py:meth:`Store.add_zdict` for it, labelled
+        with the collection name. Each call creates a new version; records
+        compressed with older versions remain readable.
+
+            `size`:
+                Maximum dictionary size in bytes. zlib refers back at most 32
+                KiB, so larger dictionaries are of no benefit.
+        """
+        it = self._iter(None, None, None, None, False, max_recs, False, None)
+        samples = [str(data) for _, _, data in it]
+        zdict = encoders.train_zdict(samples, size)
+        return self.store.add_zdict(self.info['name'], zdict, level)
+
+    def choose_packer(self, sample=1000, packers=None, max_recs=None,
+                      min_rate=None):
+        """Measure each candidate compressor against up to `sample` encoded
+        records of the collection, returning `(packer, results)`, where
+        `results` is a list of dicts describing each candidate in order of
+        decreasing compression ratio, and `packer` is the first candidate that
+        decompresses at least `min_rate` bytes per second, or the fastest to
+        decompress if none do. Return `(None, [])` if the collection is empty.
+
+            `packers`:
+                Sequence of candidate :py:class:`acid.encoders.Compressor`
+                instances; defaults to :py:data:`acid.encoders.COMPRESSORS`.
+
+            `max_recs`:
+                If not ``None``, compress the sample in groups of this many
+                records, as :py:meth:`batch` would, rather than individually.
+
+            `min_rate`:
+                Minimum acceptable decompression rate, or ``None`` to choose the
+                candidate with the best ratio.
+
+        Each result has a ``packer`` key, a ``ratio`` key giving the size of
+        the sample divided by its compressed size, and ``pack_rate`` and
+        ``unpack_rate`` keys giving the bytes of uncompressed data processed
+        per second.
+
+        ::
+
+            packer, results = coll.choose_packer(max_recs=64, min_rate=100e6)
+            for res in results:
+                print '%-8s %5.2f %8.1f MB/s' % (res['packer'].name,
+                    res['ratio'], res['unpack_rate'] / 1e6)
+            coll.batch(max_recs=64, packer=packer)
+        """
+        it = self._iter(None, None, None, None, False, sample, False, None)
+        data = [str(d) for _, _, d in it]
+        if not data:
+            return None, []
+        if max_recs:
+            data = [''.join(data[i:i + max_recs])
+                    for i in xrange(0, len(data), max_recs)]
+        size = sum(len(s) for s in data)
+
+        results = []
+        for packer in packers or encoders.COMPRESSORS:
+            packed, pack_time = _time_calls(packer.pack, data)
+            _, unpack_time = _time_calls(packer.unpack, packed)
+            results.append({
+                'packer': packer,
+                'ratio': size / float(sum(len(p) for p in packed) or 1),
+                'pack_rate': size / pack_time,
+                'unpack_rate': size / unpack_time
+            })
+        results.sort(key=lambda res: -res['ratio'])
+
+        for res in results:
+            if min_rate is None or res['unpack_rate'] >= min_rate:
+                return res['packer'], results
+        fastest = max(results, key=operator.itemgetter('unpack_rate'))
+        return fastest['packer'], results
+
+    def rekey(self, func, max_recs=None):
+        """Rewrite every record whose key changes when passed through `func`,
+        moving it to the new key and updating its index entries. Batched
+        records are rewritten individually, and may be batched again
+        afterwards. Return the number of records rewritten.
+
+            `func`:
+                Function invoked as `func(key)` for each record, returning the
+                record's new key. It must return its argument unchanged for
+                keys that need no rewriting, including keys it produced.
+
+            `max_recs`:
+                If not ``None``, stop after rewriting this many records, so
+                migration may be split across several transactions by calling
+                :py:meth:`rekey` until it returns less than `max_recs`.
+
+        Old keys containing naive datetimes that were encoded by the C
+        extension prior to its assuming UTC decode as datetimes in the local
+        UTC offset of the host that wrote them. They can be re-encoded as naive
+        UTC using:
+
+        ::
+
+            def naive(key):
+                return tuple(v.replace(tzinfo=None)
+                             if isinstance(v, datetime.datetime) else v
+                             for v in key)
+
+            coll.rekey(naive)
+        """
+        found = []
+        for key, rec in self.items():
+            new = keylib.Key(func(key))
+            if new != key:
+                found.append((key, new, rec))
+                if len(found) == max_recs:
+                    break
+        for key, new, rec in found:
+            self.delete(key)
+            self.put(rec, key=new)
+        return len(found)
+
+    def reencode(self, encoder, packer=None, max_recs=None):
+        """Make the record encoder `encoder` the collection's
+        :py:attr:`encoder`, rewriting every record encoded by its previous
+        encoder. Records are transparently re-encoded when read until
+        rewriting completes, so readers and writers may continue using the
+        collection meanwhile. Return the number of records rewritten.
+
+            `packer`:
+                If not ``None``, compressor used for rewritten records,
+                otherwise each record keeps its compressor.
+
+            `max_recs`:
+                If not ``None``, stop after rewriting at least this many
+                records, so migration may be split across several transactions
+                by calling :py:meth:`reencode` until it returns less than
+                `max_recs`.
+
+        Until rewriting completes, records written carry an
+        :py:data:`ENCODER_TAG`, while untagged records are read using the
+        previous encoder. Other processes must reopen the collection using
+        `encoder`, after registering the previous encoder using
+        :py:meth:`Store.add_encoder` unless it is built in.
+
+        ::
+
+            encoder = acid.encoders.make_json_encoder()
+            while True:
+                with store.begin(write=True):
+                    if coll.reencode(encoder, max_recs=1000) < 1000:
+                        break
+        """
+        if encoder.name != self.encoder.name:
+            self.info.setdefault('old_encoder', self.encoder.name)
+            self.info['encoder'] = encoder.name
+            self.info.pop('reencode_key', None)
+            self.encoder = encoder
+            self.encoder_prefix = self.store.add_encoder(encoder)
+            self._set_old_encoder(self.info['old_encoder'])
+        elif 'old_encoder' not in self.info:
+            return 0
+
+        txn = self.store._txn_context.get()
+        done = 0
+        lo = self.info.get('reencode_key', self.prefix)
+        while max_recs is None or done < max_recs:
+            found = []
+            for key, value in txn.iter(lo, False):
+                key = str(key)
+                if not key.startswith(self.prefix) or len(found) == 64:
+                    break
+                if key != lo and self._untag(value)[0] is not None:
+                    found.append((key, str(value)))
+            if not found:
+                break
+
+            for phys, value in found:
+                if len(keylib.tuple_offsets(self.prefix, phys)) > 2:
+                    items, old, block_size, columnar = \
+                        self._batch_items(phys, value)
+                    txn.delete(phys)
+                    done += self._write_batch(txn, items, packer or old,
+                                              block_size, columnar)
+                else:
+                    key = keylib.Key.from_raw(self.prefix, phys)
+                    data = self._record_data(key, value)
+                    old = packer or \
+                        self.store.get_encoder(self._untag(value)[1][0])
+                    txn.put(phys, self._tag + self._packer_prefix(old) +
+                                  old.pack(data))
+                    done += 1
+                lo = phys
+                if max_recs is not None and done >= max_recs:
+                    break
+
+        if max_recs is None or done < max_recs:
+            # Every record now uses self.encoder.
+            self.info.pop('old_encoder')
+            self.info.pop('reencode_key', None)
+            self._set_old_encoder(None)
+        else:
+            self.info['reencode_key'] = lo
+        self.store.set_info2(KIND_TABLE, self.info['name'], self.info)
+        return done
+
+    def _batch_items(self, phys, value):
+        """Decode the batch record `(phys, value)`, returning `(items, packer,
+        block_size, columnar)`, where `items` is the sorted list of `(key,
+        data)` member pairs, `packer` is the compressor used, `block_size` is
+        the average block size for :py:data:`BATCH_BLOCKED` records, otherwise
+        ``None``, and `columnar` is ``True`` for :py:data:`BATCH_COLUMNAR`
+        records. Members are re-encoded using :py:attr:`encoder` if
+        necessary."""
+        encoder, value = self._untag(value)
+        front, keys, offsets, pos = self._batch_header(phys, value)
+        columnar = value[:2] == BATCH_COLUMNAR
+        if columnar:
+            _, starts = self._column_table(value, pos)
+            packer = encoders.PLAIN
+            if len(starts) > 1:
+                packer = self.store.get_encoder(value[starts[0]])
+            block_size = None
+            data = self._column_data(phys, value, pos, len(keys))
+        elif value[0] == BATCH_BLOCKED:
+            _, starts = self._block_table(value, pos)
+            packer = self.store.get_encoder(value[starts[0]])
+            block_size = offsets[-1] // (len(starts) - 1)
+            data = ''.join(str(block) for block in
+                           self._iter_blocks(phys, value, pos))
+        else:
+            packer = self.store.get_encoder(value[pos])
+            block_size = None
+            data = self._cached_decompress(phys, buffer(value, pos))
+
+        lenk = len(keys)
+        items = [(keys[i if front else (lenk - 1 - i)],
+                  str(data[offsets[i]:offsets[i+1]]))
+                 for i in xrange(lenk)]
+        if encoder is not None:
+            items = [(key, self._transcode(encoder, key, data))
+                     for key, data in items]
+            columnar = columnar and self.encoder.fields is not None
+        return items, packer, block_size, columnar
+
+    def _split_batch(self, key, phys, value, split):
+        """Remove `key` from the batch record `(phys, value)`, rewriting the
+        remaining members as a smaller batch using the same compressor, or as
+        an individual record if only one remains. Return the removed member's
+        data, or ``None`` if `key` was not a member.
+
+        If `split` is ``True``, the caller is about to write `key`, so the
+        batch is rewritten as two batches either side of `key` if it falls
+        within the batch's key range, even if `key` was not a member.
+        """
+        items, packer, block_size, columnar = self._batch_items(phys, value)
+        i = bisect.bisect_left([k for k, _ in items], key)
+        found = i < len(items) and items[i][0] == key
+        if not (found or (split and 0 < i < len(items))):
+            return
+
+        data = found and items.pop(i)[1] or None
+        txn = self.store._txn_context.get()
+        txn.delete(phys)
+        self.store.batch_cache.invalidate(phys)
+        if split:
+            self._write_batch(txn, items[:i], packer, block_size, columnar)
+            self._write_batch(txn, items[i:], packer, block_size, columnar)
+        else:
+            self._write_batch(txn, items, packer, block_size, columnar)
+        return data
+
+    def put(self, rec, packer=None, key=None, blind=False, indices=None):
         """Create or overwrite a record.
 
             `rec`:
@@ -750,9 +2253,11 @@ class Collection(object):
 
             `blind`:
                 If ``True``, skip checks for any old record assigned the same
-                key. Automatically enabled when a collection has no indices, or
-                when `blind=` is passed to :py:class:`Collection`'s
-                constructor.
+                key, including any batch record containing the key, which must
+                otherwise be split. Automatically enabled for keys produced by
+                the collection's key function when :py:meth:`set_blind` is
+                active, or when no key function was given. When a collection
+                has no indices, the check costs only a single seek.
 
                 While this significantly improves performance, enabling it for
                 a collection with indices and in the presence of old records
@@ -760,76 +2265,123 @@ class Collection(object):
                 :py:meth:`Index.iteritems` will issue a warning and discard
                 obsolete keys when this is detected, however other index
                 methods will not.
+
+            `indices`:
+                If not ``None``, a collection of index names whose entries may
+                differ between `rec` and the record it overwrites. Entries for
+                any other index are left untouched, and when no names are
+                given the old record need not be decoded at all. Ignored when
+                no old record exists.
+
+                As with `blind`, naming too few indices will lead to
+                inconsistent indices.
         """
         txn = self.store._txn_context.get()
         if key is None:
             key = self.key_func(rec)
+            blind = blind or self.info['blind']
         key = keylib.Key(key)
+        rawkey = key.to_raw(self.prefix)
         packer = packer or encoders.PLAIN
-        packer_prefix = self.store._encoder_prefix.get(packer)
-        if not packer_prefix:
-            packer_prefix = self.store.add_encoder(packer)
+        packer_prefix = self._packer_prefix(packer)
 
+        if blind or not self._delete(key, rawkey, True, indices):
+            indices = None
+        if self.store.compactor:
+            self.store.compactor.note_write(self.info['name'], key)
         if self.indices:
-            if not (blind or self.info['blind']):
-                self.delete(key)
-            for index_key in self._index_keys(key, rec):
+            for index_key in self._index_keys(key, rec, indices):
                 txn.put(index_key, '')
 
-        txn.put(key.to_raw(self.prefix),
-                packer_prefix + packer.pack(self.encoder.pack(rec)))
+        txn.put(rawkey, self._tag + packer_prefix +
+                        packer.pack(self.encoder.pack(rec)))
         return key
 
     def delete(self, key):
-        """Delete any existing record filed under `key`.
+        """Delete any existing record filed under `key`. If the record is part
+        of a batch, the batch is rewritten without it.
         """
-        it = self._iter(key, None, None, None, None, True, None)
+        key, rawkey = keylib.key_cache.get(self.prefix, key)
+        self._delete(key, rawkey, False)
+        if self.store.compactor:
+            self.store.compactor.note_write(self.info['name'], key)
+
+    def _delete(self, key, rawkey, overwrite, indices=None):
+        """Delete any existing record filed under `key`, along with its index
+        entries, or only those of the indices named in `indices` if it is not
+        ``None``. If `overwrite` is ``True``, an individual record is left in
+        place since the caller is about to replace it. Return ``True`` if a
+        record existed."""
+        phys, value, batch = self._find_phys(rawkey)
+        if phys is None:
+            return False
         txn = self.store._txn_context.get()
-        for batch, key_, data in it:
-            if key != key_:
-                break
+        reindex = self.indices and (indices is None or len(indices) > 0)
+        if batch:
+            data = self._split_batch(key, phys, value, overwrite)
+            if data is None:
+                return False
+        else:
+            if reindex:
+                data = self._record_data(key, value)
+            if not overwrite:
+                txn.delete(phys)
+
+        if reindex:
             obj = self.encoder.unpack(key, data)
-            if self.indices:
-                for key in self._index_keys(key, obj):
-                    txn.delete(key)
-            if batch:
-                self._split_batch(key)
-            else:
-                txn.delete(keylib.packs(self.prefix, key))
+            for index_key in self._index_keys(key, obj, indices):
+                txn.delete(index_key)
+        return True
 
 
 class TxnContext(object):
     """Abstraction for maintaining the local context's transaction. This
-    implementation uses TLS.
+    implementation uses TLS, so each thread has its own transaction.
+
+    If the engine's transactions provide `reset()` and `renew()` methods, as
+    :py:class:`acid.engines.LmdbEngine` does with recent py-lmdb versions, each
+    thread's most recent read-only transaction is reset rather than discarded
+    when it ends, and renewed by the thread's next read-only transaction.
     """
     def __init__(self, engine):
         self.engine = engine
         self.local = threading.local()
 
     def mode(self):
-        """Return a tristate indicating the active transaction mode: ``None`
-        means if no transaction is active, ``False`` if a read-only transaction
-        is active, or ``True`` if a write transaction is active."""
-        if hasattr(self.local, 'txn'):
-            return self.mode
+        """Return a tristate indicating the active transaction mode: ``None``
+        if no transaction is active, ``False`` if a read-only transaction is
+        active, or ``True`` if a write transaction is active."""
+        if getattr(self.local, 'txn', None):
+            return self.local.mode
 
     def begin(self, write=False):
-        self.write = write
+        self.local.write = write
         return self
 
     def __enter__(self):
         txn = getattr(self.local, 'txn', None)
         if txn:
             raise errors.TxnError('Transaction already active for this thread.')
-        txn = self.engine.begin(write=self.write)
+        idle = getattr(self.local, 'idle', None)
+        if idle and not self.local.write:
+            self.local.idle = None
+            idle.renew()
+            txn = idle
+        else:
+            txn = self.engine.begin(write=self.local.write)
+        self.local.mode = self.local.write
         setattr(self.local, 'txn', txn)
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type:
-            self.local.txn.abort()
-        else:
-            self.local.txn.commit()
+        txn = self.local.txn
         del self.local.txn
+        if not self.local.mode and getattr(txn, 'renew', None):
+            txn.reset()
+            self.local.idle = txn
+        elif exc_type:
+            txn.abort()
+        else:
+            txn.commit()
 
     def get(self):
         txn = getattr(self.local, 'txn', None)
@@ -843,6 +2395,15 @@ class Store(object):
     """Represents access to the underlying storage engine, and manages
     counters.
 
+    A store may be shared by many threads, each of which has its own
+    transaction, as provided by :py:class:`TxnContext`. Caches of collection
+    and encoder metadata are protected by a lock, while
+    :py:attr:`batch_cache` has its own. Whether transactions in different
+    threads run concurrently depends on the engine: with
+    :py:class:`acid.engines.LmdbEngine`, readers never block, and each
+    thread's read-only transaction is reused to avoid the cost of starting a
+    new one.
+
         `txn_context`:
             If not ``None``, override the default
             :py:class:`acid.core.TxnContext` implementation to provide
@@ -853,18 +2414,30 @@ class Store(object):
             Prefix for all keys used by any associated object (record, index,
             counter, metadata). This allows the storage engine's key space to
             be shared amongst several users.
+
+        `batch_cache_bytes`:
+            Byte budget for :py:attr:`batch_cache`, or ``0`` to disable it.
     """
-    def __init__(self, engine, txn_context=None, prefix=''):
+    def __init__(self, engine, txn_context=None, prefix='',
+                 batch_cache_bytes=8 * 1024 * 1024):
         self.engine = engine
         self.prefix = prefix
+        #: :py:class:`BatchCache` of decompressed batch records read through
+        #: this store.
+        self.batch_cache = BatchCache(batch_cache_bytes)
+        #: :py:class:`Compactor` notified of writes, or ``None``.
+        self.compactor = None
         self._txn_context = txn_context or TxnContext(engine)
         self.begin = self._txn_context.begin
-        self._counter_key_cache = {}
         self._encoder_prefix = dict((e, keylib.pack_int('', 1 + i))
-                                    for i, e in enumerate(encoders._ENCODERS))
+                                    for i, e in enumerate(encoders._ENCODERS)
+                                    if e)
         self._prefix_encoder = dict((keylib.pack_int('', 1 + i), e)
-                                    for i, e in enumerate(encoders._ENCODERS))
+                                    for i, e in enumerate(encoders._ENCODERS)
+                                    if e)
         # ((kind, name, attr), value)
+        # Held while updating _colls, _encoder_prefix and _prefix_encoder.
+        self._lock = threading.RLock()
         self._meta = Collection(self, {'name': '\x00meta', 'idx': 9},
             encoder=encoders.KEY, key_func=lambda t: t[:3])
         self._colls = {}
@@ -886,7 +2459,7 @@ class Store(object):
         transaction."""
         mode = self._txn_context.mode()
         if mode is None:
-            with self._txn_context.begin():
+            with self._txn_context.begin(write=write):
                 return func()
         elif mode == False and write == True:
             raise errors.TxnError('attempted write in a read-only transaction')
@@ -903,7 +2476,7 @@ class Store(object):
                 self._meta.delete(key)
             for key, value in dct.iteritems():
                 self._meta.put(value, key=(kind, name, key))
-        return self.in_txn(_set_info_txn)
+        return self.in_txn(_set_info_txn, write=True)
 
     def rename_collection(self, old, new):
         if self.get_info2(KIND_TABLE, name):
@@ -934,8 +2507,13 @@ class Store(object):
             info = self.get_info2(KIND_TABLE, name)
             if not info:
                 raise
-            self._colls[name] = Collection(self, info, **kwargs)
-            return self._colls[name]
+            with self._lock:
+                # Another thread may have won the race.
+                coll = self._colls.get(name)
+                if coll is None:
+                    coll = Collection(self, info, **kwargs)
+                    self._colls[name] = coll
+                return coll
 
     def get_index_info(self, name, index_for):
         dct = self.get_info2(KIND_INDEX, name)
@@ -951,27 +2529,89 @@ class Store(object):
         try:
             return self._encoder_prefix[encoder]
         except KeyError:
+            pass
+        with self._lock:
+            if encoder in self._encoder_prefix:
+                return self._encoder_prefix[encoder]
             dct = self.get_info2(KIND_ENCODER, encoder.name)
             idx = dct.get('idx')
             if not dct:
                 idx = self.count('\x00encoder_idx', init=10)
                 assert idx <= 240
                 self.set_info2(KIND_ENCODER, encoder.name, {'idx': idx})
-            self._encoder_prefix[encoder] = keylib.pack_int('', idx)
-            self._prefix_encoder[keylib.pack_int('', idx)] = encoder
-            return self._encoder_prefix[encoder]
+            prefix = keylib.pack_int('', idx)
+            self._prefix_encoder[prefix] = encoder
+            self._encoder_prefix[encoder] = prefix
+            return prefix
+
+    def _find_encoder(self, name):
+        """Return the registered :py:class:`acid.encoders.Encoder` named
+        `name`, or raise an error."""
+        for encoder in list(self._encoder_prefix):
+            if encoder.name == name:
+                return encoder
+        raise errors.ConfigError('Missing encoder: %r; register it using '
+                                 'Store.add_encoder()' % (name,))
 
     def get_encoder(self, prefix):
         """Get a registered :py:class:`acid.encoders.Encoder` given its string
-        prefix, or raise an error."""
+        prefix, or raise an error. Compressors created by :py:meth:`add_zdict`
+        are registered automatically on first use."""
         try:
             return self._prefix_encoder[prefix]
         except KeyError:
             it = self._meta.items(prefix=KIND_ENCODER)
-            dct = dict((v, n) for (k, n, a), v in it if a == 'idx')
+            dct = dict((v, n) for (k, n, a), (v,) in it if a == 'idx')
             idx = keylib.unpack_int(prefix)
+            name = dct.get(idx)
+            if name and self.get_info2(KIND_ZDICT, name):
+                return self._prefix_encoder[self._load_zdict(name)[1]]
+            if 0 < idx <= len(encoders._ENCODER_NAMES):
+                # Predefined compressor whose module is missing.
+                name = encoders._ENCODER_NAMES[idx - 1]
             raise errors.ConfigError('Missing encoder: %r / %d' %\
-                                     (dct.get(idx), idx))
+                                     (name, idx))
+
+    def add_zdict(self, label, zdict, level=6):
+        """Persist the preset dictionary `zdict` as a new version of the
+        dictionary compressor `label`, returning a registered
+        :py:func:`acid.encoders.make_zdict_compressor` instance using it. The
+        dictionary is kept in the store's metadata, so records compressed with
+        any version remain readable after the store is reopened, without the
+        compressor being registered again.
+
+        ::
+
+            packer = store.add_zdict('people', encoders.train_zdict(samples))
+            store['people'].put(rec, packer=packer)
+        """
+        version = self.count('\x00zdict:' + label)
+        name = 'zdict:%s:%d' % (label, version)
+        self.set_info2(KIND_ZDICT, name, {'label': label, 'level': level,
+                                          'zdict': zdict})
+        return self._load_zdict(name)[0]
+
+    def get_zdict(self, label, version=None):
+        """Return the registered compressor for `version` of the dictionary
+        compressor `label`, or its most recent version if `version` is
+        ``None``. Return ``None`` if no such version exists."""
+        if version is None:
+            version = self.count('\x00zdict:' + label, n=0) - 1
+        name = 'zdict:%s:%d' % (label, version)
+        if self.get_info2(KIND_ZDICT, name):
+            return self._load_zdict(name)[0]
+
+    def _load_zdict(self, name):
+        """Construct and register the dictionary compressor `name` from its
+        metadata, returning `(compressor, prefix)`."""
+        with self._lock:
+            for compressor, prefix in self._encoder_prefix.iteritems():
+                if compressor.name == name:
+                    return compressor, prefix
+            dct = self.get_info2(KIND_ZDICT, name)
+            compressor = encoders.make_zdict_compressor(name, dct['zdict'],
+                                                        dct['level'])
+            return compressor, self.add_encoder(compressor)
 
     def count(self, name, n=1, init=1):
         """Increment a counter and return its previous value. The counter is
@@ -988,12 +2628,8 @@ class Store(object):
             `init`:
                 Initial value to give counter if it doesn't exist.
         """
-        try:
-            key = self._counter_key_cache[name]
-        except KeyError:
-            key = keylib.Key(KIND_COUNTER, name, None)
-            self._counter_key_cache[name] = key
-
+        key, _ = keylib.key_cache.get(self._meta.prefix,
+                                      (KIND_COUNTER, name, None))
         value, = self._meta.get(key, default=(init,))
         if n:
             self._meta.put(value + n, key=key)
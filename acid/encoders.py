@@ -15,6 +15,7 @@
 #
 
 from __future__ import absolute_import
+import collections
 import functools
 import operator
 import cPickle as pickle
@@ -25,7 +26,8 @@ import acid
 import acid.keylib
 
 __all__ = ['RecordEncoder', 'make_json_encoder', 'make_msgpack_encoder',
-           'make_thrift_encoder']
+           'make_thrift_encoder', 'make_schema_encoder',
+           'make_zdict_compressor', 'train_zdict']
 
 
 class RecordEncoder(object):
@@ -34,15 +36,18 @@ class RecordEncoder(object):
     new encoders.
 
         `name`:
-            ASCII string uniquely identifying the encoding. A future version
-            may use this to verify the encoding matches what was used to create
-            the :py:class:`acid.Collection`.
+            ASCII string uniquely identifying the encoding. It is recorded
+            when an :py:class:`acid.Collection` is created, and
+            :py:meth:`acid.Store.add_collection` verifies it matches on reopen.
+            Use :py:meth:`acid.Collection.reencode` to change encoders.
 
         `unpack`:
             Function invoked as `func(key, data)` to deserialize an encoded
             record. The `data` argument may be **a buffer**. If your encoder
             does not support the :py:func:`buffer` interface (many C extensions
-            do), then first convert it using :py:func:`str`.
+            do), then first convert it using :py:func:`str`. The buffer may
+            refer to storage engine memory that is only valid until `func`
+            returns, so the result must not retain a reference to it.
 
         `pack`:
             Function invoked as `func(record)` to serialize a record. The
@@ -70,9 +75,26 @@ class RecordEncoder(object):
             Function invoked as `func(obj, attr)` to delete the attribute
             `attr` from `obj`. Used by :py:mod:`acid.meta` to implement
             attribute access. The default is :py:func:`operator.delitem`.
+
+        `unpack_fields`
+            Function invoked as `func(key, data, names)` to deserialize only
+            the fields named by the tuple `names` from an encoded record,
+            returning a dict of those present. Used by
+            :py:meth:`Collection.values(..., fields=) <acid.Collection.values>`.
+            The default deserializes the entire record using `unpack`, then
+            copies each field using `get`.
+
+        `fields`
+            For encoders storing records as produced by
+            :py:func:`acid.keylib.pack_fields`, the sequence of `(field_id,
+            kind, name)` tuples describing each field. This enables
+            :py:meth:`Collection.batch(..., columnar=True)
+            <acid.Collection.batch>` and :py:meth:`Collection.aggregate
+            <acid.Collection.aggregate>`. The default is ``None``.
     """
     def __init__(self, name, unpack, pack, new=None,
-                 get=None, set=None, delete=None):
+                 get=None, set=None, delete=None, unpack_fields=None,
+                 fields=None):
         self.name = name
         self.unpack = unpack
         self.pack = pack
@@ -80,6 +102,18 @@ class RecordEncoder(object):
         self.get = get or dict.get
         self.set = set or operator.setitem
         self.delete = delete or operator.delitem
+        self.unpack_fields = unpack_fields or self._unpack_fields
+        self.fields = fields
+
+    def _unpack_fields(self, key, data, names):
+        obj = self.unpack(key, data)
+        get = self.get
+        out = {}
+        for name in names:
+            value = get(obj, name)
+            if value is not None:
+                out[name] = value
+        return out
 
 
 class Compressor(object):
@@ -108,11 +142,21 @@ class Compressor(object):
             then first convert it using :py:func:`str`. The function may return
             :py:func:`str` or any object supporting the :py:func:`buffer`
             interface.
+
+        `compressobj`:
+            Optional function invoked as `func()` to return an incremental
+            compressor object like :py:func:`zlib.compressobj`, whose output
+            is identical to `pack`. It must provide `compress(data)`,
+            `flush()` and `copy()` methods. When present,
+            :py:meth:`Collection.batch <acid.Collection.batch>` uses it to
+            measure batches under `max_bytes` without recompressing every
+            member each time one is appended.
     """
-    def __init__(self, name, unpack, pack):
+    def __init__(self, name, unpack, pack, compressobj=None):
         self.name = name
         self.unpack = unpack
         self.pack = pack
+        self.compressobj = compressobj
 
 
 def make_json_encoder(separators=',:', **kwargs):
@@ -134,7 +178,20 @@ def make_msgpack_encoder():
     <https://pypi.python.org/pypi/msgpack-python/>`_ package."""
     import msgpack
     unpack = lambda key, data: msgpack.loads(data)
-    return RecordEncoder('msgpack', unpack, msgpack.dumps)
+
+    def unpack_fields(key, data, names):
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(data)
+        out = {}
+        for _ in xrange(unpacker.read_map_header()):
+            name = unpacker.unpack()
+            if name in names:
+                out[name] = unpacker.unpack()
+            else:
+                unpacker.skip()
+        return out
+    return RecordEncoder('msgpack', unpack, msgpack.dumps,
+                         unpack_fields=unpack_fields)
 
 
 def make_thrift_encoder(klass, factory=None):
@@ -152,6 +209,7 @@ def make_thrift_encoder(klass, factory=None):
     """
     import thrift.protocol.TCompactProtocol
     import thrift.transport.TTransport
+    import thrift.Thrift
     import thrift.TSerialization
 
     if not factory:
@@ -168,10 +226,139 @@ def make_thrift_encoder(klass, factory=None):
         assert isinstance(value, klass)
         return thrift.TSerialization.serialize(value, factory)
 
+    def unpack_fields(key, data, names):
+        transport = thrift.transport.TTransport.TMemoryBuffer(data)
+        proto = factory.getProtocol(transport)
+        spec = klass.thrift_spec
+        out = {}
+        proto.readStructBegin()
+        while True:
+            _, ttype, fid = proto.readFieldBegin()
+            if ttype == thrift.Thrift.TType.STOP:
+                break
+            fspec = spec[fid] if 0 <= fid < len(spec) else None
+            if fspec and fspec[1] == ttype and fspec[2] in names:
+                out[fspec[2]] = proto.readFieldByTType(ttype, fspec[3])
+            else:
+                proto.skip(ttype)
+            proto.readFieldEnd()
+        proto.readStructEnd()
+        return out
+
     # Form a name from the Thrift ttypes module and struct name.
     name = 'thrift:%s.%s' % (klass.__module__, klass.__name__)
-    return RecordEncoder(name, loads, dumps, factory=klass,
-                         get=getattr, set=setattr, delete=delattr)
+    return RecordEncoder(name, loads, dumps, new=klass, get=getattr,
+                         set=setattr, delete=delattr,
+                         unpack_fields=unpack_fields)
+
+
+def make_schema_encoder(fields):
+    """
+    Return an :py:class:`Encoder <acid.Encoder>` that serializes dicts using
+    :py:func:`acid.keylib.pack_fields`, a compact binary representation where
+    each field is identified by a small integer rather than its name.
+    :py:mod:`acid.meta` uses this for models whose fields declare a
+    `field_id`.
+
+    `fields`:
+        Sequence of `(field_id, kind, name)` tuples, where `kind` is one of
+        the :py:mod:`acid.keylib` ``FIELD_*`` constants. Fields may be added
+        or removed without rewriting existing records, but a `field_id` must
+        never be reused for a different field.
+    """
+    fields = sorted(fields)
+    tags = dict(((field_id << 3) | kind, name)
+                for field_id, kind, name in fields)
+    name_tags = dict((name, tag) for tag, name in tags.iteritems())
+    # Map tuples of field names to the corresponding subset of `tags`.
+    projections = {}
+
+    def unpack_fields(key, data, names):
+        subset = projections.get(names)
+        if subset is None:
+            subset = dict((name_tags[name], name)
+                          for name in names if name in name_tags)
+            projections[names] = subset
+        return acid.keylib.unpack_fields(subset, data, False)
+
+    unpack = lambda key, data: acid.keylib.unpack_fields(tags, data)
+    pack = functools.partial(acid.keylib.pack_fields, fields)
+    return RecordEncoder('schema', unpack, pack, unpack_fields=unpack_fields,
+                         fields=fields)
+
+
+def train_zdict(samples, size=32768, width=8, segment=64):
+    """Return a preset dictionary of at most `size` bytes for
+    :py:func:`make_zdict_compressor`, built from substrings common to several
+    of the bytestrings in `samples`.
+
+    Each `width` byte substring is scored by the number of samples containing
+    it, ignoring substrings found in only one sample. The samples are divided
+    into groups, and from each group the `segment` byte run with the highest
+    total score is chosen, after which the scores of its substrings are reset
+    so later choices favour other content. Runs with the highest scores are
+    placed at the end of the dictionary, where they are cheapest for zlib to
+    refer to.
+    """
+    samples = [str(s) for s in samples if len(s) >= width]
+    freq = collections.defaultdict(int)
+    for s in samples:
+        for w in set(s[i:i + width] for i in xrange(len(s) - width + 1)):
+            freq[w] += 1
+    for w, n in freq.items():
+        if n < 2:
+            del freq[w]
+
+    ngroups = max(1, min(len(samples), size // segment))
+    chosen = []
+    for group in xrange(ngroups):
+        best = (0, None)
+        for s in samples[group::ngroups]:
+            scores = [freq.get(s[i:i + width], 0)
+                      for i in xrange(len(s) - width + 1)]
+            n = max(1, min(len(scores), segment - width + 1))
+            total = sum(scores[:n])
+            best = max(best, (total, s[:n + width - 1]))
+            for i in xrange(n, len(scores)):
+                total += scores[i] - scores[i - n]
+                if total > best[0]:
+                    best = (total, s[i - n + 1:i + width])
+        score, seg = best
+        if score:
+            chosen.append(best)
+            for i in xrange(len(seg) - width + 1):
+                freq.pop(seg[i:i + width], None)
+
+    chosen.sort()
+    out = ''.join(seg for _, seg in chosen)
+    return out[-size:] if size else ''
+
+
+def make_zdict_compressor(name, zdict, level=6):
+    """Return a :py:class:`Compressor` named `name` that compresses using zlib
+    with the preset dictionary `zdict`, such as one produced by
+    :py:func:`train_zdict`. Small records sharing much of their content, such
+    as JSON objects with identical keys, compress well even individually.
+
+    Python 2's zlib module lacks preset dictionary support, so the dictionary
+    is instead compressed once ahead of time, and each record is compressed by
+    a copy of the compressor state following it. The compressed form of a
+    record is therefore only valid for the same `zdict` and `level`.
+    :py:meth:`Store.add_zdict <acid.Store.add_zdict>` persists both, so
+    records remain readable after the store is reopened.
+    """
+    compressor = zlib.compressobj(level)
+    head = compressor.compress(zdict) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    decompressor = zlib.decompressobj()
+    decompressor.decompress(head)
+
+    def pack(data):
+        obj = compressor.copy()
+        return obj.compress(data) + obj.flush()
+
+    def unpack(data):
+        return decompressor.copy().decompress(data)
+    return Compressor(name, unpack, pack, compressor.copy)
 
 
 #: Encode Python tuples using keylib.packs()/keylib.unpacks().
@@ -190,12 +377,72 @@ def _pickle_unpack(key, value):
 PICKLE = RecordEncoder('pickle', _pickle_unpack,
                        functools.partial(pickle.dumps, protocol=2))
 
-#: Perform no compression at all.
-PLAIN = Compressor('plain', str, lambda o: o)
+#: Perform no compression at all. Decompression returns its input, which is
+#: usually a buffer, without copying it.
+PLAIN = Compressor('plain', lambda o: o, lambda o: o)
 
 #: Compress bytestrings using zlib.compress()/zlib.decompress().
-ZLIB = Compressor('zlib', zlib.decompress, zlib.compress)
+ZLIB = Compressor('zlib', zlib.decompress, zlib.compress, zlib.compressobj)
+
+
+def _make_lz4():
+    try:
+        import lz4.block
+        return Compressor('lz4', lz4.block.decompress, lz4.block.compress)
+    except ImportError:
+        pass
+    try:
+        import lz4
+        return Compressor('lz4', lz4.loads, lz4.dumps)
+    except ImportError:
+        return None
+
+def _make_snappy():
+    try:
+        import snappy
+    except ImportError:
+        return None
+    return Compressor('snappy', snappy.uncompress, snappy.compress)
+
+def _make_zstd(level=3):
+    try:
+        import zstandard
+    except ImportError:
+        try:
+            import zstd
+        except ImportError:
+            return None
+        return Compressor('zstd', zstd.decompress,
+                          lambda data: zstd.compress(data, level))
+    # The frame header records the content size, so decompress() needs no
+    # size hint.
+    compressor = zstandard.ZstdCompressor(level=level, write_content_size=True)
+    decompressor = zstandard.ZstdDecompressor()
+    return Compressor('zstd', lambda data: decompressor.decompress(str(data)),
+                      compressor.compress)
+
+#: Compress bytestrings using `LZ4 <https://pypi.python.org/pypi/lz4/>`_ block
+#: compression, or ``None`` if the :py:mod:`lz4` package is missing.
+LZ4 = _make_lz4()
+
+#: Compress bytestrings using `Snappy
+#: <https://pypi.python.org/pypi/python-snappy/>`_, or ``None`` if the
+#: :py:mod:`snappy` package is missing.
+SNAPPY = _make_snappy()
+
+#: Compress bytestrings using `Zstandard
+#: <https://pypi.python.org/pypi/zstandard/>`_ at level 3, or ``None`` if
+#: neither the :py:mod:`zstandard` nor :py:mod:`zstd` package is present.
+ZSTD = _make_zstd()
 
 # The order of this tuple is significant. See core.Store source/data format
-# documentation for more information.
-_ENCODERS = (KEY, PICKLE, PLAIN, ZLIB)
+# documentation for more information. Optional compressors keep their position
+# when their module is missing, so their prefixes never change.
+_ENCODERS = (KEY, PICKLE, PLAIN, ZLIB, LZ4, SNAPPY, ZSTD)
+_ENCODER_NAMES = ('key', 'pickle', 'plain', 'zlib', 'lz4', 'snappy', 'zstd')
+
+#: Compressors available for :py:meth:`Collection.choose_packer
+#: <acid.Collection.choose_packer>` to consider by default; the optional
+#: compressors whose module is present, along with :py:data:`PLAIN` and
+#: :py:data:`ZLIB`.
+COMPRESSORS = tuple(c for c in (PLAIN, ZLIB, LZ4, SNAPPY, ZSTD) if c)
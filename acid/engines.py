@@ -21,6 +21,8 @@ import itertools
 import math
 import random
 
+from acid import keylib
+
 
 __all__ = ['SkipList', 'SkiplistEngine', 'ListEngine', 'PlyvelEngine',
            'KyotoEngine', 'LmdbEngine']
@@ -33,6 +35,13 @@ class Engine(object):
     documentary purposes. All key and value variables below are ``NUL``-safe
     bytestrings.
     """
+    #: If not ``None``, indicates :py:meth:`iter` yields buffer objects that
+    #: become invalid when the transaction ends, rather than bytestrings.
+    #: Should be set to an :py:class:`acid.keylib.Notifier` on which
+    #: :py:meth:`expire() <acid.keylib.Notifier.expire>` is called before
+    #: :py:meth:`abort` or :py:meth:`commit` invalidate any buffer.
+    notifier = None
+
     def close(self):
         """Close the database connection. The default implementation does
         nothing."""
@@ -367,21 +376,54 @@ class LmdbEngine(object):
         `db`:
             Database handle to use, or ``None`` to use the main database.
 
+        `buffers`:
+            If ``True``, read-only transactions are started with py-lmdb's
+            `buffers=True` option, avoiding a copy of each key and value
+            visited during iteration. Keys produced by
+            :py:class:`acid.Collection` borrow from these buffers until the
+            transaction ends.
+
         `kwargs`:
             If `env` and `txn` are ``None``, pass these keyword arguments to
             create a new :py:class:`lmdb.Environment`.
     """
-    def __init__(self, env=None, txn=None, db=None, **kwargs):
+    notifier = None
+
+    def __init__(self, env=None, txn=None, db=None, buffers=False, **kwargs):
         if not (env or txn):
             import lmdb
             env = lmdb.open(**kwargs)
         self.env = env
         self.txn = txn
         self.db = db
-        self.get = (txn or env).get
-        self.put = (txn or env).put
-        self.delete = (txn or env).delete
-        self.cursor = (txn or env).cursor
+        self.buffers = buffers
+        if txn or hasattr(env, 'get'):
+            self.get = (txn or env).get
+            self.put = (txn or env).put
+            self.delete = (txn or env).delete
+            self.cursor = (txn or env).cursor
+        else:
+            # Newer py-lmdb lacks Environment.get() and friends, so emulate
+            # them using a transaction per call.
+            self.get = self._autocommit('get', False)
+            self.put = self._autocommit('put', True)
+            self.delete = self._autocommit('delete', True)
+            self.iter = self._autocommit_iter
+        if not hasattr(txn, 'renew'):
+            # Older py-lmdb lacks Transaction.reset() and renew(), so read-only
+            # transactions cannot be reused.
+            self.reset = self.renew = None
+
+    def _autocommit(self, name, write):
+        def func(*args):
+            with self.env.begin(write=write) as txn:
+                return getattr(txn, name)(*args, db=self.db)
+        return func
+
+    def _autocommit_iter(self, k, reverse):
+        with self.env.begin() as txn:
+            for tup in txn.cursor(db=self.db)._iter_from(k, reverse):
+                yield tup
 
     def close(self):
         self.env.close()
@@ -394,13 +436,36 @@ class LmdbEngine(object):
                 Start a write transaction
         """
         assert not self.txn
-        return LmdbEngine(self.env, self.env.begin(write=write))
+        buffers = self.buffers and not write
+        engine = LmdbEngine(self.env, self.env.begin(write=write,
+                                                     buffers=buffers))
+        if buffers:
+            engine.notifier = keylib.Notifier()
+        return engine
 
     def abort(self):
+        if self.notifier is not None:
+            self.notifier.expire()
         self.txn.abort()
 
     def commit(self):
+        if self.notifier is not None:
+            self.notifier.expire()
         self.txn.commit()
 
+    def reset(self):
+        """End a read-only transaction, retaining its resources so it may be
+        restarted by :py:meth:`renew`."""
+        if self.notifier is not None:
+            self.notifier.expire()
+        self.txn.reset()
+
+    def renew(self):
+        """Restart a read-only transaction ended by :py:meth:`reset`, observing
+        the most recent committed state."""
+        self.txn.renew()
+        if self.notifier is not None:
+            self.notifier = keylib.Notifier()
+
     def iter(self, k, reverse):
         return self.cursor(db=self.db)._iter_from(k, reverse)
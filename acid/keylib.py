@@ -20,20 +20,27 @@ SQLite4-like tuple serialization.
 
 from __future__ import absolute_import
 
-import calendar
 import datetime
+import decimal
 import itertools
 import os
+import re
+import struct
 import sys
 import time
 import uuid
 
 
-__all__ = ['Key', 'invert', 'unpacks', 'packs', 'unpack_int', 'pack_int']
+__all__ = ['Key', 'invert', 'unpacks', 'packs', 'unpack_int', 'pack_int',
+           'packs_many', 'packs_buffer', 'unpacks_many', 'tuple_offsets',
+           'Notifier', 'KeyCache', 'key_cache', 'KeyList', 'encode_keys',
+           'pack_fields', 'unpack_fields']
 
 KIND_NULL = 0x0f
 KIND_NEG_INTEGER = 0x14
 KIND_INTEGER = 0x15
+KIND_FLOAT = 0x19
+KIND_DECIMAL = 0x1a
 KIND_BOOL = 0x1e
 KIND_BLOB = 0x28
 KIND_TEXT = 0x32
@@ -41,12 +48,37 @@ KIND_UUID = 0x5a
 KIND_NEG_TIME = 0x5b
 KIND_TIME = 0x5c
 KIND_SEP = 0x66
+
+#: Field kinds used by :py:func:`pack_fields`, stored in the low 3 bits of
+#: each field's tag.
+FIELD_BOOL = 0
+FIELD_INTEGER = 1
+FIELD_DOUBLE = 2
+FIELD_STRING = 3
+FIELD_TIME = 4
+
 INVERT_TBL = ''.join(chr(c ^ 0xff) for c in xrange(256))
+_CHR = [chr(c) for c in xrange(256)]
+_INV_CHR = [chr(c ^ 0xff) for c in xrange(256)]
+_ZEROS = ['\x00' * c for c in xrange(9)]
+_PADS = ['\x80' * c for c in xrange(9)]
+_H = struct.Struct('>H')
+_Q = struct.Struct('>Q')
+_D = struct.Struct('>d')
+_SIGN_BIT = 1 << 63
+_ALL_BITS = (1 << 64) - 1
+_STR_END_RE = re.compile('[\x00-\x7f]')
+_INT_KINDS = frozenset([KIND_INTEGER, KIND_NEG_INTEGER, KIND_BOOL, KIND_TIME,
+                        KIND_NEG_TIME])
+_NEG_KINDS = frozenset([KIND_NEG_INTEGER, KIND_NEG_TIME])
 
 UTCOFFSET_SHIFT = 64 # 16 hours * 4 (15 minute increments)
 UTCOFFSET_DIV = 15 * 60 # 15 minutes
 
-_tz_cache = {}
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+#: Map encoded UTC offset to the Unix epoch as a local time in that offset.
+_epoch_cache = {}
 
 
 class Key(object):
@@ -89,12 +121,21 @@ class Key(object):
     def from_hex(cls, hex_, secret=None):
         """Construct a Key from its raw form wrapped in hex. `secret` is
         currently unused."""
-        return self.from_raw('', hex_.decode('hex'))
+        return cls.from_raw('', hex_.decode('hex'))
 
     @classmethod
-    def from_raw(cls, prefix, packed):
+    def from_raw(cls, prefix, packed, notifier=None):
         """Construct a Key from its raw form, skipping the bytestring `prefix`
-        at the start."""
+        at the start. Return ``None`` if `packed` does not start with `prefix`.
+
+        `packed` may be a bytestring or any other buffer object. If a
+        :py:class:`Notifier` is given, the Key may borrow memory from `packed`
+        until the notifier expires, otherwise `packed` is copied if it is not a
+        bytestring. This implementation always copies."""
+        if type(packed) is not str:
+            packed = str(packed)
+        if not packed.startswith(prefix):
+            return
         self = cls()
         self.prefix = prefix
         self.packed = packed
@@ -126,42 +167,92 @@ class Key(object):
         return iter(self.args)
 
     def __getitem__(self, i):
-        try:
+        if self.args is not None:
             return self.args[i]
-        except TypeError:
+        if type(i) is not int or i < 0:
             self.args = unpack(self.prefix, self.packed)
             return self.args[i]
 
+        # Decode only the requested element.
+        inp = bytearray(self.packed)
+        length = len(inp)
+        pos = len(self.prefix)
+        while i and pos < length and inp[pos] != KIND_SEP:
+            pos = _skip_element(inp, pos, length)
+            i -= 1
+        if pos >= length or inp[pos] == KIND_SEP:
+            raise IndexError('Key index out of range')
+        return _read_element(inp, pos, length)[0]
+
     def __hash__(self):
+        # Keys compare equal to tuples with the same encoding.
         if self.args is None:
             self.args = unpack(self.prefix, self.packed)
         return hash(self.args)
 
     def __len__(self):
-        if self.args is None:
-            self.args = unpack(self.prefix, self.packed)
-        return len(self.args)
+        if self.args is not None:
+            return len(self.args)
+        inp = bytearray(self.packed)
+        length = len(inp)
+        pos = len(self.prefix)
+        n = 0
+        while pos < length and inp[pos] != KIND_SEP:
+            pos = _skip_element(inp, pos, length)
+            n += 1
+        return n
+
+    def _raw_other(self, other):
+        """Return the encoded form of `other` prefixed by this key's prefix,
+        without modifying `other`. Encodings of tuples are cached in
+        :py:data:`key_cache`."""
+        if type(other) is Key:
+            if other.prefix == self.prefix:
+                return other.packed
+            return self.prefix + other.packed[len(other.prefix):]
+        return key_cache.get(self.prefix, other)[1]
+
+    def startswith(self, other):
+        """Return ``True`` if the elements of the Key or tuple `other` form a
+        prefix of this Key's elements. As with :py:class:`Key`, if `other` is
+        not a tuple it is treated as a 1-tuple. Only the encoded forms are
+        compared.
+
+        ::
+
+            >>> Key(1, 'ab', 2).startswith((1, 'ab'))
+            True
+            >>> Key(1, 'abc').startswith((1, 'ab'))
+            False
+        """
+        raw = self._raw_other(other)
+        packed = self.packed
+        if not packed.startswith(raw):
+            return False
+        # The next byte must begin a new element. String encodings have the
+        # high bit set, while kind bytes do not.
+        return len(packed) == len(raw) or packed[len(raw)] < '\x80'
 
     def __le__(self, other):
-        return self.packed <= Key(other).to_raw(self.prefix)
+        return self.packed <= self._raw_other(other)
 
     def __ge__(self, other):
-        return self.packed >= Key(other).to_raw(self.prefix)
+        return self.packed >= self._raw_other(other)
 
     def __lt__(self, other):
-        return self.packed < Key(other).to_raw(self.prefix)
+        return self.packed < self._raw_other(other)
 
     def __gt__(self, other):
-        return self.packed > Key(other).to_raw(self.prefix)
+        return self.packed > self._raw_other(other)
 
     def __eq__(self, other):
-        return self.packed == Key(other).to_raw(self.prefix)
+        return self.packed == self._raw_other(other)
 
     def __ne__(self, other):
-        return self.packed != Key(other).to_raw(self.prefix)
+        return self.packed != self._raw_other(other)
 
     def __cmp__(self, other):
-        return cmp(self.packed, Key(other).to_raw(self.prefix))
+        return cmp(self.packed, self._raw_other(other))
 
     def __repr__(self):
         if self.args is None:
@@ -169,10 +260,167 @@ class Key(object):
         return 'acid.Key%r' % (self.args,)
 
 
+class Notifier(object):
+    """Tracks Keys borrowing memory from buffers that become invalid at some
+    future point, such as when a storage engine transaction ends.
+    :py:meth:`expire` must be called before that happens, causing every Key
+    still alive to copy its data.
+
+    This implementation does nothing, since :py:meth:`Key.from_raw` always
+    copies.
+    """
+    def expire(self):
+        """Copy the data of any Key borrowing memory tracked by this notifier.
+        """
+
+
+class KeyCache(object):
+    """Bounded cache mapping a prefix and key tuple to its :py:class:`Key` and
+    encoded form, avoiding repeated encoding of frequently used keys, such as
+    query bounds and counter names.
+
+    Eviction is approximately least-recently-used: entries are stored in a
+    young generation, which becomes the old generation once it holds half of
+    `size` entries. Entries found in the old generation are promoted back to
+    the young generation, while those never found again are discarded with
+    it.
+
+    Since ``(1,) == (True,) == (1.0,)``, element types form part of the cache
+    key. Equal datetimes with different UTC offsets also have distinct
+    encodings, so the offset of each datetime forms part of the cache key too.
+    """
+    def __init__(self, size=1024):
+        #: Maximum number of entries.
+        self.size = size
+        #: Number of lookups satisfied from the cache.
+        self.hits = 0
+        #: Number of lookups that required a key to be encoded.
+        self.misses = 0
+        self._young = {}
+        self._old = {}
+
+    def __len__(self):
+        return len(self._young) + len(self._old)
+
+    def clear(self):
+        """Discard all entries and reset :py:attr:`hits` and
+        :py:attr:`misses`."""
+        self._young = {}
+        self._old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, prefix, args):
+        """Return `(key, raw)`, where `key` is the :py:class:`Key` for `args`
+        and `raw` is its encoding prefixed by `prefix`. As with
+        :py:class:`Key`, if `args` is not a tuple it is treated as a 1-tuple.
+        """
+        type_ = type(args)
+        if type_ is Key:
+            return args, args.to_raw(prefix)
+        elif type_ is not tuple:
+            args = (args,)
+
+        types = tuple(map(type, args))
+        if datetime.datetime in types:
+            types += tuple(arg.utcoffset() for arg in args
+                           if type(arg) is datetime.datetime)
+        # Types precede args, since comparing naive and aware datetimes
+        # raises TypeError.
+        ckey = (prefix, types, args)
+        try:
+            ent = self._young[ckey]
+            self.hits += 1
+            return ent
+        except KeyError:
+            ent = self._old.pop(ckey, None)
+        except TypeError:
+            self.misses += 1
+            raw = packs(prefix, args)
+            return Key.from_raw(prefix, raw), raw
+
+        if ent:
+            self.hits += 1
+        else:
+            self.misses += 1
+            raw = packs(prefix, args)
+            ent = Key.from_raw(prefix, raw), raw
+
+        if len(self._young) >= (self.size / 2):
+            self._old = self._young
+            self._young = {}
+        self._young[ckey] = ent
+        return ent
+
+
+#: Shared :py:class:`KeyCache` used for query bounds, counter names, and by
+#: :py:class:`Key` comparisons.
+key_cache = KeyCache()
+
+
 class KeyList(object):
+    """Sequence of :py:class:`Key` instances for each tuple of a physical key
+    produced by :py:func:`packs`, such as the key of a batch record. Only the
+    raw key and the offset of each tuple are stored; Keys are constructed on
+    demand, and in the C implementation, borrow memory from the raw key rather
+    than copying it.
+    """
+    __slots__ = ('prefix', 'raw', 'offsets')
+
     @classmethod
-    def from_raw(cls, prefix, packed):
-        return unpacks(prefix, packed)
+    def from_raw(cls, prefix, raw):
+        """Construct a KeyList from the bytestring or buffer `raw`, skipping
+        the bytestring `prefix` at the start. Return ``None`` if `raw` does not
+        start with `prefix`."""
+        if type(raw) is not str:
+            raw = str(raw)
+        offsets = tuple_offsets(prefix, raw)
+        if offsets is None:
+            return
+        self = cls()
+        self.prefix = prefix
+        self.raw = raw
+        self.offsets = offsets
+        return self
+
+    @classmethod
+    def from_front(cls, s):
+        """Construct a KeyList from the bytestring or buffer `s` produced by
+        :py:func:`encode_keys`."""
+        ba = bytearray(s)
+        length = len(ba)
+        pos = 0
+        keys = []
+        prev = ''
+        while pos < length:
+            shared, pos = read_int(ba, pos, length, 0)
+            if pos >= length:
+                raise ValueError('front coded keys corrupt.')
+            n, pos = read_int(ba, pos, length, 0)
+            if shared > len(prev) or (pos + n) > length:
+                raise ValueError('front coded keys corrupt.')
+            prev = prev[:shared] + str(ba[pos:pos + n])
+            pos += n
+            keys.append(prev)
+
+        self = cls()
+        self.prefix = ''
+        self.raw = _CHR[KIND_SEP].join(keys)
+        self.offsets = [0]
+        for key in keys:
+            self.offsets.append(self.offsets[-1] + len(key) + 1)
+        return self
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.offsets) - 1
+        if not (0 <= i < (len(self.offsets) - 1)):
+            raise IndexError('KeyList index out of range')
+        packed = self.raw[self.offsets[i]:self.offsets[i + 1] - 1]
+        return Key.from_raw(self.prefix, self.prefix + packed)
 
 
 
@@ -213,11 +461,10 @@ def invert(s):
     return s.translate(INVERT_TBL)
 
 
-def write_int(v, w, xor):
-    """Given a positive integer of 64-bits or less, encode it in a
-    variable-length form that preserves the original integer order. Invokes
-    `w()` repeatedly with byte ordinals corresponding to the encoded
-    representation.
+def encode_int(v, xor=0):
+    """Given a positive integer of 64-bits or less, return a bytestring
+    containing its variable-length encoding that preserves the original integer
+    order. If `xor` is ``0xff``, the bits of the encoding are inverted.
 
     The output size is such that:
 
@@ -244,231 +491,268 @@ def write_int(v, w, xor):
         +-------------+------------------------+
     """
     if v <= 240:
-        w(xor ^ v)
+        return (_INV_CHR if xor else _CHR)[v]
     elif v <= 2287:
-        v -= 240
-        w(xor ^ (241 + (v >> 8)))
-        w(xor ^ (v & 0xff))
+        s = _H.pack(v + 0xf010) # (241 << 8) - 240
     elif v <= 67823:
-        v -= 2288
-        w(xor ^ (0xf9))
-        w(xor ^ ((v >> 8)))
-        w(xor ^ ((v & 0xff)))
-    elif v <= 0xffffff:
-        w(xor ^ 0xfa)
-        w(xor ^ (v >> 16))
-        w(xor ^ ((v >> 8) & 0xff))
-        w(xor ^ ((v & 0xff)))
-    elif v <= 0xffffffff:
-        w(xor ^ 0xfb)
-        w(xor ^ (v >> 24))
-        w(xor ^ ((v >> 16) & 0xff))
-        w(xor ^ ((v >> 8) & 0xff))
-        w(xor ^ ((v & 0xff)))
-    elif v <= 0xffffffffff:
-        w(xor ^ 0xfc)
-        w(xor ^ ((v >> 32)))
-        w(xor ^ ((v >> 24) & 0xff))
-        w(xor ^ ((v >> 16) & 0xff))
-        w(xor ^ ((v >> 8) & 0xff))
-        w(xor ^ ((v & 0xff)))
-    elif v <= 0xffffffffffff:
-        w(xor ^ 0xfd)
-        w(xor ^ ((v >> 40)))
-        w(xor ^ ((v >> 32) & 0xff))
-        w(xor ^ ((v >> 24) & 0xff))
-        w(xor ^ ((v >> 16) & 0xff))
-        w(xor ^ ((v >> 8) & 0xff))
-        w(xor ^ ((v & 0xff)))
-    elif v <= 0xffffffffffffff:
-        w(xor ^ 0xfe)
-        w(xor ^ ((v >> 48)))
-        w(xor ^ ((v >> 40) & 0xff))
-        w(xor ^ ((v >> 32) & 0xff))
-        w(xor ^ ((v >> 24) & 0xff))
-        w(xor ^ ((v >> 16) & 0xff))
-        w(xor ^ ((v >> 8) & 0xff))
-        w(xor ^ ((v & 0xff)))
+        s = '\xf9' + _H.pack(v - 2288)
     elif v <= 0xffffffffffffffff:
-        w(xor ^ 0xff)
-        w(xor ^ (v >> 56))
-        w(xor ^ ((v >> 48) & 0xff))
-        w(xor ^ ((v >> 40) & 0xff))
-        w(xor ^ ((v >> 32) & 0xff))
-        w(xor ^ ((v >> 24) & 0xff))
-        w(xor ^ ((v >> 16) & 0xff))
-        w(xor ^ ((v >> 8) & 0xff))
-        w(xor ^ ((v & 0xff)))
+        n = (v.bit_length() + 7) >> 3
+        s = _CHR[0xf7 + n] + _Q.pack(v)[8 - n:]
     else:
         raise ValueError('Cannot encode integers >= 64 bits, got %d bits (%#x)'
                          % (v.bit_length(), v))
+    if xor:
+        s = s.translate(INVERT_TBL)
+    return s
+
+
+def write_int(v, w, xor):
+    """Encode `v` as if by :py:func:`encode_int`, invoking `w()` repeatedly
+    with byte ordinals corresponding to the encoded representation. Prefer
+    :py:func:`encode_int` where the output is a bytearray."""
+    for o in bytearray(encode_int(v, xor)):
+        w(o)
 
 
 def read_int(inp, pos, length, xor):
-    """Decode and return an integer encoded by :py:func:`write_int`. Invokes
-    `getc` repeatedly, which should yield integer bytes from the input stream.
+    """Decode and return an integer encoded by :py:func:`encode_int` from the
+    bytearray `inp` starting at `pos`, returning `(value, pos)` where `pos` is
+    the offset following the encoding.
     """
     o = xor ^ inp[pos]
     if o <= 240:
         return o, pos+1
 
-    have = length - pos
     if o <= 248:
-        if have < 2:
-            raise ValueError('not enough bytes: need 2')
-        o2 = xor ^ inp[pos+1]
-        return 240 + (256 * (o - 241) + o2), pos+2
-
-    if have < (o - 249):
-        raise ValueError('not enough bytes: need %d' % (o - 249))
-
-    if o == 249:
-        return 2288 + (256*(xor^inp[pos+1])) + (xor^inp[pos+2]), pos+3
-    elif o == 250:
-        return ((xor^(inp[pos+1] << 16)) |
-                (xor^(inp[pos+2] << 8)) |
-                (xor^(inp[pos+3]))), pos+4
-    elif o == 251:
-        return ((xor^(inp[pos+1] << 24)) |
-                (xor^(inp[pos+2] << 16)) |
-                (xor^(inp[pos+3] << 8)) |
-                (xor^(inp[pos+4]))), pos+5
-    elif o == 252:
-        return ((xor^(inp[pos+1] << 32)) |
-                (xor^(inp[pos+2] << 24)) |
-                (xor^(inp[pos+3] << 16)) |
-                (xor^(inp[pos+4] << 8)) |
-                (xor^(inp[pos+5]))), pos+6
-    elif o == 253:
-        return ((xor^(inp[pos+1] << 40)) |
-                (xor^(inp[pos+2] << 32)) |
-                (xor^(inp[pos+3] << 24)) |
-                (xor^(inp[pos+4] << 16)) |
-                (xor^(inp[pos+5] << 8)) |
-                (xor^(inp[pos+6]))), pos+7
-    elif o == 254:
-        return ((xor^(inp[pos+1] << 48)) |
-                (xor^(inp[pos+2] << 40)) |
-                (xor^(inp[pos+3] << 32)) |
-                (xor^(inp[pos+4] << 24)) |
-                (xor^(inp[pos+5] << 16)) |
-                (xor^(inp[pos+6] << 8)) |
-                (xor^(inp[pos+7]))), pos+8
-    elif o == 255:
-        return ((xor^(inp[pos+1] << 56)) |
-                (xor^(inp[pos+2] << 48)) |
-                (xor^(inp[pos+3] << 40)) |
-                (xor^(inp[pos+4] << 32)) |
-                (xor^(inp[pos+5] << 24)) |
-                (xor^(inp[pos+6] << 16)) |
-                (xor^(inp[pos+7] << 8)) |
-                (xor^(inp[pos+8]))), pos+9
+        n = 1
+    elif o == 249:
+        n = 2
+    else:
+        n = o - 247
+    end = pos + 1 + n
+    if end > length:
+        raise ValueError('not enough bytes: need %d' % (n + 1,))
+
+    s = str(inp[pos+1:end])
+    if xor:
+        s = s.translate(INVERT_TBL)
+    if o <= 248:
+        return 240 + (256 * (o - 241)) + ord(s), end
+    elif o == 249:
+        return 2288 + _H.unpack(s)[0], end
+    return _Q.unpack(_ZEROS[8 - n] + s)[0], end
 
 
-def write_str(s, w):
+def encode_str(s):
     """Encode the bytestring `s` so that no NUL appears in the output. A
     constant-space encoding is used that treats the input as a stream of bits,
-    packing each group of 7 bits into a byte with the highest bit always set,
-    except for the final byte. A delimiting NUL is appended to the output.
-    Invokes `w()` repeatedly with byte ordinals corresponding to the encoded
-    representation."""
-    shift = 1
-    trailer = 0
-
-    for o in bytearray(s):
-        w(0x80 | trailer | (o >> shift))
-        if shift < 7:
-            trailer = (o << (7 - shift)) & 0xff
-            shift += 1
-        else:
-            w(0x80 | o)
-            shift = 1
-            trailer = 0
-
-    if len(s) % 7:
-        w(0x80 | trailer)
-
+    packing each group of 7 bits into a byte with the highest bit always set.
+    The encoding ends at the first following byte lacking the high bit, or at
+    the end of the key.
+
+    Input is processed in 7 byte chunks, each producing 8 output bytes. A
+    partial final chunk of `n` bytes produces `n + 1` output bytes."""
+    length = len(s)
+    rem = length % 7
+    if rem:
+        s += _ZEROS[7 - rem]
+        outlen = length + (length // 7) + 1
+    else:
+        outlen = length + (length // 7)
+
+    unpack = _Q.unpack
+    pack = _Q.pack
+    out = []
+    for i in xrange(0, len(s), 7):
+        n = unpack('\x00' + s[i:i+7])[0]
+        n = ((n & 0xfffffff0000000) << 4) | (n & 0xfffffff)
+        n = ((n & 0x0fffc0000fffc000) << 2) | (n & 0x00003fff00003fff)
+        n = ((n & 0x3f803f803f803f80) << 1) | (n & 0x007f007f007f007f)
+        out.append(pack(n | 0x8080808080808080))
+    if len(out) == 1:
+        return out[0][:outlen]
+    return ''.join(out)[:outlen]
 
-def read_str(inp, pos, length):
-    """Decode and return a bytestring encoded by :py:func:`read_str`. Invokes
-    `getc` repeatedly, which should yield byte ordinals from the input
-    stream."""
-    if pos >= length:
-        return '', pos
-    lb = inp[pos]
-    if lb < 0x80:
-        return '', pos
-    pos += 1
-    out = bytearray()
-    shift = 1
-    while pos < length:
-        cb = inp[pos]
-        if cb < 0x80:
-            break
-        pos += 1
-        ch = (lb << shift) & 0xff
-        ch |= (cb & 0x7f) >> (7 - shift)
-        out.append(ch)
-        if shift < 7:
-            shift += 1
-            lb = cb
-        else:
-            shift = 1
-            if pos >= length:
-                break
-            lb = inp[pos]
-            if lb < 0x80:
-                break
-            pos += 1
 
-    return str(out), pos
+def write_str(s, w):
+    """Encode `s` as if by :py:func:`encode_str`, invoking `w()` repeatedly
+    with byte ordinals corresponding to the encoded representation. Prefer
+    :py:func:`encode_str` where the output is a bytearray."""
+    for o in bytearray(encode_str(s)):
+        w(o)
 
 
-def write_time(dt, w):
-    """Encode a datetime.datetime to `w`.
+def read_str(inp, pos, length):
+    """Decode and return a bytestring encoded by :py:func:`encode_str` from
+    the bytearray `inp` starting at `pos`, returning `(value, pos)` where `pos`
+    is the offset following the encoding."""
+    m = _STR_END_RE.search(inp, pos, length)
+    end = m.start() if m else length
+    elen = end - pos
+    rem = elen & 7
+    if rem:
+        enc = str(inp[pos:end]) + _PADS[8 - rem]
+        outlen = elen - (elen >> 3) - 1
+    else:
+        enc = str(inp[pos:end])
+        outlen = elen - (elen >> 3)
+
+    unpack = _Q.unpack
+    pack = _Q.pack
+    out = []
+    for i in xrange(0, len(enc), 8):
+        n = unpack(enc[i:i+8])[0] & 0x7f7f7f7f7f7f7f7f
+        n = ((n & 0x7f007f007f007f00) >> 1) | (n & 0x007f007f007f007f)
+        n = ((n & 0x3fff00003fff0000) >> 2) | (n & 0x00003fff00003fff)
+        n = ((n & 0x0fffffff00000000) >> 4) | (n & 0x000000000fffffff)
+        out.append(pack(n)[1:])
+    if len(out) == 1:
+        return out[0][:outlen], end
+    return ''.join(out)[:outlen], end
+
+
+def encode_time(dt):
+    """Return the bytestring encoding of a datetime.datetime, including its
+    kind byte. Naive datetimes are assumed to be in UTC.
     """
-    msec = int(calendar.timegm(dt.utctimetuple())) * 1000
-    msec += dt.microsecond / 1000
-    msec <<= 7
-    if dt.tzinfo:
-        offset = int(dt.utcoffset().total_seconds())
+    secs = (dt.toordinal() - _EPOCH_ORDINAL) * 86400
+    secs += (dt.hour * 3600) + (dt.minute * 60) + dt.second
+    offset = dt.utcoffset()
+    if offset:
+        offset = (offset.days * 86400) + offset.seconds
+        secs -= offset
     else:
-        offset = (calendar.timegm(dt.timetuple()) -
-                  calendar.timegm(dt.utctimetuple()))
+        offset = 0
 
-    msec |= (offset / UTCOFFSET_DIV) + UTCOFFSET_SHIFT
+    msec = (secs * 1000) + (dt.microsecond // 1000)
+    msec <<= 7
+    # Offsets round towards zero, as in C.
+    msec |= int(offset / float(UTCOFFSET_DIV)) + UTCOFFSET_SHIFT
     if msec < 0:
-        w(KIND_NEG_TIME)
-        write_int(-msec, w, 0xff)
-    else:
-        w(KIND_TIME)
-        write_int(msec, w, 0)
+        return _CHR[KIND_NEG_TIME] + encode_int(-msec, 0xff)
+    return _CHR[KIND_TIME] + encode_int(msec)
 
 
-def read_time(kind, inp, pos, length):
+def read_time(kind, inp, pos, length, naive=False):
+    """Decode the time starting at `pos` in the bytearray `inp`, returning
+    `(value, pos)`. If `naive` is ``True``, return a naive datetime in UTC,
+    otherwise return a datetime in the original UTC offset."""
     xor = 0xff if kind == KIND_NEG_TIME else 0
-    msec, pos = read_int(inp, pos, length, xor)
-    offset = msec & 0x7f
-    msec >>= 7
+    v, pos = read_int(inp, pos, length, xor)
     if kind == KIND_NEG_TIME:
-        msec = -msec
+        v = -v
+    delta = datetime.timedelta(0, 0, 0, v >> 7)
+    if naive:
+        return _EPOCH + delta, pos
 
+    offset = v & 0x7f
     try:
-        tz = _tz_cache[offset]
+        epoch = _epoch_cache[offset]
     except KeyError:
-        tz = FixedOffsetZone((offset - UTCOFFSET_SHIFT) * UTCOFFSET_DIV)
-        _tz_cache[offset] = tz
-
-    return datetime.datetime.fromtimestamp(msec / 1000.0, tz), pos
+        secs = (offset - UTCOFFSET_SHIFT) * UTCOFFSET_DIV
+        epoch = _EPOCH.replace(tzinfo=FixedOffsetZone(secs))
+        epoch += datetime.timedelta(0, secs)
+        _epoch_cache[offset] = epoch
+    return epoch + delta, pos
+
+
+def encode_float(f):
+    """Return the bytestring encoding of the float `f`, including its kind
+    byte. The IEEE 754 representation is written big-endian, with every bit
+    inverted for negative numbers and only the sign bit inverted otherwise, so
+    that the encoded bytes sort in numeric order. Negative zero is encoded as
+    zero.
+    """
+    n = _Q.unpack(_D.pack(f or 0.0))[0]
+    if n & _SIGN_BIT:
+        n ^= _ALL_BITS
+    else:
+        n ^= _SIGN_BIT
+    return _CHR[KIND_FLOAT] + _Q.pack(n)
+
+
+def read_float(inp, pos, length):
+    """Decode the 8 byte float starting at `pos` in the bytearray `inp`,
+    returning `(value, pos)`."""
+    end = pos + 8
+    if end > length:
+        raise ValueError('short float read')
+    n = _Q.unpack(str(inp[pos:end]))[0]
+    if n & _SIGN_BIT:
+        n ^= _SIGN_BIT
+    else:
+        n ^= _ALL_BITS
+    return _D.unpack(_Q.pack(n))[0], end
+
+
+def encode_decimal(d):
+    """Return the bytestring encoding of the ``decimal.Decimal`` `d`,
+    including its kind byte. A class byte of 0x01, 0x02 or 0x03 follows for
+    negative, zero and positive values. Nonzero values are normalized to
+    ``0.DDD * 10**E``, and written as the exponent `E` followed by the digits
+    packed two per byte as ``1 + 10*a + b``, terminated by 0x00. Every byte
+    following the class of a negative value is inverted, so that the encoded
+    bytes sort in numeric order. Raise ``ValueError`` for NaN and infinity.
+    """
+    if not d.is_finite():
+        raise ValueError('cannot encode non-finite decimal')
+    sign, digits, exp = d.as_tuple()
+    ndigits = len(digits)
+    while ndigits and not digits[ndigits - 1]:
+        ndigits -= 1
+        exp += 1
+    if not ndigits:
+        return '\x1a\x02'
+    e = ndigits + exp
+    if e < 0:
+        body = '\x01' + encode_int(-e, 0xff)
+    else:
+        body = '\x02' + encode_int(e)
+    digits = digits[:ndigits] + (0,)
+    body += ''.join(_CHR[1 + 10*digits[i] + digits[i + 1]]
+                    for i in xrange(0, ndigits, 2)) + '\x00'
+    if sign:
+        return '\x1a\x01' + body.translate(INVERT_TBL)
+    return '\x1a\x03' + body
+
+
+def read_decimal(inp, pos, length):
+    """Decode the decimal starting at `pos` in the bytearray `inp`,
+    returning `(value, pos)`."""
+    if pos >= length:
+        raise ValueError('short decimal read')
+    cls = inp[pos]
+    pos += 1
+    if cls == 0x02:
+        return decimal.Decimal(0), pos
+    elif cls != 0x01 and cls != 0x03:
+        raise ValueError('bad decimal class %r; key corrupt?' % (cls,))
+    xor = 0xff if cls == 0x01 else 0
+    if pos >= length:
+        raise ValueError('short decimal read')
+    if (inp[pos] ^ xor) == 0x01:
+        e, pos = read_int(inp, pos + 1, length, xor ^ 0xff)
+        e = -e
+    else:
+        e, pos = read_int(inp, pos + 1, length, xor)
+    digits = []
+    while True:
+        if pos >= length:
+            raise ValueError('short decimal read')
+        o = inp[pos] ^ xor
+        pos += 1
+        if not o:
+            break
+        digits.extend(divmod(o - 1, 10))
+    if digits and not digits[-1]:
+        digits.pop()
+    return decimal.Decimal((xor & 1, tuple(digits), e - len(digits))), pos
 
 
 def pack_int(prefix, i):
-    """Invoke :py:func:`write_int(i, ba) <write_int>` using a temporary
-    :py:class:`bytearray` initialized to contain `prefix`, returning the result
-    as a bytestring."""
-    ba = bytearray(prefix)
-    write_int(i, ba.append, 0)
-    return str(ba)
+    """Return :py:func:`encode_int(i) <encode_int>` appended to `prefix`."""
+    return prefix + encode_int(i)
 
 
 def unpack_int(s):
@@ -494,13 +778,21 @@ def packs(prefix, tups):
         1. ``None``
         2. Negative integers
         3. Positive integers
-        4. ``False``
-        5. ``True``
-        6. Bytestrings (i.e. :py:func:`str`).
-        7. Unicode strings.
-        8. ``uuid.UUID`` instances.
-        9. ``datetime.datetime`` instances.
-        10. Sequences with another tuple following the last identical element.
+        4. Floats, in numeric order.
+        5. ``decimal.Decimal`` instances, in numeric order.
+        6. ``False``
+        7. ``True``
+        8. Bytestrings (i.e. :py:func:`str`).
+        9. Unicode strings.
+        10. ``uuid.UUID`` instances.
+        11. ``datetime.datetime`` instances.
+        12. Sequences with another tuple following the last identical element.
+
+    Integers, floats and decimals are distinct kinds: every float sorts after
+    every integer, and every decimal after every float, at the same position,
+    so a field should hold only one of them. Decimals are encoded exactly, so
+    distinct values always produce distinct keys; NaN and infinity raise
+    ``ValueError``.
 
     If `tups` is not exactly a list, it is assumed to a be single key, and will
     be treated as if it were wrapped in a list.
@@ -516,51 +808,95 @@ def packs(prefix, tups):
         >>> packs([(1,)]) # Treated like packs([(1,)])
     """
     ba = bytearray(prefix)
+    _write_key(ba, tups)
+    return str(ba)
+
+
+def _write_key(ba, tups):
+    """Encode `tups` to the bytearray `ba` according to the rules of
+    :py:func:`packs`."""
     w = ba.append
+    extend = ba.extend
 
     if type(tups) is not list:
         tups = [tups]
 
-    last = len(tups) - 1
     for i, tup in enumerate(tups):
         if i:
             w(KIND_SEP)
         if type(tup) not in GOOD_TYPES:
             tup = (tup,)
-        for j, arg in enumerate(tup):
+        for arg in tup:
             type_ = type(arg)
             if type_ is int or type_ is long:
                 if arg < 0:
                     w(KIND_NEG_INTEGER)
-                    write_int(-arg, w, 0xff)
+                    extend(encode_int(-arg, 0xff))
                 else:
                     w(KIND_INTEGER)
-                    write_int(arg, w, 0)
+                    extend(encode_int(arg))
             elif type_ is str:
                 w(KIND_BLOB)
-                write_str(arg, w)
+                extend(encode_str(arg))
             elif type_ is unicode:
                 w(KIND_TEXT)
-                write_str(arg.encode('utf-8'), w)
+                extend(encode_str(arg.encode('utf-8')))
             elif arg is None:
                 w(KIND_NULL)
             elif type_ is uuid.UUID:
                 w(KIND_UUID)
-                ba.extend(arg.get_bytes())
+                extend(arg.get_bytes())
             elif type_ is bool:
                 w(KIND_BOOL)
-                write_int(arg, w, 0)
+                w(arg)
             elif type_ is datetime.datetime:
-                write_time(arg, w)
+                extend(encode_time(arg))
+            elif type_ is float:
+                extend(encode_float(arg))
+            elif type_ is decimal.Decimal:
+                extend(encode_decimal(arg))
             else:
                 raise TypeError('unsupported type: %r' % (arg,))
-    return str(ba)
+
+
+def packs_many(prefix, seq):
+    """Encode each element of `seq` as if by :py:func:`packs`, returning a list
+    of bytestrings each beginning with `prefix`. Prefer this to repeated calls
+    to :py:func:`packs` when many keys must be produced at once.
+
+    ::
+
+        >>> packs_many('', [1, (2, 3), [(4,), (5,)]])
+        ['\x15\x01', '\x15\x02\x15\x03', '\x15\x04f\x15\x05']
+    """
+    return [packs(prefix, tups) for tups in seq]
+
+
+def packs_buffer(prefix, seq):
+    """Encode each element of `seq` as if by :py:func:`packs`, returning a
+    tuple `(s, offsets)`, where `s` is a single bytestring containing every
+    encoded key, each beginning with `prefix`, and `offsets` is a list of
+    ``len(seq) + 1`` integers such that ``s[offsets[i]:offsets[i+1]]`` is the
+    `i`th key.
+
+    ::
+
+        >>> packs_buffer('', [1, 2])
+        ('\x15\x01\x15\x02', [0, 2, 4])
+    """
+    ba = bytearray()
+    offsets = [0]
+    for tups in seq:
+        ba.extend(prefix)
+        _write_key(ba, tups)
+        offsets.append(len(ba))
+    return str(ba), offsets
 
 
 pack = packs
 
 
-def unpacks(prefix, s, first=False):
+def unpacks(prefix, s, first=False, number_factory=None, naive=False):
     """Decode a bytestring produced by :py:func:`keylib.packs`, returning the
     list of tuples the string represents.
 
@@ -573,57 +909,310 @@ def unpacks(prefix, s, first=False):
             Stop work after the first tuple has been decoded and return it
             immediately. Note the return value is the tuple, not a list
             containing the tuple.
+
+        `number_factory`:
+            If specified, invoked with the shortest string representation of
+            each decoded float (i.e. its ``repr()``), with the result used in
+            place of the float. Every float is converted, including those
+            that were floats when encoded, so this suits fields holding only
+            one kind of number. Decimals decode as ``decimal.Decimal``
+            regardless.
+
+        `naive`:
+            If ``True``, decode datetimes as naive datetimes in UTC, rather than
+            constructing them in their original UTC offset.
     """
-    if not s.startswith(prefix):
+    plength = len(prefix)
+    if s[:plength] != prefix:
         return
 
-    plength = len(prefix)
-    inp = bytearray(s[plength:])
+    inp = bytearray(s)
     length = len(inp)
-    pos = 0
+    pos = plength
 
     tups = []
     tup = []
     while pos < length:
-        c = inp[pos]
-        pos += 1
-        if c == KIND_NULL:
-            arg = None
-        elif c == KIND_INTEGER:
-            arg, pos = read_int(inp, pos, length, 0)
-        elif c == KIND_NEG_INTEGER:
-            arg, pos = read_int(inp, pos, length, 0xff)
-            arg = -arg
-        elif c == KIND_BLOB:
-            arg, pos = read_str(inp, pos, length)
-        elif c == KIND_TEXT:
-            arg, pos = read_str(inp, pos, length)
-            arg = arg.decode('utf-8')
-        elif c == KIND_TIME or c == KIND_NEG_TIME:
-            arg, pos = read_time(c, inp, pos, length)
-        elif c == KIND_BOOL:
-            arg = bool(inp[pos])
+        if inp[pos] == KIND_SEP:
             pos += 1
-        elif c == KIND_UUID:
-            if (pos + 16) >= length:
-                raise ValueError('short UUID read')
-            arg = uuid.UUID(None, s[plength + pos:plength + pos + 16])
-            pos += 16
-        elif c == KIND_SEP:
             tups.append(tuple(tup))
             if first:
                 return tups[0]
             tup = []
-            continue
         else:
-            raise ValueError('bad kind %r; key corrupt? %r' % (c, tup))
-        tup.append(arg)
+            arg, pos = _read_element(inp, pos, length, number_factory, naive)
+            tup.append(arg)
     tups.append(tuple(tup))
     return tups[0] if first else tups
 
 
-def unpack(prefix, s):
-    return unpacks(prefix, s, True)
+def _read_element(inp, pos, length, number_factory=None, naive=False):
+    """Decode the element starting at `pos` in the bytearray `inp`, returning
+    `(value, pos)` where `pos` is the offset following the element."""
+    c = inp[pos]
+    pos += 1
+    if c == KIND_NULL:
+        return None, pos
+    elif c == KIND_INTEGER:
+        return read_int(inp, pos, length, 0)
+    elif c == KIND_NEG_INTEGER:
+        arg, pos = read_int(inp, pos, length, 0xff)
+        return -arg, pos
+    elif c == KIND_BLOB:
+        return read_str(inp, pos, length)
+    elif c == KIND_TEXT:
+        arg, pos = read_str(inp, pos, length)
+        return arg.decode('utf-8'), pos
+    elif c == KIND_TIME or c == KIND_NEG_TIME:
+        return read_time(c, inp, pos, length, naive)
+    elif c == KIND_BOOL:
+        return bool(inp[pos]), pos + 1
+    elif c == KIND_FLOAT:
+        arg, pos = read_float(inp, pos, length)
+        if number_factory:
+            arg = number_factory(repr(arg))
+        return arg, pos
+    elif c == KIND_DECIMAL:
+        return read_decimal(inp, pos, length)
+    elif c == KIND_UUID:
+        if (pos + 16) > length:
+            raise ValueError('short UUID read')
+        return uuid.UUID(bytes=str(inp[pos:pos + 16])), pos + 16
+    raise ValueError('bad kind %r; key corrupt?' % (c,))
+
+
+def _skip_element(inp, pos, length):
+    """Return the offset following the element starting at `pos` in the
+    bytearray `inp`, without decoding it."""
+    c = inp[pos]
+    pos += 1
+    if c in _INT_KINDS:
+        o = inp[pos] ^ (0xff if c in _NEG_KINDS else 0)
+        if o <= 240:
+            pos += 1
+        elif o <= 248:
+            pos += 2
+        elif o == 249:
+            pos += 3
+        else:
+            pos += o - 246
+    elif c == KIND_BLOB or c == KIND_TEXT:
+        m = _STR_END_RE.search(inp, pos, length)
+        pos = m.start() if m else length
+    elif c == KIND_UUID:
+        pos += 16
+    elif c == KIND_FLOAT:
+        pos += 8
+    elif c == KIND_DECIMAL:
+        pos = read_decimal(inp, pos, length)[1]
+    elif c != KIND_NULL:
+        raise ValueError('bad kind %r; key corrupt?' % (c,))
+    if pos > length:
+        raise ValueError('short element read; key corrupt?')
+    return pos
+
+
+def encode_keys(keys):
+    """Front code the sorted list of encoded keys `keys`, returning a
+    bytestring containing, for each key, a varint giving the length of the
+    prefix it shares with its predecessor, a varint giving the length of the
+    remainder, then the remainder itself. Decode the result using
+    :py:meth:`KeyList.from_front`.
+
+    ::
+
+        >>> encode_keys(['ab', 'abc'])
+        '\x00\x02ab\x02\x01c'
+    """
+    out = bytearray()
+    prev = ''
+    for key in keys:
+        shared = 0
+        end = min(len(prev), len(key))
+        while shared < end and prev[shared] == key[shared]:
+            shared += 1
+        out.extend(encode_int(shared))
+        out.extend(encode_int(len(key) - shared))
+        out.extend(key[shared:])
+        prev = key
+    return str(out)
+
+
+def pack_fields(fields, rec):
+    """Encode the dict `rec` as a sequence of tagged fields, returning a
+    bytestring. `fields` is a sequence of `(field_id, kind, name)` tuples
+    describing each field, where `field_id` is a positive integer, `kind` is
+    one of the ``FIELD_*`` constants, and `name` is the key of the field's
+    value in `rec`. Fields whose value is missing or ``None`` are omitted.
+
+    Each field is written as a varint tag ``(field_id << 3) | kind``, followed
+    by its value. If `rec` contains a ``None`` key, its value is taken to be
+    fields previously found by :py:func:`unpack_fields` that lacked a
+    description, and is appended unchanged.
+
+    ::
+
+        >>> pack_fields([(1, FIELD_STRING, 'name')], {'name': u'Dave'})
+        '\x0b\x04Dave'
+    """
+    out = bytearray()
+    for field_id, kind, name in fields:
+        v = rec.get(name)
+        if v is None:
+            continue
+        out.extend(encode_int((field_id << 3) | kind))
+        if kind == FIELD_BOOL:
+            out.append(1 if v else 0)
+        elif kind == FIELD_INTEGER:
+            if not (-_SIGN_BIT <= v < _SIGN_BIT):
+                raise ValueError('%r: integer field out of range' % (name,))
+            out.extend(encode_int((v << 1) if v >= 0 else ((-v << 1) - 1)))
+        elif kind == FIELD_DOUBLE:
+            out.extend(_D.pack(v))
+        else:
+            if kind == FIELD_STRING:
+                if type(v) is unicode:
+                    v = v.encode('utf-8')
+                elif type(v) is not str:
+                    raise TypeError('%r: string field must be str or '
+                                    'unicode, got %r' % (name, type(v)))
+            elif kind == FIELD_TIME:
+                v = packs('', (v,))
+            else:
+                raise ValueError('%r: bad field kind %r' % (name, kind))
+            out.extend(encode_int(len(v)))
+            out.extend(v)
+    unknown = rec.get(None)
+    if unknown:
+        out.extend(unknown)
+    return str(out)
+
+
+def unpack_fields(fields, s, unknown=True):
+    """Decode the bytestring or buffer `s` produced by :py:func:`pack_fields`,
+    returning a dict. `fields` maps the tag ``(field_id << 3) | kind`` of each
+    known field to its name. Strings are decoded as unicode. Fields whose tag
+    is not in `fields`, such as those added to a newer version of a schema or
+    whose kind has changed, are concatenated in their encoded form and stored
+    under the ``None`` key, so they are not lost if the dict is packed again.
+    If `unknown` is ``False`` they are skipped, and decoding stops once every
+    field in `fields` has been found, allowing a subset of fields to be
+    decoded cheaply.
+
+    ::
+
+        >>> unpack_fields({0x0b: 'name'}, '\x0b\x04Dave')
+        {'name': u'Dave'}
+    """
+    inp = bytearray(s)
+    length = len(inp)
+    rec = {}
+    skipped = []
+    pos = 0
+    while pos < length:
+        start = pos
+        tag, pos = read_int(inp, pos, length, 0)
+        kind = tag & 7
+        if pos == length:
+            raise ValueError('not enough bytes: need 1')
+        if kind <= FIELD_INTEGER:
+            v, pos = read_int(inp, pos, length, 0)
+        elif kind == FIELD_DOUBLE:
+            end = pos + 8
+            if end > length:
+                raise ValueError('not enough bytes: need 8')
+            v = inp[pos:end]
+            pos = end
+        elif kind <= FIELD_TIME:
+            n, pos = read_int(inp, pos, length, 0)
+            end = pos + n
+            if end > length:
+                raise ValueError('not enough bytes: need %d' % (n,))
+            v = inp[pos:end]
+            pos = end
+        else:
+            raise ValueError('bad field kind %d; record corrupt?' % (kind,))
+
+        name = fields.get(tag)
+        if name is None:
+            if unknown:
+                skipped.append(str(inp[start:pos]))
+        elif kind == FIELD_BOOL:
+            rec[name] = bool(v)
+        elif kind == FIELD_INTEGER:
+            rec[name] = -((v + 1) >> 1) if v & 1 else (v >> 1)
+        elif kind == FIELD_DOUBLE:
+            rec[name] = _D.unpack(str(v))[0]
+        elif kind == FIELD_STRING:
+            rec[name] = str(v).decode('utf-8')
+        else:
+            rec[name] = unpack('', str(v))[0]
+        if name is not None and not unknown and len(rec) == len(fields):
+            break
+    if skipped:
+        rec[None] = ''.join(skipped)
+    return rec
+
+
+def unpack(prefix, s, number_factory=None, naive=False):
+    return unpacks(prefix, s, True, number_factory, naive)
+
+
+def tuple_offsets(prefix, s):
+    """Locate each tuple within the bytestring or buffer `s` produced by
+    :py:func:`packs`, without decoding it. Return a list of offsets such that
+    tuple `i` occupies ``s[offsets[i]:offsets[i+1]-1]``, or ``None`` if `s`
+    does not start with `prefix`. The number of tuples is ``len(offsets) -
+    1``.
+
+    ::
+
+        >>> tuple_offsets('', packs('', [(1, 'a'), (2,)]))
+        [0, 6, 9]
+    """
+    plength = len(prefix)
+    if s[:plength] != prefix:
+        return
+
+    inp = bytearray(s)
+    length = len(inp)
+    pos = plength
+    offsets = [pos]
+    while pos < length:
+        if inp[pos] == KIND_SEP:
+            pos += 1
+            offsets.append(pos)
+        else:
+            pos = _skip_element(inp, pos, length)
+    offsets.append(length + 1)
+    return offsets
+
+
+def unpacks_many(prefix, seq, offsets=None, first=False, number_factory=None,
+                 naive=False):
+    """Decode many keys in one call, returning a list containing the result of
+    :py:func:`unpacks` for each key.
+
+        `seq`:
+            Either a sequence of bytestrings, or when `offsets` is given, a
+            single bytestring or buffer containing the concatenation of every
+            key, as returned by :py:func:`packs_buffer`.
+
+        `offsets`:
+            If not ``None``, a list of ``len(keys) + 1`` integers describing
+            the position of each key within `seq`.
+
+        `first`:
+            If ``True``, decode only the first tuple of each key, as if by
+            :py:func:`unpack`.
+
+        `number_factory`, `naive`:
+            As for :py:func:`unpacks`.
+    """
+    if offsets is not None:
+        seq = [seq[offsets[i]:offsets[i + 1]]
+               for i in xrange(len(offsets) - 1)]
+    return [unpacks(prefix, s, first, number_factory, naive) for s in seq]
 
 
 # Hack: disable speedups while testing or reading docstrings.
@@ -20,10 +20,36 @@ definition of database models using Python code.
 
 .. warning::
 
-    This is a work in progress! The examples here do not yet work perfectly,
-    and the most interesting aspect is missing. A future version will use the
-    model definitions to maintain a compact encoding automatically. For now
-    this is just a curiosity.
+    This is a work in progress! The examples here do not yet work perfectly.
+
+Records are stored as JSON unless every field of a model declares a
+`field_id`, in which case the compact binary encoding produced by
+:py:func:`acid.encoders.make_schema_encoder` is used. Fields may later be
+added or removed, but a field ID must never be reused for a different field.
+Since the choice of encoding is recorded by the collection, adding field IDs
+to a model with existing JSON records requires migrating its collection.
+
+Setting ``META_LAZY = True`` on a model class causes instances read from the
+store to keep a copy of their encoded record, decoding each field only when it
+is first accessed. With the compact encoding, fields are decoded individually,
+so scans that inspect only one or two fields of most records avoid decoding the
+remainder. The record is fully decoded when a field is assigned or deleted.
+
+Models track which fields have been assigned or deleted since they were loaded
+or last saved, available as :py:attr:`BaseModel.dirty`. Saving a model that
+was previously saved and has no dirty fields does nothing, and an index
+declared with `depends` is only recomputed when one of the fields it depends
+on is dirty. Mutating a field's value in place, such as appending to a list,
+is not tracked; assign the field again, or pass ``force=True`` to
+:py:meth:`BaseModel.save`.
+
+Setting ``META_SLOTS = True`` on a model class stores field values in
+``__slots__`` rather than a per-instance record dict, greatly reducing the
+memory used by each instance and making field access as cheap as ordinary
+attribute access. Fields of such models read as ``None`` when unset, are never
+lazy, and are not tracked as dirty, so every save writes the full record. Each
+base class must also set ``META_SLOTS``, or declare ``__slots__ = ()``, for
+instances to lack a ``__dict__``.
 """
 
 from __future__ import absolute_import
@@ -33,49 +59,74 @@ import operator
 import acid
 import acid.encoders
 import acid.errors
+import acid.keylib
 
 
 class Field(object):
     """Base class for all field types.
+
+        `field_id`:
+            Positive integer uniquely identifying the field within its model,
+            used to enable the compact record encoding.
     """
+    #: Field kind passed to :py:func:`acid.keylib.pack_fields`.
+    KIND = None
+    #: If the field has a `field_id`, the argument to
+    #: :py:func:`acid.keylib.unpack_fields` that decodes only this field.
+    tags = None
+
+    def __init__(self, field_id=None):
+        if field_id is not None and field_id < 1:
+            raise ValueError('field_id must be a positive integer.')
+        self.field_id = field_id
+
     def __get__(self, instance, klass):
         if instance:
+            if instance._rec is None:
+                return instance._get_lazy(self)
             return klass.META_ENCODER.get(instance._rec, self.name)
         return self
 
     def __set__(self, instance, value):
-        instance.META_ENCODER.set(instance._rec, self.name, value)
+        instance.META_ENCODER.set(instance._materialize(), self.name, value)
+        instance._dirty.add(self.name)
 
     def __delete__(self, instance):
         try:
-            instance.META_ENCODER.delete(instance._rec, self.name)
+            instance.META_ENCODER.delete(instance._materialize(), self.name)
         except KeyError:
             raise AttributeError(self.name)
+        instance._dirty.add(self.name)
 
 
 class Bool(Field):
     """A boolean field.
     """
+    KIND = acid.keylib.FIELD_BOOL
 
 
 class Double(Field):
     """A double field.
     """
+    KIND = acid.keylib.FIELD_DOUBLE
 
 
 class Integer(Field):
     """An integer field.
     """
+    KIND = acid.keylib.FIELD_INTEGER
 
 
 class String(Field):
     """A string field.
     """
+    KIND = acid.keylib.FIELD_STRING
 
 
 class Time(Field):
     """A datetime.datetime field.
     """
+    KIND = acid.keylib.FIELD_TIME
 
 
 def _check_constraint(func, model):
@@ -87,6 +138,30 @@ def _check_constraint(func, model):
             msg='Constraint %r failed' % (func.func_name,))
 
 
+def _get_slots_rec(self):
+    """Getter for the `_rec` property of slotted models; builds a record from
+    field values that are not ``None``."""
+    rec = dict(self._extra or ())
+    for name in self.META_SLOT_NAMES:
+        value = getattr(self, name)
+        if value is not None:
+            rec[name] = value
+    return rec
+
+
+def _set_slots_rec(self, rec):
+    """Setter for the `_rec` property of slotted models; assigns each field
+    from `rec`, keeping any undeclared fields aside so they survive a save."""
+    get = rec.get
+    for name in self.META_SLOT_NAMES:
+        setattr(self, name, get(name))
+    extra = None
+    if not self.META_SLOT_SET.issuperset(rec):
+        extra = dict((k, v) for k, v in rec.iteritems()
+                     if k not in self.META_SLOT_SET)
+    self._extra = extra
+
+
 class LazyIndexProperty(object):
     """Property that replaces itself with a acid.Index when it is first
     accessed."""
@@ -101,19 +176,48 @@ class LazyIndexProperty(object):
 
 class ModelMeta(type):
     def __new__(cls, name, bases, attrs):
-        klass = type.__new__(cls, name, bases, attrs)
+        klass_attrs = cls.make_slots(bases, attrs)
+        klass = type.__new__(cls, name, bases, klass_attrs)
         cls.setup_type_vars(klass, bases, attrs)
         cls.setup_key_func(klass, bases, attrs)
         cls.setup_index_funcs(klass, bases, attrs)
         cls.setup_index_properties(klass, bases, attrs)
         cls.setup_field_properties(klass, bases, attrs)
+        cls.setup_slot_properties(klass, bases, attrs)
         cls.setup_encoder(klass, bases, attrs)
         cls.setup_triggers(klass, bases, attrs)
         cls.setup_constraints(klass, bases, attrs)
         return klass
 
+    @classmethod
+    def make_slots(cls, bases, attrs):
+        """Return the class dict to construct the class with. For slotted
+        models, fields are replaced by an equivalent ``__slots__``."""
+        inherited = any(getattr(b, 'META_SLOTS', False) for b in bases)
+        if not (inherited or attrs.get('META_SLOTS')):
+            return attrs
+        if attrs.get('META_LAZY'):
+            raise TypeError('META_SLOTS and META_LAZY cannot be combined')
+        klass_attrs = dict(attrs)
+        slots = []
+        if not inherited:
+            slots = ['_key', '_extra', '_partial']
+            for base in bases:
+                slots.extend(f.name for f in getattr(base, 'META_FIELDS', ()))
+        for key, value in attrs.iteritems():
+            if isinstance(value, Field):
+                del klass_attrs[key]
+                slots.append(key)
+        klass_attrs['__slots__'] = tuple(slots)
+        klass_attrs['META_SLOTS'] = True
+        return klass_attrs
+
     @classmethod
     def setup_type_vars(cls, klass, bases, attrs):
+        if not hasattr(klass, 'META_LAZY'):
+            klass.META_LAZY = False
+        if not hasattr(klass, 'META_SLOTS'):
+            klass.META_SLOTS = False
         if 'META_COLLECTION_NAME' not in attrs:
             klass.META_COLLECTION_NAME = klass.__name__
         if 'META_KIND_NAME' not in attrs:
@@ -183,19 +287,60 @@ class ModelMeta(type):
 
     @classmethod
     def setup_field_properties(cls, klass, bases, attrs):
+        fields = list(getattr(klass, 'META_FIELDS', []))
         for key, value in attrs.iteritems():
             if isinstance(value, Field):
                 value.name = key
+                if value.field_id is not None:
+                    value.tags = {(value.field_id << 3) | value.KIND: key}
+                fields.append(value)
+
+        ids = [f.field_id for f in fields if f.field_id is not None]
+        if ids and len(ids) != len(fields):
+            raise TypeError('%r: either all fields or none must have a '
+                            'field_id' % (klass,))
+        if len(set(ids)) != len(ids):
+            raise TypeError('%r: duplicate field_id found' % (klass,))
+        klass.META_FIELDS = fields
+
+    @classmethod
+    def setup_slot_properties(cls, klass, bases, attrs):
+        if not klass.META_SLOTS:
+            return
+        klass.META_SLOT_NAMES = tuple(f.name for f in klass.META_FIELDS)
+        klass.META_SLOT_SET = frozenset(klass.META_SLOT_NAMES)
+        klass._dirty = klass.META_SLOT_SET
+        klass._rec = property(_get_slots_rec, _set_slots_rec)
 
     @classmethod
     def setup_encoder(cls, klass, bases, attrs):
-        wrapped = acid.encoders.make_json_encoder()
+        if klass.META_FIELDS and klass.META_FIELDS[0].field_id is not None:
+            wrapped = acid.encoders.make_schema_encoder(
+                (f.field_id, f.KIND, f.name) for f in klass.META_FIELDS)
+        else:
+            wrapped = acid.encoders.make_json_encoder()
+        def unpack(key, data):
+            if klass.META_LAZY:
+                return klass(None, key, str(data))
+            return klass(wrapped.unpack(key, data), key)
+
+        def pack(model):
+            rec = model._rec
+            if rec is None:
+                return model._data
+            return wrapped.pack(rec)
+
+        def unpack_fields(key, data, names):
+            model = klass(wrapped.unpack_fields(key, data, names), key)
+            model._partial = True
+            return model
+
+        klass.META_RECORD_ENCODER = wrapped
         klass.META_ENCODER = acid.encoders.RecordEncoder(
-            name=wrapped.name,
-            unpack=(lambda key, data: klass(wrapped.unpack(key, data), key)),
-            pack=(lambda model: wrapped.pack(model._rec)),
+            name=wrapped.name, unpack=unpack, pack=pack,
             new=wrapped.new, get=wrapped.get, set=wrapped.set,
-            delete=wrapped.delete)
+            delete=wrapped.delete, unpack_fields=unpack_fields,
+            fields=wrapped.fields)
 
 
 def key(func):
@@ -244,10 +389,16 @@ def blind(func):
     return func
 
 
-def index(func):
+def index(func=None, depends=None):
     """Mark a function as an index for the model. The function will be called
     during update to produce secondary indices for each item.
 
+    `depends`:
+        If not ``None``, a list of field names the function's result depends
+        on. When an existing model is saved, the index entries are only
+        recomputed if one of these fields is dirty. Listing too few fields
+        will lead to inconsistent indices.
+
     See :py:class:`acid.Index` for more information on the function's return
     value.
 
@@ -272,8 +423,19 @@ def index(func):
         # Fetch youngest and oldest people.
         youngest = Person.by_age.find()
         oldest = Person.by_age.find(reverse=True)
+
+    Declaring dependent fields requires calling the decorator:
+
+    ::
+
+        @meta.index(depends=['age'])
+        def by_age(self):
+            return self.age
     """
+    if func is None:
+        return functools.partial(index, depends=depends)
     func.meta_index_func = True
+    func.meta_index_depends = None if depends is None else frozenset(depends)
     return func
 
 
@@ -392,6 +554,8 @@ class BaseModel(object):
     :py:class:`Model` to allow clean subclassing of the :py:class:`ModelMeta`
     metaclass.
     """
+    __slots__ = ()
+
     @classmethod
     def create_collection(cls):
         if not hasattr(cls, 'META_STORE'):
@@ -435,8 +599,7 @@ class BaseModel(object):
         """
         assert isinstance(store, acid.Store)
         cls.META_STORE = store
-        if hasattr(cls, 'META_COLLECTION'):
-            del cls.META_COLLECTION
+        cls.META_COLLECTION = None
 
     @classmethod
     def get(cls, key):
@@ -449,28 +612,94 @@ class BaseModel(object):
         """Fetch the first matching instance; see
         :py:meth:`acid.Collection.find`.
         """
-        return cls.collection().find(key, lo, hi, reverse, include)
+        return cls.collection().find(key, lo, hi, reverse=reverse,
+                                     include=include)
 
     @classmethod
     def iter(cls, key=None, lo=None, hi=None, reverse=None, max=None,
-             include=False):
+             include=False, fields=None):
         """Yield matching models in key order; see
-        :py:meth:`acid.Store.values`."""
-        return cls.collection().values(key, lo, hi, reverse, max, include)
+        :py:meth:`acid.Collection.values`. If `fields` is a sequence of field
+        names, only those fields are decoded, and other fields read as
+        ``None``. Saving such a model updates only the fields it contains,
+        leaving the remainder of the stored record intact."""
+        return cls.collection().values(key, lo, hi, reverse=reverse, max=max,
+                                       include=include, fields=fields)
 
-    def __init__(self, _rec=None, _key=None, **kwargs):
+    @classmethod
+    def aggregate(cls, field, key=None, lo=None, hi=None, include=False):
+        """Summarize the values of `field` among matching instances; see
+        :py:meth:`acid.Collection.aggregate`. The model's fields must declare
+        a `field_id`."""
+        return cls.collection().aggregate(field, key, lo, hi, include=include)
+
+    #: ``True`` if the model was produced by :py:meth:`iter` with `fields`.
+    _partial = False
+    #: For lazy models, the encoded record until it is fully decoded.
+    _data = None
+    #: For lazy models, fields decoded individually from :py:attr:`_data`.
+    _fields = None
+
+    def __init__(self, _rec=None, _key=None, _data=None, **kwargs):
         self._key = _key
-        self._rec = _rec or self.META_ENCODER.new()
+        if self.META_SLOTS:
+            self._partial = False
+        else:
+            self._dirty = set()
+        if _data is not None:
+            # Lazy: _rec is produced from _data by _materialize().
+            self._rec = None
+            self._data = _data
+            self._fields = {}
+        else:
+            self._rec = _rec or self.META_ENCODER.new()
         if kwargs:
             for name, value in kwargs.iteritems():
                 setattr(self, name, value)
 
+    def _get_lazy(self, field):
+        """Return the value of `field` for a lazy model. With the compact
+        encoding each field is decoded individually, otherwise the whole record
+        is decoded on first access."""
+        fields = self._fields
+        name = field.name
+        if name in fields:
+            return fields[name]
+        if field.tags is None:
+            return self.META_RECORD_ENCODER.get(self._materialize(), name)
+        value = acid.keylib.unpack_fields(field.tags, self._data, False)
+        value = fields[name] = value.get(name)
+        return value
+
+    def _materialize(self):
+        """Fully decode a lazy model's record if necessary, and return it."""
+        if self._rec is None:
+            self._rec = self.META_RECORD_ENCODER.unpack(self._key, self._data)
+            self._data = None
+            self._fields = None
+        return self._rec
+
     @property
     def is_saved(self):
         """``True`` if the model has been saved already.
         """
         return self._key is not None
 
+    @property
+    def dirty(self):
+        """Set of field names assigned or deleted since the model was loaded
+        or last saved. Triggers may inspect this to determine what changed.
+        For slotted models every field is always considered dirty.
+        """
+        return frozenset(self._dirty)
+
+    def _dirty_indices(self):
+        """Return names of indices that must be recomputed when overwriting
+        the stored record with this model."""
+        return [func.func_name for func in self.META_INDEX_FUNCS
+                if getattr(func, 'meta_index_depends', None) is None
+                or not self._dirty.isdisjoint(func.meta_index_depends)]
+
     def delete(self):
         """Delete the model if it has been saved."""
         if not self._key:
@@ -481,10 +710,14 @@ class BaseModel(object):
         for func in self.META_AFTER_DELETE:
             func(self)
 
-    def save(self):
-        """Create or update the model in the database.
+    def save(self, force=False):
+        """Create or update the model in the database. If the model was saved
+        previously and no fields are dirty, nothing is written and no triggers
+        run, unless `force` is ``True``.
         """
         key = self._key
+        if key and not (force or self._dirty):
+            return
         if key:
             on_funcs = self.META_ON_UPDATE
             after_funcs = self.META_AFTER_UPDATE
@@ -492,11 +725,25 @@ class BaseModel(object):
             on_funcs = self.META_ON_CREATE
             after_funcs = self.META_AFTER_CREATE
 
+        if self._partial:
+            stored = self.collection().get(key)
+            if stored:
+                rec = stored._materialize()
+                rec.update(self._rec)
+                self._rec = rec
+            self._partial = False
+
         for func in on_funcs:
             func(self)
-        self._key = self.collection().put(self, key=key)
+        dirty = frozenset(self._dirty)
+        indices = None
+        if key and not force:
+            indices = self._dirty_indices()
+        self._key = self.collection().put(self, key=key, indices=indices)
         for func in after_funcs:
             func(self)
+        if not self.META_SLOTS:
+            self._dirty.difference_update(dirty)
 
     def __repr__(self):
         klass = self.__class__
@@ -510,3 +757,4 @@ class Model(BaseModel):
     """Inherit from this class to add fields to the basic model.
     """
     __metaclass__ = ModelMeta
+    __slots__ = ()
@@ -6,6 +6,7 @@ import os
 import random
 import shutil
 import time
+import zlib
 
 import acid
 import acid.encoders
@@ -34,19 +35,6 @@ def dotestiter():
         cnt += 1
     return recs / (time.time() - t0), cnt / (time.time() - t0)
 
-try:
-    import lz4
-    LZ4 = acid.Encoder('lz4', lz4.loads, lz4.dumps)
-except ImportError:
-    LZ4 = None
-
-try:
-    import snappy
-    SNAPPY = acid.Encoder('snappy', snappy.uncompress, snappy.compress)
-except ImportError:
-    SNAPPY = None
-
-
 print '"Packer","Size","Count","Ratio","BatchSz","Gets/sec","Iters/sec","Iterrecs/sec"'
 
 def out(*args):
@@ -59,7 +47,9 @@ def engine_size(engine):
     return sum(len(k) + len(v) for k, v in engine.iter('', False))
 
 
-for packer in acid.encoders.ZLIB, SNAPPY, LZ4:
+# Optional compressors are None when their module is missing.
+for packer in (acid.encoders.ZLIB, acid.encoders.SNAPPY, acid.encoders.LZ4,
+               acid.encoders.ZSTD):
     if not packer:
         continue
 
@@ -89,3 +79,31 @@ for packer in acid.encoders.ZLIB, SNAPPY, LZ4:
         iterrecs, te = dotestiter()
         out(packer.name, after / 1024., itemcount, float(before) / after,
             bsize, dotestget(), te, iterrecs)
+
+
+# Batching under max_bytes: a packer without compressobj is recompressed after
+# every appended member, while ZLIB compresses each member once. Both produce
+# identical batches.
+RECOMPRESS = acid.encoders.Compressor('zlib-recompress', zlib.decompress,
+                                      zlib.compress)
+
+print
+print '"Packer","MaxBytes","Recs/sec","Ratio"'
+
+def outbytes(*args):
+    print '"%s","%d","%.2f","%.2f"' % args
+
+for max_bytes in 1024, 4096, 16384, 65536:
+    for packer in RECOMPRESS, acid.encoders.ZLIB:
+        st = acid.open('ListEngine')
+        with st.begin(write=True):
+            co = st.add_collection('people',
+                encoder=acid.encoders.make_json_encoder(sort_keys=True))
+            for rec in recs:
+                co.put(rec)
+            before = engine_size(st.engine)
+            t0 = time.time()
+            co.batch(max_bytes=max_bytes, packer=packer)
+            t1 = time.time()
+        outbytes(packer.name, max_bytes, len(recs) / (t1 - t0),
+                 float(before) / engine_size(st.engine))
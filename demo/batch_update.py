@@ -0,0 +1,58 @@
+
+"""
+Measure the cost of updating and deleting records that live in a compressed
+batch, for a range of batch sizes. Each update splits the containing batch, so
+cost grows with the batch size.
+"""
+
+import gzip
+import json
+import os
+import random
+import time
+
+import acid
+import acid.encoders
+
+INPUT_PATH = os.path.join(os.path.dirname(__file__), 'laforge.json.gz')
+recs = json.load(gzip.open(INPUT_PATH))[:1000]
+
+
+def make_store(batch_size):
+    store = acid.open('ListEngine')
+    with store.begin(write=True):
+        coll = store.add_collection('recs')
+        for i, rec in enumerate(recs):
+            coll.put(rec, key=i)
+        if batch_size > 1:
+            coll.batch(max_recs=batch_size, packer=acid.encoders.ZLIB)
+    return store, coll
+
+
+def dotest(name, batch_size, func):
+    store, coll = make_store(batch_size)
+    keys = range(len(recs))
+    random.shuffle(keys)
+    t0 = time.time()
+    with store.begin(write=True):
+        for key in keys[:200]:
+            func(coll, key)
+    out(name, batch_size, 200 / (time.time() - t0))
+
+
+def update(coll, key):
+    coll.put(recs[key], key=key)
+
+
+def delete(coll, key):
+    coll.delete(key)
+
+
+def out(*args):
+    print '"%s","%d","%.2f"' % args
+
+
+print '"Test","BatchSz","Ops/sec"'
+for batch_size in 1, 2, 4, 8, 16, 32, 64, 128:
+    dotest('update', batch_size, update)
+    dotest('delete', batch_size, delete)
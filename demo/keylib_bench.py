@@ -0,0 +1,55 @@
+
+"""
+Microbenchmark for the key codec. Run under PyPy, or with ACID_NO_SPEEDUPS=1
+set, to measure the pure-Python implementation in acid/keylib.py.
+"""
+
+import os
+import platform
+import random
+import time
+import uuid
+
+from datetime import datetime
+
+from acid import keylib
+
+
+def dotest(name, func, prefix, keys):
+    t0 = time.time()
+    cnt = 0
+    while (time.time() - t0) < 2:
+        for x in xrange(100):
+            func(prefix, keys)
+        cnt += 100 * len(keys)
+    out(name, cnt / (time.time() - t0))
+
+
+def out(*args):
+    print '"%s","%.2f"' % args
+
+
+SMALL_INTS = [random.randint(0, 240) for x in xrange(100)]
+BIG_INTS = [random.randint(-1 << 62, 1 << 62) for x in xrange(100)]
+SHORT_STRS = [os.urandom(random.randint(1, 16)) for x in xrange(100)]
+LONG_STRS = [os.urandom(random.randint(100, 400)) for x in xrange(100)]
+MIXED = [(s, i, u'x', None, True, uuid.uuid4(), datetime.utcnow())
+         for s, i in zip(SHORT_STRS, BIG_INTS)]
+
+TESTS = [
+    ('small_ints', SMALL_INTS),
+    ('big_ints', BIG_INTS),
+    ('short_strs', SHORT_STRS),
+    ('long_strs', LONG_STRS),
+    ('mixed', MIXED),
+]
+
+print '"%s %s, speedups=%s"' % (platform.python_implementation(),
+                                platform.python_version(),
+                                keylib.packs.__module__ != 'acid.keylib')
+print '"Test","Keys/sec"'
+
+for name, keys in TESTS:
+    packed = keylib.packs_many('', keys)
+    dotest(name + '_packs', keylib.packs_many, '', keys)
+    dotest(name + '_unpacks', keylib.unpacks_many, '', packed)
@@ -0,0 +1,74 @@
+
+"""
+Measure read throughput of a single LMDB-backed store shared by a varying
+number of threads. Each thread repeatedly starts a read-only transaction and
+performs a handful of random gets within it. LMDB readers never block each
+other, so throughput should grow with the number of cores, less whatever the
+GIL costs.
+"""
+
+import gzip
+import itertools
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import acid
+import acid.encoders
+
+INPUT_PATH = os.path.join(os.path.dirname(__file__), 'laforge.json.gz')
+GETS_PER_TXN = 10
+DURATION = 2.0
+
+recs = json.load(gzip.open(INPUT_PATH))
+
+
+def reader(store, coll, keys, counts):
+    nextkey = itertools.cycle(random.sample(keys, len(keys))).next
+    t0 = time.time()
+    cnt = 0
+    while (time.time() - t0) < DURATION:
+        with store.begin():
+            for x in xrange(GETS_PER_TXN):
+                coll.get(nextkey(), raw=True)
+        cnt += GETS_PER_TXN
+    counts.append(cnt / (time.time() - t0))
+
+
+def dotest(store, coll, keys, nthreads):
+    counts = []
+    threads = [threading.Thread(target=reader,
+                                args=(store, coll, keys, counts))
+               for i in xrange(nthreads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts)
+
+
+def out(*args):
+    print '"%d","%s","%.2f","%.2f"' % args
+
+
+path = tempfile.mkdtemp(prefix='acid-threaded-')
+try:
+    store = acid.open('LmdbEngine', path=path, map_size=1048576*1024)
+    with store.begin(write=True):
+        coll = store.add_collection('people',
+            encoder=acid.encoders.make_json_encoder(sort_keys=True))
+        keys = [coll.put(rec) for rec in recs]
+
+    txn = store.engine.begin()
+    reuse = 'yes' if txn.renew else 'no'
+    txn.abort()
+    print '"Threads","TxnReuse","Gets/sec","Gets/sec/thread"'
+    for nthreads in 1, 2, 4, 8:
+        rate = dotest(store, coll, keys, nthreads)
+        out(nthreads, reuse, rate, rate / nthreads)
+finally:
+    shutil.rmtree(path)
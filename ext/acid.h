@@ -48,6 +48,8 @@ enum ElementKind
     KIND_NULL = 15,
     KIND_NEG_INTEGER = 20,
     KIND_INTEGER = 21,
+    KIND_FLOAT = 25,
+    KIND_DECIMAL = 26,
     KIND_BOOL = 30,
     KIND_BLOB = 40,
     KIND_TEXT = 50,
@@ -62,6 +64,10 @@ struct reader
 {
     uint8_t *p;
     uint8_t *e;
+    // If not NULL, called with the repr() of each decoded float.
+    PyObject *number_factory;
+    // If nonzero, decode datetimes as naive UTC.
+    int naive;
 };
 
 
@@ -82,7 +88,9 @@ enum KeyFlags {
     KEY_PRIVATE = 4
 };
 
-typedef struct {
+struct Notifier;
+
+typedef struct Key {
     PyObject_VAR_HEAD
     long hash;
     // Size is tracked in Py_SIZE(Key).
@@ -91,8 +99,21 @@ typedef struct {
     PyObject *source;
     // In all cases, points to data.
     uint8_t *p;
+    // If KEY_SHARED and the source buffer may expire, borrowed reference to
+    // the notifier whose list we're linked into, otherwise NULL.
+    struct Notifier *notifier;
+    // Previous and next keys in the notifier's list.
+    struct Key *prev;
+    struct Key *next;
 } Key;
 
+typedef struct Notifier {
+    PyObject_HEAD
+    // Head of the list of KEY_SHARED keys borrowing from buffers that become
+    // invalid when expire() is called.
+    Key *head;
+} Notifier;
+
 typedef struct {
     PyObject_HEAD
     // Key we're iterating over.
@@ -111,12 +132,15 @@ void writer_abort(struct writer *wtr);
 int write_element(struct writer *wtr, PyObject *arg);
 PyObject *read_element(struct reader *rdr);
 int skip_element(struct reader *rdr, int *eof);
+int read_plain_int(struct reader *rdr, uint64_t *u64, uint8_t xor);
 
 
 PyTypeObject *init_fixed_offset_type(void);
 PyObject *get_fixed_offset(int offset_secs);
 
 PyTypeObject *init_key_type(void);
+PyTypeObject *init_notifier_type(void);
+PyTypeObject *init_keylist_type(void);
 
 
 #endif /* !ACID_H */
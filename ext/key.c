@@ -23,6 +23,20 @@
 
 static PyTypeObject KeyType;
 static PyTypeObject KeyIterType;
+static PyTypeObject NotifierType;
+static PyTypeObject KeyListType;
+
+
+typedef struct {
+    PyObject_HEAD
+    // String containing the encoded tuples.
+    PyObject *source;
+    // Number of tuples.
+    Py_ssize_t size;
+    // size+1 offsets into source; tuple i occupies
+    // source[offsets[i]:offsets[i+1]-1].
+    Py_ssize_t *offsets;
+} KeyList;
 
 
 /**
@@ -36,6 +50,7 @@ make_private_key(uint8_t *p, Py_ssize_t size)
         self->hash = -1;
         self->flags = KEY_PRIVATE;
         self->p = (uint8_t *) &self[1];
+        self->notifier = NULL;
         if(p) {
             memcpy(self->p, p, size);
         }
@@ -43,6 +58,77 @@ make_private_key(uint8_t *p, Py_ssize_t size)
     return self;
 }
 
+/**
+ * Construct a new Key instance borrowing `p[0..size]` from `source`, and
+ * return it. If `notifier` is not NULL, link the key into its list so that the
+ * data is copied before `source` expires.
+ */
+static Key *
+make_shared_key(PyObject *source, uint8_t *p, Py_ssize_t size,
+                Notifier *notifier)
+{
+    Key *self = PyObject_NewVar(Key, &KeyType, 0);
+    if(self) {
+        Py_SIZE(self) = size;
+        self->hash = -1;
+        self->flags = KEY_SHARED;
+        self->p = p;
+        self->source = source;
+        Py_INCREF(source);
+        self->notifier = notifier;
+        if(notifier) {
+            self->prev = NULL;
+            self->next = notifier->head;
+            if(notifier->head) {
+                notifier->head->prev = self;
+            }
+            notifier->head = self;
+        }
+    }
+    return self;
+}
+
+/**
+ * Remove a KEY_SHARED key from its notifier's list, if any.
+ */
+static void
+key_unlink(Key *self)
+{
+    Notifier *notifier = self->notifier;
+    if(notifier) {
+        if(self->prev) {
+            self->prev->next = self->next;
+        } else {
+            notifier->head = self->next;
+        }
+        if(self->next) {
+            self->next->prev = self->prev;
+        }
+        self->notifier = NULL;
+    }
+}
+
+/**
+ * Convert a KEY_SHARED key to KEY_COPIED by copying its data to a new heap
+ * allocation, and releasing the reference to its source. Return 0 on success,
+ * or set an exception and return -1 on failure.
+ */
+static int
+key_copy(Key *self)
+{
+    uint8_t *p = malloc(Py_SIZE(self) ? Py_SIZE(self) : 1);
+    if(! p) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    memcpy(p, self->p, Py_SIZE(self));
+    key_unlink(self);
+    self->p = p;
+    self->flags = KEY_COPIED;
+    Py_CLEAR(self->source);
+    return 0;
+}
+
 /**
  * Construct a Key from a sequence.
  */
@@ -88,8 +174,8 @@ key_dealloc(Key *self)
 {
     switch(self->flags) {
     case KEY_SHARED:
+        key_unlink(self);
         Py_DECREF(self->source);
-        // TODO: unlink from notifier list.
         break;
     case KEY_COPIED:
         free(self->p);
@@ -166,24 +252,46 @@ key_from_hex(PyTypeObject *cls, PyObject *args, PyObject *kwds)
 }
 
 /**
- * Given a raw bytestring and prefix, return a new Key instance.
+ * Given a raw bytestring and prefix, return a new Key instance. If `raw` is a
+ * string, the key borrows its data without copying. If `raw` is another
+ * buffer object and a Notifier is given, the key borrows its data until the
+ * notifier expires, otherwise the data is copied.
  */
 static PyObject *
 key_from_raw(PyTypeObject *cls, PyObject *args, PyObject *kwds)
 {
+    static char *keywords[] = {"prefix", "raw", "notifier", NULL};
     char *prefix;
-    char *raw;
     Py_ssize_t prefix_len;
+    PyObject *source;
+    PyObject *notifier = Py_None;
+    uint8_t *raw;
     Py_ssize_t raw_len;
 
-    if(! PyArg_ParseTuple(args, "s#s#", &prefix, &prefix_len, &raw, &raw_len)) {
+    if(! PyArg_ParseTupleAndKeywords(args, kwds, "s#O|O", keywords,
+            &prefix, &prefix_len, &source, &notifier)) {
+        return NULL;
+    }
+    if(PyObject_AsReadBuffer(source, (const void **) &raw, &raw_len)) {
         return NULL;
     }
     if(raw_len < prefix_len || memcmp(prefix, raw, prefix_len)) {
         Py_RETURN_NONE;
     }
-    return (PyObject *) make_private_key((void *) raw + prefix_len,
-                                         raw_len - prefix_len);
+
+    raw += prefix_len;
+    raw_len -= prefix_len;
+    if(PyString_CheckExact(source)) {
+        return (PyObject *) make_shared_key(source, raw, raw_len, NULL);
+    } else if(Py_TYPE(notifier) == &NotifierType) {
+        return (PyObject *) make_shared_key(source, raw, raw_len,
+                                            (Notifier *) notifier);
+    } else if(notifier != Py_None) {
+        PyErr_SetString(PyExc_TypeError,
+                        "notifier must be a Notifier instance or None.");
+        return NULL;
+    }
+    return (PyObject *) make_private_key(raw, raw_len);
 }
 
 /**
@@ -225,22 +333,20 @@ key_iter(Key *self)
 }
 
 /**
- * Return a hash of the key's content.
+ * Return a hash of the key's content. Since Keys compare equal to tuples with
+ * the same encoding, this is the hash of the equivalent tuple.
  */
 static long
 key_hash(Key *self)
 {
     long h = self->hash;
     if(h == -1) {
-        uint8_t *p = self->p;
-        uint8_t *e = self->p + Py_SIZE(self);
-        h = 0;
-        while(p < e) {
-            h = (1000003 * h) ^ *p++;
-        }
-        if(h == -1) {
-            h--;
+        PyObject *tup = PySequence_Tuple((PyObject *) self);
+        if(! tup) {
+            return -1;
         }
+        h = PyObject_Hash(tup);
+        Py_DECREF(tup);
         self->hash = h;
     }
     return h;
@@ -333,6 +439,55 @@ key_richcompare(Key *self, PyObject *other, int op)
     Py_RETURN_FALSE;
 }
 
+/**
+ * Return True if the elements of the Key or tuple `other` form a prefix of
+ * this Key's elements, comparing only their encoded forms.
+ */
+static PyObject *
+key_startswith(Key *self, PyObject *other)
+{
+    struct writer wtr;
+    uint8_t *p;
+    Py_ssize_t size;
+
+    if(Py_TYPE(other) == &KeyType) {
+        p = ((Key *) other)->p;
+        size = Py_SIZE(other);
+        wtr.s = NULL;
+    } else {
+        // As with Key(), a non-tuple is treated as a 1-tuple.
+        if(! writer_init(&wtr, 32)) {
+            return NULL;
+        }
+        if(PyTuple_CheckExact(other)) {
+            for(Py_ssize_t i = 0; i < PyTuple_GET_SIZE(other); i++) {
+                if(! write_element(&wtr, PyTuple_GET_ITEM(other, i))) {
+                    writer_abort(&wtr);
+                    return NULL;
+                }
+            }
+        } else if(! write_element(&wtr, other)) {
+            writer_abort(&wtr);
+            return NULL;
+        }
+        p = writer_ptr(&wtr) - wtr.pos;
+        size = wtr.pos;
+    }
+
+    // The next byte must begin a new element. String encodings have the high
+    // bit set, while kind bytes do not.
+    int ok = (Py_SIZE(self) >= size) &&
+             !memcmp(self->p, p, size) &&
+             ((Py_SIZE(self) == size) || (self->p[size] < 0x80));
+    if(wtr.s) {
+        writer_abort(&wtr);
+    }
+    if(ok) {
+        Py_RETURN_TRUE;
+    }
+    Py_RETURN_FALSE;
+}
+
 /**
  * Return the length of the tuple pointed to by `rdr`.
  */
@@ -400,12 +555,9 @@ key_item(Key *self, Py_ssize_t i)
     struct reader rdr = {self->p, self->p + Py_SIZE(self)};
     int eof = rdr.p == rdr.e;
 
-    if(i < 0) {
-        // TODO: can this be made more efficient?
-        Py_ssize_t len = key_length(self);
-        i = len - i;
-        eof |= i < 0;
-    }
+    // PySequence_GetItem() already added key_length() to negative indices,
+    // so any remaining negative index is out of range.
+    eof |= i < 0;
     while(i-- && !eof) {
         if(skip_element(&rdr, &eof)) {
             return NULL;
@@ -427,9 +579,11 @@ static PySequenceMethods key_seq_methods = {
 
 static PyMethodDef key_methods[] = {
     {"from_hex",    (PyCFunction)key_from_hex, METH_VARARGS|METH_CLASS, ""},
-    {"from_raw",    (PyCFunction)key_from_raw, METH_VARARGS|METH_CLASS, ""},
+    {"from_raw",    (PyCFunction)key_from_raw,
+        METH_VARARGS|METH_KEYWORDS|METH_CLASS, ""},
     {"to_raw",      (PyCFunction)key_to_raw,   METH_VARARGS,            ""},
     {"to_hex",      (PyCFunction)key_to_hex,   METH_VARARGS|METH_KEYWORDS, ""},
+    {"startswith",  (PyCFunction)key_startswith, METH_O,                ""},
     {0,             0,                         0,                       0}
 };
 
@@ -451,6 +605,26 @@ static PyTypeObject KeyType = {
 };
 
 
+PyTypeObject *
+init_notifier_type(void)
+{
+    if(PyType_Ready(&NotifierType)) {
+        return NULL;
+    }
+    return &NotifierType;
+}
+
+
+PyTypeObject *
+init_keylist_type(void)
+{
+    if(PyType_Ready(&KeyListType)) {
+        return NULL;
+    }
+    return &KeyListType;
+}
+
+
 PyTypeObject *
 init_key_type(void)
 {
@@ -526,3 +700,316 @@ static PyTypeObject KeyIterType = {
     .tp_doc = "acid._keylib.KeyIterator",
     .tp_methods = keyiter_methods
 };
+
+
+// -------------
+// Notifier Type
+// -------------
+
+
+/**
+ * Construct a new, empty Notifier.
+ */
+static PyObject *
+notifier_new(PyTypeObject *cls, PyObject *args, PyObject *kwds)
+{
+    Notifier *self = PyObject_New(Notifier, &NotifierType);
+    if(self) {
+        self->head = NULL;
+    }
+    return (PyObject *) self;
+}
+
+/**
+ * Copy every key linked to the notifier into a private heap allocation, so
+ * that their source buffers may safely be invalidated. Return None on success,
+ * or set an exception and return NULL on failure.
+ */
+static PyObject *
+notifier_expire(Notifier *self)
+{
+    while(self->head) {
+        if(key_copy(self->head)) {
+            return NULL;
+        }
+    }
+    Py_RETURN_NONE;
+}
+
+/**
+ * Expire any remaining keys, then destroy the instance.
+ */
+static void
+notifier_dealloc(Notifier *self)
+{
+    if(! notifier_expire(self)) {
+        PyErr_WriteUnraisable((PyObject *) self);
+        // Leave the remaining keys pointing at their (still referenced)
+        // source, but sever their link to this notifier.
+        while(self->head) {
+            key_unlink(self->head);
+        }
+    } else {
+        Py_DECREF(Py_None);
+    }
+    PyObject_Del(self);
+}
+
+
+static PyMethodDef notifier_methods[] = {
+    {"expire", (PyCFunction)notifier_expire, METH_NOARGS, ""},
+    {0, 0, 0, 0}
+};
+
+static PyTypeObject NotifierType = {
+    PyObject_HEAD_INIT(NULL)
+    .tp_name = "acid._keylib.Notifier",
+    .tp_basicsize = sizeof(Notifier),
+    .tp_new = notifier_new,
+    .tp_dealloc = (destructor) notifier_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "acid._keylib.Notifier",
+    .tp_methods = notifier_methods
+};
+
+
+// ------------
+// KeyList Type
+// ------------
+
+
+/**
+ * Construct a KeyList from the physical key `raw`, which may be a string or
+ * any object supporting the buffer interface, skipping the string `prefix`.
+ * Return None if `raw` does not start with `prefix`. Strings are shared, while
+ * other buffers are copied once into a new string.
+ */
+static PyObject *
+keylist_from_raw(PyTypeObject *cls, PyObject *args, PyObject *kwds)
+{
+    static char *keywords[] = {"prefix", "raw", NULL};
+    char *prefix;
+    Py_ssize_t prefix_len;
+    PyObject *source;
+    uint8_t *raw;
+    Py_ssize_t raw_len;
+
+    if(! PyArg_ParseTupleAndKeywords(args, kwds, "s#O", keywords,
+            &prefix, &prefix_len, &source)) {
+        return NULL;
+    }
+    if(PyObject_AsReadBuffer(source, (const void **) &raw, &raw_len)) {
+        return NULL;
+    }
+    if(raw_len < prefix_len || memcmp(prefix, raw, prefix_len)) {
+        Py_RETURN_NONE;
+    }
+
+    if(PyString_CheckExact(source)) {
+        Py_INCREF(source);
+    } else {
+        source = PyString_FromStringAndSize((char *) raw, raw_len);
+        if(! source) {
+            return NULL;
+        }
+        raw = (uint8_t *) PyString_AS_STRING(source);
+    }
+
+    KeyList *self = PyObject_New(KeyList, &KeyListType);
+    if(! self) {
+        Py_DECREF(source);
+        return NULL;
+    }
+    self->source = source;
+    self->size = 0;
+
+    Py_ssize_t alloc = 8;
+    if(! (self->offsets = PyMem_New(Py_ssize_t, alloc))) {
+        Py_DECREF(self);
+        return PyErr_NoMemory();
+    }
+    self->offsets[0] = prefix_len;
+
+    struct reader rdr = {raw + prefix_len, raw + raw_len};
+    for(;;) {
+        int eof = rdr.p == rdr.e;
+        if(! eof && *rdr.p != KIND_SEP) {
+            if(skip_element(&rdr, &eof)) {
+                Py_DECREF(self);
+                return NULL;
+            }
+            continue;
+        }
+
+        if((self->size + 2) > alloc) {
+            Py_ssize_t *offsets = self->offsets;
+            alloc *= 2;
+            if(! PyMem_Resize(offsets, Py_ssize_t, alloc)) {
+                Py_DECREF(self);
+                return PyErr_NoMemory();
+            }
+            self->offsets = offsets;
+        }
+        // Final offset is one past the end, as if a separator were present.
+        self->offsets[++self->size] = (++rdr.p) - raw;
+        if(eof) {
+            break;
+        }
+    }
+    return (PyObject *) self;
+}
+
+/**
+ * Read the shared prefix length and suffix length of the next front coded key
+ * from `rdr` into `*shared` and `*n`, checking them against the length of the
+ * previous key `prev_len` and the remaining input. Return 1 on success, or
+ * set an exception and return 0 on failure.
+ */
+static int
+read_front_key(struct reader *rdr, Py_ssize_t prev_len, uint64_t *shared,
+               uint64_t *n)
+{
+    if(! (read_plain_int(rdr, shared, 0) && read_plain_int(rdr, n, 0))) {
+        if(! PyErr_Occurred()) {
+            PyErr_SetString(PyExc_ValueError, "short front coded key read.");
+        }
+        return 0;
+    }
+    if(*shared > (uint64_t) prev_len || *n > (uint64_t) (rdr->e - rdr->p)) {
+        PyErr_SetString(PyExc_ValueError, "front coded keys corrupt.");
+        return 0;
+    }
+    return 1;
+}
+
+/**
+ * Construct a KeyList from the string or buffer `s` produced by
+ * keylib.encode_keys(). The keys are rebuilt into a single new string,
+ * separated as if by packs(), from which each Key is later borrowed.
+ */
+static PyObject *
+keylist_from_front(PyTypeObject *cls, PyObject *args)
+{
+    PyObject *source;
+    uint8_t *s;
+    Py_ssize_t s_len;
+    uint64_t shared;
+    uint64_t n;
+
+    if(! PyArg_ParseTuple(args, "O", &source)) {
+        return NULL;
+    }
+    if(PyObject_AsReadBuffer(source, (const void **) &s, &s_len)) {
+        return NULL;
+    }
+
+    // First pass: validate input and measure output.
+    struct reader rdr = {s, s + s_len};
+    Py_ssize_t count = 0;
+    Py_ssize_t size = 0;
+    Py_ssize_t prev_len = 0;
+    while(rdr.p < rdr.e) {
+        if(! read_front_key(&rdr, prev_len, &shared, &n)) {
+            return NULL;
+        }
+        rdr.p += n;
+        prev_len = (Py_ssize_t) (shared + n);
+        size += prev_len + 1;
+        count++;
+    }
+
+    KeyList *self = PyObject_New(KeyList, &KeyListType);
+    if(! self) {
+        return NULL;
+    }
+    self->size = count;
+    self->offsets = PyMem_New(Py_ssize_t, count + 1);
+    self->source = PyString_FromStringAndSize(NULL, size ? size - 1 : 0);
+    if(! (self->offsets && self->source)) {
+        Py_DECREF(self);
+        return PyErr_NoMemory();
+    }
+
+    uint8_t *out = (uint8_t *) PyString_AS_STRING(self->source);
+    uint8_t *prev = out;
+    Py_ssize_t pos = 0;
+    self->offsets[0] = 0;
+    rdr.p = s;
+    for(Py_ssize_t i = 0; i < count; i++) {
+        // Already validated by the first pass.
+        read_plain_int(&rdr, &shared, 0);
+        read_plain_int(&rdr, &n, 0);
+        memcpy(out + pos, prev, shared);
+        memcpy(out + pos + shared, rdr.p, n);
+        rdr.p += n;
+        prev = out + pos;
+        pos += shared + n;
+        if(i < (count - 1)) {
+            out[pos] = KIND_SEP;
+        }
+        self->offsets[i + 1] = ++pos;
+    }
+    return (PyObject *) self;
+}
+
+/**
+ * Return the number of tuples in the list.
+ */
+static Py_ssize_t
+keylist_length(KeyList *self)
+{
+    return self->size;
+}
+
+/**
+ * Return a Key borrowing the `i`th tuple from the list's source string.
+ */
+static PyObject *
+keylist_item(KeyList *self, Py_ssize_t i)
+{
+    if(i < 0 || i >= self->size) {
+        PyErr_SetString(PyExc_IndexError, "KeyList index out of range");
+        return NULL;
+    }
+    Py_ssize_t start = self->offsets[i];
+    uint8_t *p = (uint8_t *) PyString_AS_STRING(self->source);
+    return (PyObject *) make_shared_key(self->source, p + start,
+                                        self->offsets[i + 1] - 1 - start,
+                                        NULL);
+}
+
+/**
+ * Release the source string and offsets array, then destroy the instance.
+ */
+static void
+keylist_dealloc(KeyList *self)
+{
+    Py_XDECREF(self->source);
+    PyMem_Free(self->offsets);
+    PyObject_Del(self);
+}
+
+
+static PySequenceMethods keylist_seq_methods = {
+    .sq_length = (lenfunc) keylist_length,
+    .sq_item = (ssizeargfunc) keylist_item
+};
+
+static PyMethodDef keylist_methods[] = {
+    {"from_raw",    (PyCFunction)keylist_from_raw,
+        METH_VARARGS|METH_KEYWORDS|METH_CLASS, ""},
+    {"from_front",  (PyCFunction)keylist_from_front,
+        METH_VARARGS|METH_CLASS, ""},
+    {0,             0,                         0,                       0}
+};
+
+static PyTypeObject KeyListType = {
+    PyObject_HEAD_INIT(NULL)
+    .tp_name = "acid._keylib.KeyList",
+    .tp_basicsize = sizeof(KeyList),
+    .tp_dealloc = (destructor) keylist_dealloc,
+    .tp_as_sequence = &keylist_seq_methods,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "acid._keylib.KeyList",
+    .tp_methods = keylist_methods
+};
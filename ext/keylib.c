@@ -14,7 +14,6 @@
  * under the License.
  */
 
-#define _BSD_SOURCE // timegm()
 #define _POSIX_C_SOURCE 200809L
 
 #include "acid.h"
@@ -33,6 +32,8 @@
 static PyTypeObject *KeyType;
 // Reference to uuid.UUID().
 static PyTypeObject *UUID_Type;
+// Reference to decimal.Decimal().
+static PyTypeObject *Decimal_Type;
 // Reference to uuid.UUID.get_bytes().
 static PyObject *uuid_get_bytes;
 // Reference to datetime.datetime.utcoffset().
@@ -300,59 +301,87 @@ static int write_str(struct writer *wtr, uint8_t *restrict p, Py_ssize_t length,
     return 1;
 }
 
+/**
+ * Return the number of days between 1970-01-01 and the proleptic Gregorian
+ * date `y`-`m`-`d`, using only integer arithmetic. From
+ * http://howardhinnant.github.io/date_algorithms.html
+ */
+static int64_t days_from_civil(int64_t y, unsigned m, unsigned d)
+{
+    y -= m <= 2;
+    int64_t era = ((y >= 0) ? y : (y - 399)) / 400;
+    unsigned yoe = (unsigned) (y - (era * 400));
+    unsigned doy = ((153 * (m + ((m > 2) ? -3 : 9))) + 2) / 5 + d - 1;
+    unsigned doe = (yoe * 365) + (yoe / 4) - (yoe / 100) + doy;
+    return (era * 146097) + (int64_t) doe - 719468;
+}
+
+/**
+ * Inverse of days_from_civil(): convert `z` days since 1970-01-01 into a
+ * proleptic Gregorian date, written to `*y`, `*m` and `*d`.
+ */
+static void civil_from_days(int64_t z, int *y, int *m, int *d)
+{
+    z += 719468;
+    int64_t era = ((z >= 0) ? z : (z - 146096)) / 146097;
+    unsigned doe = (unsigned) (z - (era * 146097));
+    unsigned yoe = (doe - (doe / 1460) + (doe / 36524) - (doe / 146096)) / 365;
+    unsigned doy = doe - ((365 * yoe) + (yoe / 4) - (yoe / 100));
+    unsigned mp = ((5 * doy) + 2) / 153;
+    *d = (int) (doy - (((153 * mp) + 2) / 5) + 1);
+    *m = (int) ((mp < 10) ? (mp + 3) : (mp - 9));
+    *y = (int) ((int64_t) yoe + (era * 400) + (*m <= 2));
+}
+
 /**
  * Given a datetime.datetime instance `dt`, try to figure out its UTC offset in
- * seconds. If the datetime is timezone-naive, then assume it is in the
- * system's timezone. Return 0 on success, or set an exception and return -1 on
- * failure.
+ * seconds. If the datetime is timezone-naive, then assume it is in UTC. Store
+ * the offset in `*offset` and return 1 on success, or set an exception and
+ * return 0 on failure.
  */
-static int get_utcoffset_secs(PyObject *dt, int64_t ts)
+static int get_utcoffset_secs(PyObject *dt, int *offset)
 {
+    if(! ((PyDateTime_DateTime *) dt)->hastzinfo) {
+        *offset = 0;
+        return 1;
+    }
+
     PyObject *td = PyObject_CallFunctionObjArgs(datetime_utcoffset, dt, NULL);
     if(! td) {
-        return -1;
+        return 0;
     } else if(td == Py_None) {
+        *offset = 0;
+    } else if(! PyDelta_Check(td)) {
+        PyErr_SetString(PyExc_TypeError, "utcoffset() must return timedelta");
         Py_DECREF(td);
-        time_t now = (time_t) ts;
-        struct tm tm;
-        localtime_r(&now, &tm);
-        time_t local = mktime(&tm);
-        time_t utc = timegm(&tm);
-        return (int) (utc - local);
-    } else if(! PyDelta_CheckExact(td)) {
-        return -1;
+        return 0;
     } else {
         PyDateTime_Delta *delta = (void *)td;
-        int offset = delta->days * (60 * 60 * 24);
-        offset += delta->seconds;
-        Py_DECREF(td);
-        return offset;
+        *offset = (delta->days * (60 * 60 * 24)) + delta->seconds;
     }
+    Py_DECREF(td);
+    return 1;
 }
 
 /**
- * Encode the datetime.datetime instance `dt` into `wtr`. Return 0 on success
- * or set an exception and return -1 on failure.
+ * Encode the datetime.datetime instance `dt` into `wtr`. Return 1 on success
+ * or set an exception and return 0 on failure.
  */
 static int write_time(struct writer *wtr, PyObject *dt)
 {
-    struct tm tm = {
-        .tm_sec = PyDateTime_DATE_GET_SECOND(dt),
-        .tm_min = PyDateTime_DATE_GET_MINUTE(dt),
-        .tm_hour = PyDateTime_DATE_GET_HOUR(dt),
-        .tm_mday = PyDateTime_GET_DAY(dt),
-        .tm_mon = PyDateTime_GET_MONTH(dt) - 1,
-        .tm_year = PyDateTime_GET_YEAR(dt) - 1900
-    };
-
-    int64_t ts = (int64_t) timegm(&tm);
-
-    int offset_secs = get_utcoffset_secs(dt, ts);
-    if(offset_secs == -1) {
-        return -1;
+    int offset_secs;
+    if(! get_utcoffset_secs(dt, &offset_secs)) {
+        return 0;
     }
 
+    int64_t ts = days_from_civil(PyDateTime_GET_YEAR(dt),
+                                 PyDateTime_GET_MONTH(dt),
+                                 PyDateTime_GET_DAY(dt)) * 86400;
+    ts += PyDateTime_DATE_GET_HOUR(dt) * 3600;
+    ts += PyDateTime_DATE_GET_MINUTE(dt) * 60;
+    ts += PyDateTime_DATE_GET_SECOND(dt);
     ts -= offset_secs;
+
     int offset_bits = UTCOFFSET_SHIFT + (offset_secs / UTCOFFSET_DIV);
     assert(offset_bits <= 0x7f && offset_bits >= 0);
     ts *= 1000;
@@ -367,6 +396,99 @@ static int write_time(struct writer *wtr, PyObject *dt)
     }
 }
 
+/**
+ * Encode the double `d` into `wtr` as an 8 byte big-endian integer that sorts
+ * in numeric order: negative numbers have every bit inverted, while positive
+ * numbers have only their sign bit inverted. Negative zero is encoded as zero.
+ * Return 1 on success or set an exception and return 0 on failure.
+ */
+static int write_float(struct writer *wtr, double d)
+{
+    union {
+        double d;
+        uint64_t u64;
+    } v = {.d = (d == 0.0) ? 0.0 : d};
+
+    if(v.u64 & (1ULL << 63)) {
+        v.u64 = ~v.u64;
+    } else {
+        v.u64 ^= 1ULL << 63;
+    }
+
+    uint8_t buf[9] = {KIND_FLOAT};
+    for(int i = 8; i > 0; i--) {
+        buf[i] = (uint8_t) v.u64;
+        v.u64 >>= 8;
+    }
+    return writer_puts(wtr, (const char *) buf, sizeof buf);
+}
+
+/**
+ * Encode the decimal.Decimal `arg` into `wtr`: a class byte for negative, zero
+ * or positive, followed for nonzero values by the exponent of the normalized
+ * value 0.DDD * 10**E, then the digits packed two per byte as 1 + 10*a + b,
+ * then a 0 terminator. Bytes following the class of a negative value are
+ * inverted. Return 1 on success or set an exception and return 0 on failure.
+ */
+static int write_decimal(struct writer *wtr, PyObject *arg)
+{
+    PyObject *tup = PyObject_CallMethod(arg, "as_tuple", NULL);
+    if(! tup) {
+        return 0;
+    }
+
+    int ret = 0;
+    PyObject *digits = PyTuple_GET_ITEM(tup, 1);
+    PyObject *exp = PyTuple_GET_ITEM(tup, 2);
+    if(! (PyInt_Check(exp) || PyLong_Check(exp))) {
+        PyErr_Format(PyExc_ValueError, "cannot encode non-finite decimal");
+        Py_DECREF(tup);
+        return 0;
+    }
+
+    long long e = PyLong_AsLongLong(exp);
+    Py_ssize_t ndigits = PyTuple_GET_SIZE(digits);
+    if(e == -1 && PyErr_Occurred()) {
+        Py_DECREF(tup);
+        return 0;
+    }
+    while(ndigits && !PyInt_AS_LONG(PyTuple_GET_ITEM(digits, ndigits - 1))) {
+        ndigits--;
+        e++;
+    }
+
+    if(! ndigits) {
+        ret = writer_putc(wtr, KIND_DECIMAL) && writer_putc(wtr, 0x02);
+        Py_DECREF(tup);
+        return ret;
+    }
+
+    uint8_t xor = PyObject_IsTrue(PyTuple_GET_ITEM(tup, 0)) ? 0xff : 0;
+    e += ndigits;
+    ret = writer_putc(wtr, KIND_DECIMAL) &&
+          writer_putc(wtr, xor ? 0x01 : 0x03);
+    if(ret && e < 0) {
+        ret = writer_putc(wtr, xor ^ 0x01) &&
+              write_int(wtr, (uint64_t) -e, 0, xor ^ 0xff);
+    } else if(ret) {
+        ret = writer_putc(wtr, xor ^ 0x02) &&
+              write_int(wtr, (uint64_t) e, 0, xor);
+    }
+    for(Py_ssize_t i = 0; ret && i < ndigits; i += 2) {
+        long a = PyInt_AS_LONG(PyTuple_GET_ITEM(digits, i));
+        long b = 0;
+        if((i + 1) < ndigits) {
+            b = PyInt_AS_LONG(PyTuple_GET_ITEM(digits, i + 1));
+        }
+        ret = writer_putc(wtr, xor ^ (uint8_t) (1 + (10 * a) + b));
+    }
+    if(ret) {
+        ret = writer_putc(wtr, xor);
+    }
+    Py_DECREF(tup);
+    return ret;
+}
+
 /**
  * Given some arbitrary Python object `arg`, figure out what it is, and encode
  * it to `wtr`. Return 1 on success, or set an exception and return 0 on
@@ -411,6 +533,10 @@ int write_element(struct writer *wtr, PyObject *arg)
         }
     } else if(PyDateTime_CheckExact(arg)) {
         ret = write_time(wtr, arg);
+    } else if(type == &PyFloat_Type) {
+        ret = write_float(wtr, PyFloat_AS_DOUBLE(arg));
+    } else if(type == Decimal_Type) {
+        ret = write_decimal(wtr, arg);
     } else if(type == UUID_Type) {
         PyObject *ss = PyObject_CallFunctionObjArgs(uuid_get_bytes, arg, NULL);
         if(! ss) {
@@ -444,6 +570,45 @@ static int write_tuple(struct writer *wtr, PyObject *tup)
     return ret;
 }
 
+/**
+ * Encode `tups` into `wtr` following the rules of packs(): a list is encoded
+ * as a sequence of KIND_SEP-delimited keys, a tuple or Key as a single key,
+ * and anything else as a 1-tuple. Return 1 on success, or set an exception
+ * and return 0 on failure.
+ */
+static int write_key(struct writer *wtr, PyObject *tups)
+{
+    PyTypeObject *type = Py_TYPE(tups);
+
+    int ret = 1;
+    if(type != &PyList_Type) {
+        if(type == &PyTuple_Type) {
+            ret = write_tuple(wtr, tups);
+        } else if(type == KeyType) {
+            ret = writer_puts(wtr, (void *) ((Key *)tups)->p, Py_SIZE(tups));
+        } else {
+            ret = write_element(wtr, tups);
+        }
+    } else {
+        for(int i = 0; ret && i < PyList_GET_SIZE(tups); i++) {
+            if(i) {
+                ret = writer_putc(wtr, KIND_SEP);
+            }
+            PyObject *elem = PyList_GET_ITEM(tups, i);
+            type = Py_TYPE(elem);
+            if(type == &PyTuple_Type) {
+                ret = write_tuple(wtr, elem);
+            } else if(type == KeyType) {
+                ret = writer_puts(wtr, (void *) ((Key *)elem)->p,
+                                  Py_SIZE(elem));
+            } else {
+                ret = write_element(wtr, elem);
+            }
+        }
+    }
+    return ret;
+}
+
 /**
  * Python-level packs() implementation. Accepts 2 parameters, string prefix and
  * list/tuple/element to encode.
@@ -479,54 +644,149 @@ static PyObject *py_packs(PyObject *self, PyObject *args)
         }
     }
 
-    PyObject *tups = PyTuple_GET_ITEM(args, 1);
-    PyTypeObject *type = Py_TYPE(tups);
+    int ret = write_key(&wtr, PyTuple_GET_ITEM(args, 1));
+    PyObject *packed = writer_fini(&wtr);
+    if(! ret) {
+        Py_CLEAR(packed);
+    }
+    return packed;
+}
 
-    int ret = 1;
-    if(type != &PyList_Type) {
-        if(type == &PyTuple_Type) {
-            ret = write_tuple(&wtr, tups);
-        } else if(type == KeyType) {
-            ret = writer_puts(&wtr, (void *) ((Key *)tups)->p, Py_SIZE(tups));
-        } else {
-            ret = write_element(&wtr, tups);
+/**
+ * Python-level packs_many() implementation. Accepts 2 parameters, string
+ * prefix and a sequence of values that would be accepted by packs(). Return a
+ * list of encoded strings on success, or set an exception and return NULL on
+ * failure.
+ */
+static PyObject *py_packs_many(PyObject *self, PyObject *args)
+{
+    char *prefix;
+    Py_ssize_t prefix_size;
+    PyObject *seq;
+
+    if(! PyArg_ParseTuple(args, "s#O", &prefix, &prefix_size, &seq)) {
+        return NULL;
+    }
+
+    PyObject *fast = PySequence_Fast(seq, "packs_many() requires a sequence.");
+    if(! fast) {
+        return NULL;
+    }
+
+    Py_ssize_t len = PySequence_Fast_GET_SIZE(fast);
+    PyObject *out = PyList_New(len);
+    if(! out) {
+        Py_DECREF(fast);
+        return NULL;
+    }
+
+    for(Py_ssize_t i = 0; i < len; i++) {
+        struct writer wtr;
+        if(! writer_init(&wtr, prefix_size + 20)) {
+            break;
         }
-    } else {
-        for(int i = 0; ret && i < PyList_GET_SIZE(tups); i++) {
-            if(i) {
-                ret = writer_putc(&wtr, KIND_SEP);
+        if(! (writer_puts(&wtr, prefix, prefix_size) &&
+              write_key(&wtr, PySequence_Fast_GET_ITEM(fast, i)))) {
+            writer_abort(&wtr);
+            break;
+        }
+        PyObject *packed = writer_fini(&wtr);
+        if(! packed) {
+            break;
+        }
+        PyList_SET_ITEM(out, i, packed);
+    }
+
+    Py_DECREF(fast);
+    if(PyErr_Occurred()) {
+        Py_CLEAR(out);
+    }
+    return out;
+}
+
+/**
+ * Python-level packs_buffer() implementation. Accepts 2 parameters, string
+ * prefix and a sequence of values that would be accepted by packs(). Return a
+ * tuple `(s, offsets)` where `s` is the concatenation of every encoded key,
+ * each beginning with `prefix`, and `offsets` is a list of integers such that
+ * `s[offsets[i]:offsets[i+1]]` is the i'th key. Set an exception and return
+ * NULL on failure.
+ */
+static PyObject *py_packs_buffer(PyObject *self, PyObject *args)
+{
+    char *prefix;
+    Py_ssize_t prefix_size;
+    PyObject *seq;
+
+    if(! PyArg_ParseTuple(args, "s#O", &prefix, &prefix_size, &seq)) {
+        return NULL;
+    }
+
+    PyObject *fast = PySequence_Fast(seq,
+                                     "packs_buffer() requires a sequence.");
+    if(! fast) {
+        return NULL;
+    }
+
+    Py_ssize_t len = PySequence_Fast_GET_SIZE(fast);
+    PyObject *offsets = PyList_New(1 + len);
+    struct writer wtr;
+    if(! (offsets && writer_init(&wtr, len * (prefix_size + 12)))) {
+        Py_XDECREF(offsets);
+        Py_DECREF(fast);
+        return NULL;
+    }
+
+    PyObject *tmp = PyInt_FromLong(0);
+    if(tmp) {
+        PyList_SET_ITEM(offsets, 0, tmp);
+        for(Py_ssize_t i = 0; i < len; i++) {
+            if(! (writer_puts(&wtr, prefix, prefix_size) &&
+                  write_key(&wtr, PySequence_Fast_GET_ITEM(fast, i)))) {
+                break;
             }
-            PyObject *elem = PyList_GET_ITEM(tups, i);
-            type = Py_TYPE(elem);
-            if(type == &PyTuple_Type) {
-                ret = write_tuple(&wtr, elem);
-            } else if(type == KeyType) {
-                ret = writer_puts(&wtr, (void *) ((Key *)elem)->p,
-                                  Py_SIZE(elem));
-            } else {
-                ret = write_element(&wtr, elem);
+            if(! (tmp = PyInt_FromSsize_t(wtr.pos))) {
+                break;
             }
+            PyList_SET_ITEM(offsets, 1 + i, tmp);
         }
     }
 
+    Py_DECREF(fast);
+    if(PyErr_Occurred()) {
+        writer_abort(&wtr);
+        Py_DECREF(offsets);
+        return NULL;
+    }
+
     PyObject *packed = writer_fini(&wtr);
-    if(! ret) {
-        Py_CLEAR(packed);
+    if(! packed) {
+        Py_DECREF(offsets);
+        return NULL;
     }
-    return packed;
+
+    PyObject *out = PyTuple_New(2);
+    if(! out) {
+        Py_DECREF(packed);
+        Py_DECREF(offsets);
+        return NULL;
+    }
+    PyTuple_SET_ITEM(out, 0, packed);
+    PyTuple_SET_ITEM(out, 1, offsets);
+    return out;
 }
 
 /**
  * Decode the varint pointed to by `rdr` into `u64`, XORing read bytes with
  * `xor`. Return 1 on success or set an exception and return 0 on failure.
  */
-static int read_plain_int(struct reader *rdr, uint64_t *u64, uint8_t xor)
+int read_plain_int(struct reader *rdr, uint64_t *u64, uint8_t xor)
 {
-    uint8_t ch = 0;
-    if(! reader_getc(rdr, &ch)) {
+    if(! reader_ensure(rdr, 1)) {
         return 0;
     }
 
+    uint8_t ch = reader_getchar(rdr);
     uint64_t v = 0;
     int ok = 1;
 
@@ -646,9 +906,10 @@ static PyObject *read_str(struct reader *rdr)
 }
 
 /**
- * Decode a datetime pointed to by `rdr`. Return a new reference to the
- * datetime.datetime instance on success, or set an exception and return NULL
- * on failure.
+ * Decode a datetime pointed to by `rdr`. If the reader's `naive` flag is set,
+ * produce a naive datetime in UTC, otherwise produce one in its original UTC
+ * offset. Return a new reference to the datetime.datetime instance on success,
+ * or set an exception and return NULL on failure.
  */
 static PyObject *read_time(struct reader *rdr, enum ElementKind kind)
 {
@@ -658,29 +919,38 @@ static PyObject *read_time(struct reader *rdr, enum ElementKind kind)
         return NULL;
     }
 
-    int offset_secs = (((int) v & 0x7f) - UTCOFFSET_SHIFT) * UTCOFFSET_DIV;
-    PyObject *fixed_offset = get_fixed_offset(offset_secs);
-    if(! fixed_offset) {
-        return NULL;
-    }
-
-    v >>= 7;
-    double secs = (double) (v / 1000) + (((double) (v % 1000)) / 1000.0);
+    int64_t ts = (int64_t) v;
     if(kind == KIND_NEG_TIME) {
-        secs = -secs;
+        ts = -ts;
+    }
+    int offset_secs = 0;
+    PyObject *tzinfo = Py_None;
+    if(! rdr->naive) {
+        offset_secs = (((int) ts & 0x7f) - UTCOFFSET_SHIFT) * UTCOFFSET_DIV;
+        if(! (tzinfo = get_fixed_offset(offset_secs))) {
+            return NULL;
+        }
     }
 
-    PyObject *py_secs = PyFloat_FromDouble(secs);
-    if(! py_secs) {
-        Py_DECREF(fixed_offset);
-        return NULL;
+    // Arithmetic shift; floor division by 128 for negative times.
+    int64_t msecs = (ts >> 7) + ((int64_t) offset_secs * 1000);
+    int64_t days = msecs / 86400000;
+    int64_t rem = msecs % 86400000;
+    if(rem < 0) {
+        rem += 86400000;
+        days--;
     }
 
-    PyObject *args = PyTuple_New(2);
-    PyTuple_SET_ITEM(args, 0, py_secs);
-    PyTuple_SET_ITEM(args, 1, fixed_offset);
-    PyObject *dt = PyDateTime_FromTimestamp(args);
-    Py_DECREF(args);
+    int year, month, day;
+    civil_from_days(days, &year, &month, &day);
+    int msec = (int) rem;
+    PyObject *dt = PyDateTimeAPI->DateTime_FromDateAndTime(
+        year, month, day, msec / 3600000, (msec / 60000) % 60,
+        (msec / 1000) % 60, (msec % 1000) * 1000, tzinfo,
+        PyDateTimeAPI->DateTimeType);
+    if(tzinfo != Py_None) {
+        Py_DECREF(tzinfo);
+    }
     return dt;
 }
 
@@ -705,6 +975,139 @@ static PyObject *read_uuid(struct reader *rdr)
     return arg;
 }
 
+/**
+ * Decode a float pointed to by `rdr`. If the reader has a number factory,
+ * return the result of calling it with the float's repr(). Return a new
+ * reference on success, or set an exception and return NULL on failure.
+ */
+static PyObject *read_float(struct reader *rdr)
+{
+    if(! reader_ensure(rdr, 8)) {
+        return NULL;
+    }
+
+    union {
+        double d;
+        uint64_t u64;
+    } v = {.u64 = 0};
+    for(int i = 0; i < 8; i++) {
+        v.u64 = (v.u64 << 8) | *rdr->p++;
+    }
+    if(v.u64 & (1ULL << 63)) {
+        v.u64 ^= 1ULL << 63;
+    } else {
+        v.u64 = ~v.u64;
+    }
+
+    PyObject *f = PyFloat_FromDouble(v.d);
+    if(! (f && rdr->number_factory)) {
+        return f;
+    }
+    PyObject *repr = PyObject_Repr(f);
+    Py_DECREF(f);
+    if(! repr) {
+        return NULL;
+    }
+    PyObject *out = PyObject_CallFunctionObjArgs(rdr->number_factory,
+                                                 repr, NULL);
+    Py_DECREF(repr);
+    return out;
+}
+
+/**
+ * Decode the exponent and digits of a nonzero decimal pointed to by `rdr`,
+ * leaving `rdr` positioned after its terminator. `xor` is 0xff for negative
+ * values, otherwise 0. If `digits` is not NULL, append each digit to it. Store
+ * the exponent of the normalized value 0.DDD * 10**E in `*e`. Return 1 on
+ * success or set an exception and return 0 on failure.
+ */
+static int read_decimal_body(struct reader *rdr, uint8_t xor,
+                             PyObject *digits, long long *e)
+{
+    uint8_t ch;
+    uint64_t u64;
+    if(! reader_getc(rdr, &ch)) {
+        PyErr_SetString(PyExc_ValueError, "short decimal read");
+        return 0;
+    }
+    if((xor ^ ch) == 0x01) {
+        if(! read_plain_int(rdr, &u64, xor ^ 0xff)) {
+            return 0;
+        }
+        *e = -(long long) u64;
+    } else {
+        if(! read_plain_int(rdr, &u64, xor)) {
+            return 0;
+        }
+        *e = (long long) u64;
+    }
+
+    for(;;) {
+        if(! reader_getc(rdr, &ch)) {
+            PyErr_SetString(PyExc_ValueError, "short decimal read");
+            return 0;
+        }
+        ch ^= xor;
+        if(! ch) {
+            return 1;
+        }
+        if(digits) {
+            for(int i = 0; i < 2; i++) {
+                PyObject *digit = PyInt_FromLong(i ? (ch - 1) % 10
+                                                   : (ch - 1) / 10);
+                if(! digit || PyList_Append(digits, digit)) {
+                    Py_XDECREF(digit);
+                    return 0;
+                }
+                Py_DECREF(digit);
+            }
+        }
+    }
+}
+
+/**
+ * Decode a decimal pointed to by `rdr`. Return a new reference to the
+ * decimal.Decimal instance on success, or set an exception and return NULL on
+ * failure.
+ */
+static PyObject *read_decimal(struct reader *rdr)
+{
+    uint8_t cls;
+    if(! reader_getc(rdr, &cls)) {
+        PyErr_SetString(PyExc_ValueError, "short decimal read");
+        return NULL;
+    }
+    if(cls == 0x02) {
+        return PyObject_CallFunction((PyObject *) Decimal_Type, "i", 0);
+    } else if(cls != 0x01 && cls != 0x03) {
+        PyErr_Format(PyExc_ValueError,
+                     "bad decimal class %d; key corrupt?", cls);
+        return NULL;
+    }
+
+    PyObject *digits = PyList_New(0);
+    if(! digits) {
+        return NULL;
+    }
+    long long e;
+    PyObject *out = NULL;
+    if(read_decimal_body(rdr, (cls == 0x01) ? 0xff : 0, digits, &e)) {
+        Py_ssize_t ndigits = PyList_GET_SIZE(digits);
+        if(ndigits && !PyInt_AS_LONG(PyList_GET_ITEM(digits, ndigits - 1))) {
+            ndigits--;
+            PyList_SetSlice(digits, ndigits, ndigits + 1, NULL);
+        }
+        PyObject *tup = PyList_AsTuple(digits);
+        if(tup) {
+            out = PyObject_CallFunction((PyObject *) Decimal_Type, "((iNL))",
+                                        cls == 0x01, tup,
+                                        e - (long long) ndigits);
+        }
+    }
+    Py_DECREF(digits);
+    return out;
+}
+
 /**
  * Decode the next tuple element pointed to by `rdr`, returning NULL and
  * setting an exception on failure.
@@ -753,6 +1156,12 @@ read_element(struct reader *rdr)
     case KIND_UUID:
         arg = read_uuid(rdr);
         break;
+    case KIND_FLOAT:
+        arg = read_float(rdr);
+        break;
+    case KIND_DECIMAL:
+        arg = read_decimal(rdr);
+        break;
     default:
         PyErr_Format(PyExc_ValueError, "bad kind %d; key corrupt?", ch);
         break;
@@ -807,12 +1216,12 @@ skip_element(struct reader *rdr, int *eof)
 
     uint8_t ch = *rdr->p++;
     switch(ch) {
-    case KIND_BOOL:
     case KIND_NULL:
         break;
     case KIND_NEG_TIME:
     case KIND_NEG_INTEGER:
         xor = 0xff;
+    case KIND_BOOL:
     case KIND_TIME:
     case KIND_INTEGER:
         ch = xor ^ *rdr->p++;
@@ -829,6 +1238,20 @@ skip_element(struct reader *rdr, int *eof)
     case KIND_UUID:
         rdr->p += 16;
         break;
+    case KIND_FLOAT:
+        rdr->p += 8;
+        break;
+    case KIND_DECIMAL:
+        if(rdr->p >= rdr->e) {
+            rdr->p++;
+        } else if(*rdr->p++ != 0x02) {
+            long long e;
+            if(! read_decimal_body(rdr, (rdr->p[-1] == 0x01) ? 0xff : 0,
+                                   NULL, &e)) {
+                ret = -1;
+            }
+        }
+        break;
     case KIND_SEP:
         *eof = 1;
         break;
@@ -836,86 +1259,292 @@ skip_element(struct reader *rdr, int *eof)
         PyErr_Format(PyExc_ValueError, "bad kind %d; key corrupt?", ch);
         ret = -1;
     }
-    if(rdr->p == rdr->e && !*eof) {
+    if(rdr->p > rdr->e) {
+        PyErr_SetString(PyExc_ValueError, "short element read; key corrupt?");
+        ret = -1;
+    } else if(rdr->p == rdr->e && !*eof) {
         *eof = 1;
     }
     return ret;
 }
 
 /**
- * Python-level interface to unpack a tuple. Expects 2 arguments: string prefix
- * to ignore and encoded tuple. Return the unpacked tuple on success, or set an
+ * Construct and return a list of tuples from the keys pointed to by `rdr`.
+ * Return the list on success, or set an exception and return NULL on failure.
+ */
+static PyObject *unpacks_reader(struct reader *rdr)
+{
+    PyObject *tups = PyList_New(LIST_START_SIZE);
+    if(! tups) {
+        return NULL;
+    }
+
+    Py_ssize_t lpos = 0;
+    while(rdr->p < rdr->e) {
+        PyObject *tup = unpack(rdr);
+        if(! tup) {
+            Py_DECREF(tups);
+            return NULL;
+        }
+
+        if(lpos < LIST_START_SIZE) {
+            PyList_SET_ITEM(tups, lpos++, tup);
+        } else {
+            if(-1 == PyList_Append(tups, tup)) {
+                Py_DECREF(tups);
+                Py_DECREF(tup);
+                return NULL;
+            }
+            Py_DECREF(tup);
+            lpos++;
+        }
+    }
+    PyTuple_GET_SIZE(tups) = lpos;
+    return tups;
+}
+
+/**
+ * Decode `s[0..s_len]` as unpacks() would, or as unpack() would if `first` is
+ * nonzero, passing decoded floats to `number_factory` if it is not None, and
+ * decoding naive datetimes if `naive` is nonzero. Return a new reference to
+ * the result, a new reference to None if `s` lacks `prefix`, or set an
  * exception and return NULL on failure.
  */
-static PyObject *py_unpack(PyObject *self, PyObject *args)
+static PyObject *unpacks_one(uint8_t *prefix, Py_ssize_t prefix_len,
+                             uint8_t *s, Py_ssize_t s_len, int first,
+                             PyObject *number_factory, int naive)
+{
+    if(s_len < prefix_len || memcmp(prefix, s, prefix_len)) {
+        Py_RETURN_NONE;
+    }
+    struct reader rdr = {s+prefix_len, s+s_len,
+                         (number_factory == Py_None) ? NULL : number_factory,
+                         naive};
+    return first ? unpack(&rdr) : unpacks_reader(&rdr);
+}
+
+/**
+ * Python-level interface to unpack a tuple. Expects 2 arguments: string prefix
+ * to ignore and encoded tuple, and optionally a number factory and the `naive`
+ * flag. Return the unpacked tuple on success, or set an exception and return
+ * NULL on failure.
+ */
+static PyObject *py_unpack(PyObject *self, PyObject *args, PyObject *kwds)
 {
+    static char *keywords[] = {"prefix", "s", "number_factory", "naive",
+                               NULL};
     uint8_t *prefix;
     uint8_t *s;
     Py_ssize_t s_len;
     Py_ssize_t prefix_len;
+    PyObject *number_factory = Py_None;
+    int naive = 0;
 
-    if(! PyArg_ParseTuple(args, "s#s#", (char **) &prefix, &prefix_len,
-                                        (char **) &s, &s_len)) {
+    if(! PyArg_ParseTupleAndKeywords(args, kwds, "s#s#|Oi", keywords,
+            (char **) &prefix, &prefix_len, (char **) &s, &s_len,
+            &number_factory, &naive)) {
         return NULL;
     }
-
-    if(s_len < prefix_len || memcmp(prefix, s, prefix_len)) {
-        Py_RETURN_NONE;
-    }
-
-    struct reader rdr = {s+prefix_len, s+s_len};
-    return unpack(&rdr);
+    return unpacks_one(prefix, prefix_len, s, s_len, 1, number_factory,
+                       naive);
 }
 
 /**
  * Python-level interface to unpack a list of tuples. Expects 2 arguments:
- * string prefix to ignore and encoded tuple. Return the unpacked list on
- * success, or set an exception and return NULL on failure.
+ * string prefix to ignore and encoded tuple, and optionally the `first` flag,
+ * a number factory, and the `naive` flag. Return the unpacked list on success,
+ * or set an exception and return NULL on failure.
  */
-static PyObject *py_unpacks(PyObject *self, PyObject *args)
+static PyObject *py_unpacks(PyObject *self, PyObject *args, PyObject *kwds)
 {
+    static char *keywords[] = {"prefix", "s", "first", "number_factory",
+                               "naive", NULL};
     uint8_t *prefix;
     uint8_t *s;
     Py_ssize_t prefix_len;
     Py_ssize_t s_len;
+    int first = 0;
+    PyObject *number_factory = Py_None;
+    int naive = 0;
+
+    if(! PyArg_ParseTupleAndKeywords(args, kwds, "s#s#|iOi", keywords,
+            (char **) &prefix, &prefix_len, (char **) &s, &s_len,
+            &first, &number_factory, &naive)) {
+        return NULL;
+    }
+    return unpacks_one(prefix, prefix_len, s, s_len, first, number_factory,
+                       naive);
+}
 
-    if(! PyArg_ParseTuple(args, "s#s#", (char **) &prefix, &prefix_len,
-                                        (char **) &s, &s_len)) {
+/**
+ * Python-level unpacks_many() implementation. Accepts a string prefix, either
+ * a sequence of encoded strings or a single string containing concatenated
+ * keys, and when a single string is given, the list of offsets produced by
+ * packs_buffer(). Return a list containing one result per key on success, or
+ * set an exception and return NULL on failure.
+ */
+static PyObject *py_unpacks_many(PyObject *self, PyObject *args,
+                                 PyObject *kwds)
+{
+    static char *keywords[] = {"prefix", "seq", "offsets", "first",
+                               "number_factory", "naive", NULL};
+    uint8_t *prefix;
+    Py_ssize_t prefix_len;
+    PyObject *seq;
+    PyObject *offsets = Py_None;
+    int first = 0;
+    PyObject *number_factory = Py_None;
+    int naive = 0;
+
+    if(! PyArg_ParseTupleAndKeywords(args, kwds, "s#O|OiOi", keywords,
+            (char **) &prefix, &prefix_len, &seq, &offsets, &first,
+            &number_factory, &naive)) {
         return NULL;
     }
 
+    PyObject *out = NULL;
+    PyObject *fast = NULL;
+
+    if(offsets == Py_None) {
+        fast = PySequence_Fast(seq, "unpacks_many() requires a sequence.");
+        if(! fast) {
+            return NULL;
+        }
+        Py_ssize_t len = PySequence_Fast_GET_SIZE(fast);
+        if(! (out = PyList_New(len))) {
+            Py_DECREF(fast);
+            return NULL;
+        }
+        for(Py_ssize_t i = 0; i < len; i++) {
+            uint8_t *s;
+            Py_ssize_t s_len;
+            PyObject *elem = PySequence_Fast_GET_ITEM(fast, i);
+            if(PyObject_AsReadBuffer(elem, (const void **) &s, &s_len)) {
+                break;
+            }
+            PyObject *res = unpacks_one(prefix, prefix_len, s, s_len, first,
+                                        number_factory, naive);
+            if(! res) {
+                break;
+            }
+            PyList_SET_ITEM(out, i, res);
+        }
+    } else {
+        uint8_t *s;
+        Py_ssize_t s_len;
+        if(PyObject_AsReadBuffer(seq, (const void **) &s, &s_len)) {
+            return NULL;
+        }
+        fast = PySequence_Fast(offsets, "offsets must be a sequence.");
+        if(! fast) {
+            return NULL;
+        }
+        Py_ssize_t len = PySequence_Fast_GET_SIZE(fast) - 1;
+        if(! (out = PyList_New((len > 0) ? len : 0))) {
+            Py_DECREF(fast);
+            return NULL;
+        }
+
+        Py_ssize_t start = 0;
+        for(Py_ssize_t i = 0; i <= len; i++) {
+            PyObject *elem = PySequence_Fast_GET_ITEM(fast, i);
+            Py_ssize_t end = PyNumber_AsSsize_t(elem, PyExc_OverflowError);
+            if(end == -1 && PyErr_Occurred()) {
+                break;
+            }
+            if(end < start || end > s_len) {
+                PyErr_SetString(PyExc_ValueError, "invalid offsets array.");
+                break;
+            }
+            if(i) {
+                PyObject *res = unpacks_one(prefix, prefix_len, s + start,
+                                            end - start, first,
+                                            number_factory, naive);
+                if(! res) {
+                    break;
+                }
+                PyList_SET_ITEM(out, i - 1, res);
+            }
+            start = end;
+        }
+    }
+
+    Py_DECREF(fast);
+    if(PyErr_Occurred()) {
+        Py_CLEAR(out);
+    }
+    return out;
+}
+
+/**
+ * Append `n` to the list `out`. Return 0 on success, or decrement the
+ * reference count of `out`, set an exception, and return -1 on failure.
+ */
+static int append_ssize(PyObject *out, Py_ssize_t n)
+{
+    PyObject *tmp = PyInt_FromSsize_t(n);
+    if(! tmp || PyList_Append(out, tmp)) {
+        Py_XDECREF(tmp);
+        Py_DECREF(out);
+        return -1;
+    }
+    Py_DECREF(tmp);
+    return 0;
+}
+
+/**
+ * Python-level tuple_offsets() implementation. Accepts a string prefix and an
+ * encoded key as a string or buffer. Return a list of offsets such that tuple
+ * `i` occupies `s[offsets[i]:offsets[i+1]-1]`, None if `s` lacks `prefix`, or
+ * set an exception and return NULL on failure.
+ */
+static PyObject *py_tuple_offsets(PyObject *self, PyObject *args)
+{
+    uint8_t *prefix;
+    Py_ssize_t prefix_len;
+    PyObject *source;
+    uint8_t *s;
+    Py_ssize_t s_len;
+
+    if(! PyArg_ParseTuple(args, "s#O", (char **) &prefix, &prefix_len,
+                          &source)) {
+        return NULL;
+    }
+    if(PyObject_AsReadBuffer(source, (const void **) &s, &s_len)) {
+        return NULL;
+    }
     if(s_len < prefix_len || memcmp(prefix, s, prefix_len)) {
         Py_RETURN_NONE;
     }
 
-    struct reader rdr = {s+prefix_len, s+s_len};
-    PyObject *tups = PyList_New(LIST_START_SIZE);
-    if(! tups) {
+    PyObject *out = PyList_New(0);
+    if(! out) {
+        return NULL;
+    }
+    if(append_ssize(out, prefix_len)) {
         return NULL;
     }
 
-    Py_ssize_t lpos = 0;
+    struct reader rdr = {s + prefix_len, s + s_len};
     while(rdr.p < rdr.e) {
-        PyObject *tup = unpack(&rdr);
-        if(! tup) {
-            Py_DECREF(tups);
-            return NULL;
-        }
-
-        if(lpos < LIST_START_SIZE) {
-            PyList_SET_ITEM(tups, lpos++, tup);
+        if(*rdr.p == KIND_SEP) {
+            rdr.p++;
+            if(append_ssize(out, rdr.p - s)) {
+                return NULL;
+            }
         } else {
-            if(-1 == PyList_Append(tups, tup)) {
-                Py_DECREF(tups);
-                Py_DECREF(tup);
+            int eof = 0;
+            if(skip_element(&rdr, &eof)) {
+                Py_DECREF(out);
                 return NULL;
             }
-            Py_DECREF(tup);
-            lpos++;
         }
     }
-    PyTuple_GET_SIZE(tups) = lpos;
-    return tups;
+    // Final offset is one past the end, as if a separator were present.
+    if(append_ssize(out, s_len + 1)) {
+        return NULL;
+    }
+    return out;
 }
 
 /**
@@ -975,6 +1604,333 @@ static PyObject *py_decode_offsets(PyObject *self, PyObject *args)
     return tmp;
 }
 
+/**
+ * Field kinds used by pack_fields(), stored in the low 3 bits of each tag.
+ */
+enum FieldKind {
+    FIELD_BOOL = 0,
+    FIELD_INTEGER = 1,
+    FIELD_DOUBLE = 2,
+    FIELD_STRING = 3,
+    FIELD_TIME = 4
+};
+
+/**
+ * Write `s[0..len]` to `wtr` preceded by its length as a varint. Return 1 on
+ * success or set an exception and return 0 on failure.
+ */
+static int write_field_str(struct writer *wtr, const char *s, Py_ssize_t len)
+{
+    return write_int(wtr, (uint64_t) len, 0, 0) && writer_puts(wtr, s, len);
+}
+
+/**
+ * Encode the value `v` of the field `name` having kind `kind` to `wtr`. Return
+ * 1 on success or set an exception and return 0 on failure.
+ */
+static int write_field(struct writer *wtr, long kind, PyObject *name,
+                       PyObject *v)
+{
+    int ret = 0;
+    PyObject *tmp;
+    struct writer tmp_wtr;
+
+    switch(kind) {
+    case FIELD_BOOL:
+        if((ret = PyObject_IsTrue(v)) != -1) {
+            ret = writer_putc(wtr, (uint8_t) ret);
+        } else {
+            ret = 0;
+        }
+        break;
+    case FIELD_INTEGER:
+        if(PyInt_Check(v) || PyLong_Check(v)) {
+            int64_t i64 = PyLong_AsLongLong(v);
+            if(i64 == -1 && PyErr_Occurred()) {
+                PyErr_Clear();
+                tmp = PyObject_Repr(name);
+                PyErr_Format(PyExc_ValueError,
+                    "%s: integer field out of range",
+                    tmp ? PyString_AS_STRING(tmp) : "?");
+                Py_XDECREF(tmp);
+            } else {
+                uint64_t u64 = ((uint64_t) i64 << 1) ^ (uint64_t) (i64 >> 63);
+                ret = write_int(wtr, u64, 0, 0);
+            }
+        } else {
+            PyErr_Format(PyExc_TypeError, "integer field must be int, got %s",
+                         Py_TYPE(v)->tp_name);
+        }
+        break;
+    case FIELD_DOUBLE: {
+        union {
+            double d;
+            uint64_t u64;
+        } u = {.d = PyFloat_AsDouble(v)};
+        if(! (u.d == -1.0 && PyErr_Occurred())) {
+            uint8_t buf[8];
+            for(int i = 7; i >= 0; i--) {
+                buf[i] = (uint8_t) u.u64;
+                u.u64 >>= 8;
+            }
+            ret = writer_puts(wtr, (const char *) buf, sizeof buf);
+        }
+        break;
+    }
+    case FIELD_STRING:
+        if(PyUnicode_CheckExact(v)) {
+            tmp = PyUnicode_AsUTF8String(v);
+            if(tmp) {
+                ret = write_field_str(wtr, PyString_AS_STRING(tmp),
+                                      PyString_GET_SIZE(tmp));
+                Py_DECREF(tmp);
+            }
+        } else if(PyString_CheckExact(v)) {
+            ret = write_field_str(wtr, PyString_AS_STRING(v),
+                                  PyString_GET_SIZE(v));
+        } else {
+            PyErr_Format(PyExc_TypeError,
+                "string field must be str or unicode, got %s",
+                Py_TYPE(v)->tp_name);
+        }
+        break;
+    case FIELD_TIME:
+        if(writer_init(&tmp_wtr, 12)) {
+            if(write_element(&tmp_wtr, v)) {
+                ret = write_field_str(wtr, PyString_AS_STRING(tmp_wtr.s),
+                                      tmp_wtr.pos);
+            }
+            writer_abort(&tmp_wtr);
+        }
+        break;
+    default:
+        PyErr_Format(PyExc_ValueError, "bad field kind %ld", kind);
+    }
+    return ret;
+}
+
+/**
+ * Python-level pack_fields() implementation. Accepts a sequence of
+ * `(field_id, kind, name)` tuples and a dict. Return the encoded string on
+ * success, or set an exception and return NULL on failure.
+ */
+static PyObject *py_pack_fields(PyObject *self, PyObject *args)
+{
+    PyObject *fields;
+    PyObject *rec;
+    if(! PyArg_ParseTuple(args, "OO!", &fields, &PyDict_Type, &rec)) {
+        return NULL;
+    }
+    PyObject *seq = PySequence_Fast(fields, "fields must be a sequence.");
+    if(! seq) {
+        return NULL;
+    }
+
+    struct writer wtr;
+    if(! writer_init(&wtr, 64)) {
+        Py_DECREF(seq);
+        return NULL;
+    }
+
+    int ret = 1;
+    for(Py_ssize_t i = 0; ret && i < PySequence_Fast_GET_SIZE(seq); i++) {
+        long field_id;
+        long kind;
+        PyObject *name;
+        ret = PyArg_ParseTuple(PySequence_Fast_GET_ITEM(seq, i), "llO",
+                               &field_id, &kind, &name);
+        if(ret) {
+            PyObject *v = PyDict_GetItem(rec, name);
+            if(v && v != Py_None) {
+                ret = write_int(&wtr, (uint64_t) ((field_id << 3) | kind),
+                                0, 0) &&
+                      write_field(&wtr, kind, name, v);
+            }
+        }
+    }
+    Py_DECREF(seq);
+
+    if(ret) {
+        PyObject *unknown = PyDict_GetItem(rec, Py_None);
+        if(unknown && PyString_CheckExact(unknown)) {
+            ret = writer_puts(&wtr, PyString_AS_STRING(unknown),
+                              PyString_GET_SIZE(unknown));
+        }
+    }
+    if(! ret) {
+        writer_abort(&wtr);
+        return NULL;
+    }
+    return writer_fini(&wtr);
+}
+
+/**
+ * Decode the value of a field having kind `kind` from `rdr`. Return a new
+ * reference on success, or set an exception and return NULL on failure.
+ */
+static PyObject *read_field(struct reader *rdr, uint64_t kind)
+{
+    PyObject *out = NULL;
+    uint64_t u64;
+    union {
+        double d;
+        uint64_t u64;
+    } u;
+
+    switch(kind) {
+    case FIELD_BOOL:
+        if(read_plain_int(rdr, &u64, 0)) {
+            out = PyBool_FromLong(u64 != 0);
+        }
+        break;
+    case FIELD_INTEGER:
+        if(read_plain_int(rdr, &u64, 0)) {
+            int64_t i64 = (int64_t) (u64 >> 1) ^ -(int64_t) (u64 & 1);
+            if(i64 >= LONG_MIN && i64 <= LONG_MAX) {
+                out = PyInt_FromLong((long) i64);
+            } else {
+                out = PyLong_FromLongLong(i64);
+            }
+        }
+        break;
+    case FIELD_DOUBLE:
+        if(reader_ensure(rdr, 8)) {
+            u.u64 = 0;
+            for(int i = 0; i < 8; i++) {
+                u.u64 = (u.u64 << 8) | reader_getchar(rdr);
+            }
+            out = PyFloat_FromDouble(u.d);
+        }
+        break;
+    case FIELD_STRING:
+    case FIELD_TIME:
+        if(read_plain_int(rdr, &u64, 0) &&
+           reader_ensure(rdr, (Py_ssize_t) u64)) {
+            uint8_t *p = rdr->p;
+            rdr->p += u64;
+            if(kind == FIELD_STRING) {
+                out = PyUnicode_DecodeUTF8((char *) p, (Py_ssize_t) u64,
+                                           "strict");
+            } else if(u64) {
+                struct reader sub = {p, p + u64, NULL, 0};
+                out = read_element(&sub);
+            } else {
+                PyErr_SetString(PyExc_ValueError, "empty time field");
+            }
+        }
+        break;
+    default:
+        PyErr_Format(PyExc_ValueError, "bad field kind %d; record corrupt?",
+                     (int) kind);
+    }
+    return out;
+}
+
+/**
+ * Advance `rdr` past the value of a field having kind `kind`, without decoding
+ * it. Return 1 on success or set an exception and return 0 on failure.
+ */
+static int skip_field(struct reader *rdr, uint64_t kind)
+{
+    uint64_t u64;
+    int ret = 0;
+
+    switch(kind) {
+    case FIELD_BOOL:
+    case FIELD_INTEGER:
+        ret = read_plain_int(rdr, &u64, 0);
+        break;
+    case FIELD_DOUBLE:
+        if((ret = reader_ensure(rdr, 8))) {
+            rdr->p += 8;
+        }
+        break;
+    case FIELD_STRING:
+    case FIELD_TIME:
+        if((ret = read_plain_int(rdr, &u64, 0) &&
+                  reader_ensure(rdr, (Py_ssize_t) u64))) {
+            rdr->p += u64;
+        }
+        break;
+    default:
+        PyErr_Format(PyExc_ValueError, "bad field kind %d; record corrupt?",
+                     (int) kind);
+    }
+    return ret;
+}
+
+/**
+ * Python-level unpack_fields() implementation. Accepts a dict mapping tags to
+ * field names, a string or buffer, and optionally the `unknown` flag. Return
+ * the decoded dict on success, or set an exception and return NULL on failure.
+ */
+static PyObject *py_unpack_fields(PyObject *self, PyObject *args)
+{
+    PyObject *fields;
+    uint8_t *s;
+    Py_ssize_t s_len;
+    int keep_unknown = 1;
+    if(! PyArg_ParseTuple(args, "O!s#|i", &PyDict_Type, &fields,
+                          (char **) &s, &s_len, &keep_unknown)) {
+        return NULL;
+    }
+
+    PyObject *rec = PyDict_New();
+    if(! rec) {
+        return NULL;
+    }
+
+    struct reader rdr = {s, s + s_len, NULL, 0};
+    struct writer unknown = {NULL, 0};
+    int ret = 1;
+    while(ret && rdr.p < rdr.e) {
+        uint8_t *start = rdr.p;
+        uint64_t tag;
+        if(! (ret = read_plain_int(&rdr, &tag, 0))) {
+            break;
+        }
+        PyObject *py_tag = PyInt_FromLong((long) tag);
+        if(! (ret = (py_tag != NULL))) {
+            break;
+        }
+        PyObject *name = PyDict_GetItem(fields, py_tag);
+        Py_DECREF(py_tag);
+
+        if(! name && ! keep_unknown) {
+            ret = skip_field(&rdr, tag & 7);
+            continue;
+        }
+        PyObject *v = read_field(&rdr, tag & 7);
+        if(! (ret = (v != NULL))) {
+            break;
+        }
+        if(name) {
+            ret = PyDict_SetItem(rec, name, v) == 0;
+            if(! keep_unknown && PyDict_Size(rec) == PyDict_Size(fields)) {
+                Py_DECREF(v);
+                break;
+            }
+        } else {
+            if(! unknown.s) {
+                ret = writer_init(&unknown, rdr.p - start);
+            }
+            ret = ret && writer_puts(&unknown, (char *) start, rdr.p - start);
+        }
+        Py_DECREF(v);
+    }
+
+    if(ret && unknown.s) {
+        PyObject *tmp = writer_fini(&unknown);
+        ret = tmp && PyDict_SetItem(rec, Py_None, tmp) == 0;
+        Py_XDECREF(tmp);
+    }
+    writer_abort(&unknown);
+    if(! ret) {
+        Py_CLEAR(rec);
+    }
+    return rec;
+}
+
 /**
  * Import `module`, then iteratively walk its attributes looking for a specific
  * object. Given import_object("sys", "stdout", "write", NULL), would return a
@@ -1010,12 +1966,21 @@ import_object(const char *module, ...)
  * Table of functions exported in the acid._keylib module.
  */
 static PyMethodDef KeylibMethods[] = {
-    {"unpack", py_unpack, METH_VARARGS, "unpack"},
-    {"unpacks", py_unpacks, METH_VARARGS, "unpacks"},
+    {"unpack", (PyCFunction) py_unpack,
+        METH_VARARGS|METH_KEYWORDS, "unpack"},
+    {"unpacks", (PyCFunction) py_unpacks,
+        METH_VARARGS|METH_KEYWORDS, "unpacks"},
+    {"unpacks_many", (PyCFunction) py_unpacks_many,
+        METH_VARARGS|METH_KEYWORDS, "unpacks_many"},
     {"pack", py_packs, METH_VARARGS, "pack"},
     {"packs", py_packs, METH_VARARGS, "packs"},
+    {"packs_many", py_packs_many, METH_VARARGS, "packs_many"},
+    {"packs_buffer", py_packs_buffer, METH_VARARGS, "packs_buffer"},
     {"pack_int", py_pack_int, METH_VARARGS, "pack_int"},
     {"decode_offsets", py_decode_offsets, METH_VARARGS, "decode_offsets"},
+    {"tuple_offsets", py_tuple_offsets, METH_VARARGS, "tuple_offsets"},
+    {"pack_fields", py_pack_fields, METH_VARARGS, "pack_fields"},
+    {"unpack_fields", py_unpack_fields, METH_VARARGS, "unpack_fields"},
     {NULL, NULL, 0, NULL}
 };
 
@@ -1029,6 +1994,8 @@ init_keylib(void)
 
     UUID_Type = (PyTypeObject *) import_object("uuid", "UUID", NULL);
     assert(PyType_CheckExact((PyObject *) UUID_Type));
+    Decimal_Type = (PyTypeObject *) import_object("decimal", "Decimal", NULL);
+    assert(PyType_Check((PyObject *) Decimal_Type));
 
     datetime_utcoffset = import_object("datetime",
         "datetime", "utcoffset", NULL);
@@ -1054,4 +2021,14 @@ init_keylib(void)
     if(KeyType) {
         PyDict_SetItemString(dct, "Key", (PyObject *) KeyType);
     }
+
+    PyTypeObject *notifier = init_notifier_type();
+    if(notifier) {
+        PyDict_SetItemString(dct, "Notifier", (PyObject *) notifier);
+    }
+
+    PyTypeObject *keylist = init_keylist_type();
+    if(keylist) {
+        PyDict_SetItemString(dct, "KeyList", (PyObject *) keylist);
+    }
 }
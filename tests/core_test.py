@@ -1,11 +1,14 @@
 
 import cStringIO
+import datetime
 import operator
 import os
 import pdb
 import shutil
+import threading
 import time
 import unittest
+import zlib
 
 from pprint import pprint
 from unittest import TestCase
@@ -394,6 +397,37 @@ class LmdbEngineTest(EngineTestBase):
         rm_rf('test.lmdb')
 
 
+@register()
+class LmdbBuffersTest:
+    ITEMS = ['dave', 'jim', 'zork']
+
+    def setUp(self):
+        rm_rf('test.lmdb')
+        self.e = acid.engines.LmdbEngine(path='test.lmdb', buffers=True)
+        self.store = acid.Store(self.e)
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('people')
+            for value in self.ITEMS:
+                self.coll.put(value)
+
+    def tearDown(self):
+        self.e.close()
+        rm_rf('test.lmdb')
+
+    def test_keys_outlive_txn(self):
+        with self.store.begin():
+            items = list(self.coll.items())
+        with self.store.begin(write=True):
+            for i in xrange(100):
+                self.coll.put('x' * 100)
+        eq([((1,), 'dave'), ((2,), 'jim'), ((3,), 'zork')],
+           [(tuple(k), v) for k, v in items])
+
+    def test_reverse(self):
+        with self.store.begin():
+            eq([(3,), (2,), (1,)], list(self.coll.keys(reverse=True)))
+
+
 @register()
 class OneCollBoundsTest:
     def setUp(self):
@@ -478,6 +512,62 @@ class CollBasicTest:
         eq([''], list(self.coll.values()))
 
 
+@register()
+class ZeroCopyTest:
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        self.types = []
+        def unpack(key, data):
+            self.types.append(type(data))
+            return acid.encoders.PICKLE.unpack(key, data)
+        encoder = acid.encoders.RecordEncoder('pickle', unpack,
+            acid.encoders.PICKLE.pack)
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('coll', encoder=encoder)
+            for i in range(1, 5):
+                self.coll.put('x' * i, key=i)
+
+    def test_plain(self):
+        with self.store.begin():
+            eq('x', self.coll.get(1))
+            eq(['x', 'xx', 'xxx', 'xxxx'], list(self.coll.values()))
+        eq([buffer] * 5, self.types)
+
+    def test_raw(self):
+        with self.store.begin():
+            eq(str, type(self.coll.get(1, raw=True)))
+            eq(str, type(self.coll.find(raw=True)))
+            eq([str] * 4, map(type, self.coll.values(raw=True)))
+
+    def test_blocked(self):
+        with self.store.begin(write=True):
+            self.coll.batch(max_recs=4, block_size=8)
+            self.coll.delete(2)
+            eq(['x', 'xxx', 'xxxx'], list(self.coll.values()))
+
+
+@register()
+class PrefixTest:
+    KEYS = [('ab',), ('ab', 1), ('ab', 2), ('ab\x01',), ('ab\x01', 3),
+            ('abc',)]
+
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('coll1')
+            for key in self.KEYS:
+                self.coll.put('', key=key)
+
+    def test_forward(self):
+        with self.store.begin():
+            eq(self.KEYS[:3], list(self.coll.keys(prefix=('ab',))))
+
+    def test_reverse(self):
+        with self.store.begin():
+            eq(self.KEYS[:3][::-1],
+               list(self.coll.keys(prefix=('ab',), reverse=True)))
+
+
 @register()
 class IndexTest:
     def setUp(self):
@@ -558,6 +648,48 @@ class IndexTest:
         assert self.i.has((69, 'dave2'))
 
 
+@register()
+class PutIndicesTest:
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('stuff')
+            self.a = self.coll.add_index('a', lambda obj: obj['a'])
+            self.b = self.coll.add_index('b', lambda obj: obj['b'])
+
+    def test_subset(self):
+        with self.store.begin(write=True):
+            key = self.coll.put({'a': 1, 'b': 1})
+            self.coll.put({'a': 1, 'b': 2}, key=key, indices=['b'])
+            eq([(1,)], list(self.a.tups()))
+            eq([(2,)], list(self.b.tups()))
+
+    def test_none(self):
+        with self.store.begin(write=True):
+            key = self.coll.put({'a': 1, 'b': 1})
+            self.coll.put({'a': 1, 'b': 1, 'c': 1}, key=key, indices=())
+            eq({'a': 1, 'b': 1, 'c': 1}, self.coll.get(key))
+            eq([(1,)], list(self.a.tups()))
+            eq([(1,)], list(self.b.tups()))
+
+    def test_missing(self):
+        # Without an old record, all index entries are written.
+        with self.store.begin(write=True):
+            self.coll.put({'a': 1, 'b': 2}, key=1, indices=())
+            eq([(1,)], list(self.a.tups()))
+            eq([(2,)], list(self.b.tups()))
+
+    def test_batch(self):
+        with self.store.begin(write=True):
+            for i in range(1, 5):
+                self.coll.put({'a': i, 'b': i}, key=i)
+            self.coll.batch(max_recs=4)
+            self.coll.put({'a': 1, 'b': 5}, key=1, indices=['b'])
+            eq([(1,), (2,), (3,), (4,)], list(self.a.tups()))
+            eq([(2,), (3,), (4,), (5,)], list(self.b.tups()))
+            eq({'a': 1, 'b': 5}, self.coll.get(1))
+
+
 class Bag(object):
     def __init__(self, **kwargs):
         vars(self).update(kwargs)
@@ -586,6 +718,980 @@ class BatchTest:
         assert list(self.coll.items()) == self.ITEMS
 
 
+@register()
+class BatchKeysTest:
+    KEYS = [('a', 1), ('a', 2), ('b', 1), ('b', 2), ('b', 3)]
+
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('coll1')
+            for i, key in enumerate(self.KEYS):
+                self.coll.put(i, key=key)
+            self.coll.batch(max_recs=len(self.KEYS))
+
+    def test_forward(self):
+        with self.store.begin():
+            eq(self.KEYS, list(self.coll.keys()))
+            eq(range(len(self.KEYS)), list(self.coll.values()))
+
+    def test_reverse(self):
+        with self.store.begin():
+            eq(self.KEYS[::-1], list(self.coll.keys(reverse=True)))
+
+    def test_prefix(self):
+        with self.store.begin():
+            eq(self.KEYS[2:], list(self.coll.keys(prefix=('b',))))
+            eq(self.KEYS[2:][::-1],
+               list(self.coll.keys(prefix=('b',), reverse=True)))
+
+    def test_phys_key(self):
+        with self.store.begin():
+            phys = [k for k, v in self.store.engine.items
+                    if k.startswith(self.coll.prefix)]
+            eq([keylib.packs(self.coll.prefix, [self.KEYS[-1], self.KEYS[0]])],
+               phys)
+
+    def test_get(self):
+        with self.store.begin():
+            for i, key in enumerate(self.KEYS):
+                eq(i, self.coll.get(key))
+            eq(None, self.coll.get(('a', 3)))
+
+
+@register()
+class BatchSplitTest:
+    KEYS = range(5)
+
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('coll1')
+            self.idx = self.coll.add_index('idx', lambda obj: obj)
+            for key in self.KEYS:
+                self.coll.put('v%d' % key, key=key)
+            self.coll.batch(max_recs=len(self.KEYS), packer=acid.encoders.ZLIB)
+
+    def phys(self):
+        return [k for k, v in self.store.engine.items
+                if k.startswith(self.coll.prefix)]
+
+    def test_delete(self):
+        with self.store.begin(write=True):
+            self.coll.delete(2)
+            eq(None, self.coll.get(2))
+            eq([0, 1, 3, 4], [k for k, in self.coll.keys()])
+            eq(['v0', 'v1', 'v3', 'v4'], [v for v, in self.idx.tups()])
+            eq([keylib.packs(self.coll.prefix, [(4,), (0,)])], self.phys())
+
+    def test_delete_missing(self):
+        with self.store.begin(write=True):
+            before = self.phys()
+            self.coll.delete(1.5)
+            eq(before, self.phys())
+
+    def test_delete_to_single(self):
+        with self.store.begin(write=True):
+            for key in self.KEYS[1:]:
+                self.coll.delete(key)
+            eq([((0,), 'v0')], list(self.coll.items()))
+            eq([keylib.packs(self.coll.prefix, (0,))], self.phys())
+
+    def test_put(self):
+        with self.store.begin(write=True):
+            self.coll.put('new', key=3)
+            eq(['v0', 'v1', 'v2', 'new', 'v4'], list(self.coll.values()))
+            eq('new', self.coll.get(3))
+            eq(['new', 'v0', 'v1', 'v2', 'v4'], [v for v, in self.idx.tups()])
+            eq(3, len(self.phys()))
+
+    def test_put_between(self):
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('coll2')
+            for key in (0, 2, 4, 6):
+                coll.put(key, key=key)
+            coll.batch(max_recs=4)
+            coll.put(3, key=3)
+            eq([0, 2, 3, 4, 6], list(coll.values()))
+            eq([3, 4, 6], list(coll.values(lo=3)))
+            eq(3, len([k for k, v in self.store.engine.items
+                       if k.startswith(coll.prefix)]))
+
+    def test_put_no_index(self):
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('coll2')
+            for key in self.KEYS:
+                coll.put(key, key=key)
+            coll.batch(max_recs=len(self.KEYS))
+            coll.put(-1, key=0)
+            eq([-1, 1, 2, 3, 4], list(coll.values()))
+
+    def test_rebatch(self):
+        with self.store.begin(write=True):
+            self.coll.delete(2)
+            self.coll.put('v2', key=2)
+            self.coll.batch(max_recs=5, preserve=False)
+            eq(['v%d' % k for k in self.KEYS], list(self.coll.values()))
+            eq(1, len(self.phys()))
+
+    def test_rebatch_range(self):
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('coll2')
+            for key in range(10):
+                coll.put(key, key=key)
+            eq((10, 1, (9,)), coll.batch(max_recs=10))
+            eq((4, 2, (6,)), coll.batch(lo=3, hi=6, max_recs=2,
+                                        preserve=False))
+            eq(range(10), list(coll.values()))
+            eq(4, len([k for k, v in self.store.engine.items
+                       if k.startswith(coll.prefix)]))
+            eq((0, 0, None), coll.batch(lo=10, max_recs=2))
+
+    def test_rebatch_max_bytes(self):
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('coll2')
+            for key in range(20):
+                coll.put('x' * 20, key=key)
+            coll.batch(max_recs=5)
+            found, made, last = coll.batch(max_bytes=120, preserve=False)
+            eq(20, found)
+            eq((19,), last)
+            eq(['x' * 20] * 20, list(coll.values()))
+
+
+@register()
+class BlockedBatchTest:
+    KEYS = [('a', i) for i in range(10)]
+
+    def setUp(self):
+        self.unpacked = []
+        def unpack(s):
+            self.unpacked.append(len(s))
+            return acid.encoders.ZLIB.unpack(s)
+        self.packer = acid.encoders.Compressor('zlib', unpack,
+                                               acid.encoders.ZLIB.pack)
+        self.store = acid.open('ListEngine')
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('coll1')
+            for i, key in enumerate(self.KEYS):
+                self.coll.put('x' * 10 + str(i), key=key)
+            self.coll.batch(max_recs=len(self.KEYS), packer=self.packer,
+                            block_size=30)
+
+    def test_layout(self):
+        with self.store.begin():
+            value = self.store.engine.items[-1][1]
+            eq(acid.core.BATCH_BLOCKED, value[0])
+            _, _, _, pos = self.coll._batch_header(None, value)
+            firsts, starts = self.coll._block_table(value, pos)
+            eq([0, 2, 4, 6, 8, 10], firsts)
+            eq(len(value), starts[-1])
+
+    def test_get(self):
+        self.store.batch_cache.max_bytes = 0
+        with self.store.begin():
+            for i, key in enumerate(self.KEYS):
+                del self.unpacked[:]
+                eq('x' * 10 + str(i), self.coll.get(key))
+                eq(1, len(self.unpacked))
+            eq(None, self.coll.get(('a', 10)))
+            eq(None, self.coll.get(('a', -1)))
+
+    def test_delete(self):
+        with self.store.begin(write=True):
+            self.coll.delete(('a', 4))
+            value = self.store.engine.items[-1][1]
+            eq(acid.core.BATCH_BLOCKED, value[0])
+            eq(['x' * 10 + str(i) for i in range(10) if i != 4],
+               list(self.coll.values()))
+
+    def test_iter(self):
+        with self.store.begin():
+            eq(self.KEYS, list(self.coll.keys()))
+            eq(['x' * 10 + str(i) for i in range(10)][::-1],
+               list(self.coll.values(reverse=True)))
+
+    def test_iter_lazy(self):
+        self.store.batch_cache.max_bytes = 0
+        with self.store.begin():
+            eq(['x' * 10 + str(i) for i in range(3)],
+               list(self.coll.values(max=3)))
+            eq(2, len(self.unpacked))
+            del self.unpacked[:]
+            eq(['x' * 10 + '9', 'x' * 10 + '8'],
+               list(self.coll.values(reverse=True, max=2)))
+            eq(1, len(self.unpacked))
+
+
+@register()
+class BatchSizerTest:
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        self.packed = []
+        def pack(s):
+            self.packed.append(len(s))
+            return zlib.compress(s)
+        self.slow = acid.encoders.Compressor('slowzlib', zlib.decompress, pack)
+        self.items = [(keylib.Key('k', i), ('%d' % i) * (i % 7) + 'x' * 20)
+                      for i in range(40)]
+
+    def _check(self, packer, block_size):
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('coll1')
+            sizer = acid.core.BatchSizer(packer, coll._packer_prefix(packer),
+                                         block_size)
+            for i, (key, data) in enumerate(self.items):
+                sizer.append(key, data)
+                _, value = coll._prepare_batch(self.items[:i + 1], packer,
+                                               block_size)
+                eq(len(value), sizer.size())
+            sizer.reset()
+            sizer.append(*self.items[0])
+            eq(len(coll._prepare_batch(self.items[:1], packer)[1]),
+               sizer.size())
+
+    def test_zlib(self):
+        self._check(acid.encoders.ZLIB, None)
+
+    def test_zlib_blocked(self):
+        self._check(acid.encoders.ZLIB, 100)
+
+    def test_plain(self):
+        self._check(acid.encoders.PLAIN, None)
+
+    def test_no_compressobj(self):
+        self._check(self.slow, 100)
+
+    def test_batch(self):
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('coll1')
+            for key, data in self.items:
+                coll.put(data, key=key)
+            coll.batch(max_bytes=200, packer=acid.encoders.ZLIB)
+            sizes = [len(v) for k, v in self.store.engine.items
+                     if k.startswith(coll.prefix)]
+            assert max(sizes) <= 200
+            assert len(sizes) < len(self.items)
+            eq([data for _, data in self.items], list(coll.values()))
+
+    def test_compressobj(self):
+        packer = acid.encoders.Compressor('fastzlib', zlib.decompress,
+                                          self.slow.pack, zlib.compressobj)
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('coll1')
+            sizer = acid.core.BatchSizer(packer, coll._packer_prefix(packer))
+            for key, data in self.items:
+                sizer.append(key, data)
+                sizer.size()
+            eq([len(self.items[0][1])], self.packed)
+
+
+@register()
+class BatchCacheTest:
+    def setUp(self):
+        self.cache = acid.core.BatchCache(max_bytes=30)
+        self.calls = []
+
+    def func(self, s):
+        self.calls.append(s)
+        return str(s) * 2
+
+    def test_hit(self):
+        eq('abab', self.cache.get('k', 'ab', self.func))
+        eq('abab', self.cache.get('k', 'ab', self.func))
+        eq(1, len(self.calls))
+        eq((1, 1), (self.cache.hits, self.cache.misses))
+        eq(0.5, self.cache.hit_rate)
+        eq(4, self.cache.size)
+
+    def test_changed(self):
+        self.cache.get('k', 'ab', self.func)
+        eq('cdcd', self.cache.get('k', buffer('cd'), self.func))
+        eq(2, len(self.calls))
+        eq((1, 4), (len(self.cache), self.cache.size))
+
+    def test_token(self):
+        old = 'a' * 20 + 'b' * 20 + 'c' * 20
+        new = 'a' * 20 + 'x' * 20 + 'c' * 20
+        cache = acid.core.BatchCache()
+        cache.get('k', old, self.func)
+        # Only the length and ends of the compressed data are compared.
+        eq(old * 2, cache.get('k', buffer(new), self.func))
+        eq('ab' * 60, cache.get('k', 'ab' * 30, self.func))
+        eq(2, len(self.calls))
+
+    def test_blocks(self):
+        eq('abab', self.cache.get('k', 'ab', self.func, 0))
+        eq('cdcd', self.cache.get('k', 'cd', self.func, 1))
+        eq('cdcd', self.cache.get('k', 'cd', self.func, 1))
+        eq((1, 8), (len(self.cache), self.cache.size))
+        self.cache.invalidate('k')
+        eq((0, 0), (len(self.cache), self.cache.size))
+        self.cache.get('k', 'cd', self.func, 1)
+        eq(3, len(self.calls))
+
+    def test_invalidate(self):
+        self.cache.get('k', 'ab', self.func)
+        self.cache.invalidate('k')
+        self.cache.invalidate('missing')
+        eq((0, 0), (len(self.cache), self.cache.size))
+
+    def test_evict(self):
+        for k in 'abcde':
+            self.cache.get(k, k * 3, self.func)
+        self.cache.get('a', 'aaa', self.func)
+        self.cache.get('f', 'fff', self.func)
+        eq(['c', 'd', 'e', 'a', 'f'], list(self.cache._entries))
+        eq(30, self.cache.size)
+
+    def test_oversize(self):
+        self.cache.get('k', 'x' * 20, self.func)
+        eq((0, 0), (len(self.cache), self.cache.size))
+
+    def test_clear(self):
+        self.cache.get('k', 'ab', self.func)
+        self.cache.clear()
+        eq((0, 0, 0, 0), (len(self.cache), self.cache.size,
+                          self.cache.hits, self.cache.misses))
+
+
+@register()
+class BatchCacheStoreTest:
+    def setUp(self):
+        self.unpacked = []
+        def unpack(s):
+            self.unpacked.append(len(s))
+            return acid.encoders.ZLIB.unpack(s)
+        self.packer = acid.encoders.Compressor('zlib', unpack,
+                                               acid.encoders.ZLIB.pack)
+        self.store = acid.open('ListEngine')
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('coll1')
+            for i in range(10):
+                self.coll.put(i, key=i)
+            self.coll.batch(max_recs=10, packer=self.packer)
+
+    def test_get(self):
+        with self.store.begin():
+            for i in range(10):
+                eq(i, self.coll.get(i))
+            eq(range(10), list(self.coll.values()))
+        eq(1, len(self.unpacked))
+        eq((10, 1), (self.store.batch_cache.hits,
+                     self.store.batch_cache.misses))
+
+    def test_rewrite(self):
+        with self.store.begin(write=True):
+            eq(0, self.coll.get(0))
+            eq(1, len(self.store.batch_cache))
+            phys, = [k for k, v in self.store.engine.items
+                     if k.startswith(self.coll.prefix)]
+            self.store.engine.delete(phys)
+            for i in range(10):
+                self.coll.put(i * 2, key=i)
+            self.coll.batch(max_recs=10, packer=self.packer)
+            eq(0, len(self.store.batch_cache))
+            eq(range(0, 20, 2), list(self.coll.values()))
+
+    def test_disabled(self):
+        self.store.batch_cache.max_bytes = 0
+        with self.store.begin():
+            eq(0, self.coll.get(0))
+            eq(0, self.coll.get(0))
+        eq(2, len(self.unpacked))
+
+
+@register()
+class CompactorTest:
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('coll1')
+            for i in range(20):
+                self.coll.put(i, key=i)
+        self.compactor = acid.core.Compactor(self.store, max_phys=8,
+                                             interval=0.01)
+        self.compactor.add('coll1', max_recs=4)
+
+    def phys(self):
+        return [k for k, v in self.store.engine.items
+                if k.startswith(self.coll.prefix)]
+
+    def test_run_once(self):
+        eq(8, self.compactor.run_once())
+        with self.store.begin():
+            eq(acid.Key(7), self.compactor.progress('coll1'))
+        # The batch ending at 7 is the first physical record visited.
+        eq(7, self.compactor.run_once())
+        eq(4, self.compactor.run_once())
+        with self.store.begin():
+            eq(acid.Key(19), self.compactor.progress('coll1'))
+        eq(0, self.compactor.run_once())
+        # 19 is left alone as the only record of its batch.
+        eq(6, len(self.phys()))
+        with self.store.begin():
+            eq(range(20), list(self.coll.values()))
+            eq(None, self.compactor.progress('coll1'))
+
+    def test_converge(self):
+        with self.store.begin(write=True):
+            self.coll.delete(19)
+        for _ in range(3):
+            self.compactor.run_once()
+        with self.store.begin():
+            eq(acid.Key(18), self.compactor.progress('coll1'))
+        before = self.phys()
+        eq((0, 0, None), self.compactor.compact('coll1'))
+        eq(before, self.phys())
+        # Restarting from the lowest key finds only batches.
+        eq(0, self.compactor.run_once())
+        eq(before, self.phys())
+
+    def test_resume(self):
+        self.compactor.run_once()
+        with self.store.begin():
+            lo = self.compactor.progress('coll1')
+        compactor = acid.core.Compactor(self.store)
+        with self.store.begin():
+            eq(lo, compactor.progress('coll1'))
+
+    def test_hot(self):
+        with self.store.begin(write=True):
+            self.coll.put(15, key=15)
+        eq(acid.Key(15), self.compactor.hot_key('coll1'))
+        while self.compactor.run_once():
+            pass
+        singles = [k for k in self.phys()
+                   if len(keylib.tuple_offsets(self.coll.prefix, k)) == 2]
+        eq([keylib.packs(self.coll.prefix, i) for i in range(15, 20)],
+           singles)
+
+    def test_cold(self):
+        self.compactor.cold_secs = 0
+        with self.store.begin(write=True):
+            self.coll.put(15, key=15)
+        eq(None, self.compactor.hot_key('coll1'))
+
+    def test_thread(self):
+        self.compactor.start()
+        try:
+            for _ in range(500):
+                if len(self.phys()) == 6:
+                    break
+                time.sleep(0.01)
+        finally:
+            self.compactor.stop()
+        eq(6, len(self.phys()))
+        eq(None, self.compactor.last_error)
+
+
+@register()
+class ProjectionTest:
+    RECS = [{'name': u'a%d' % i, 'age': i, 'email': u'a%d@example.com' % i}
+            for i in range(1, 4)]
+
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+
+    def _check(self, encoder):
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('coll', encoder=encoder)
+            for i, rec in enumerate(self.RECS):
+                coll.put(rec, key=i)
+            eq([{'age': r['age']} for r in self.RECS],
+               list(coll.values(fields=['age'])))
+            eq([{'age': r['age'], 'name': r['name']} for r in self.RECS],
+               list(coll.values(fields=('name', 'age', 'missing'))))
+            eq([{'age': 3}], list(coll.values(lo=2, fields=['age'])))
+            eq({'email': u'a1@example.com'}, coll.get(0, fields=['email']))
+            eq(None, coll.get(5, fields=['email']))
+
+    def test_default(self):
+        self._check(acid.encoders.make_json_encoder())
+
+    def test_pickle(self):
+        self._check(acid.encoders.PICKLE)
+
+    def test_schema(self):
+        self._check(acid.encoders.make_schema_encoder([
+            (1, keylib.FIELD_STRING, 'name'),
+            (2, keylib.FIELD_INTEGER, 'age'),
+            (3, keylib.FIELD_STRING, 'email')]))
+
+    def test_custom(self):
+        calls = []
+        def unpack_fields(key, data, names):
+            calls.append(names)
+            return 'x'
+        encoder = acid.encoders.RecordEncoder('pickle',
+            acid.encoders.PICKLE.unpack, acid.encoders.PICKLE.pack,
+            unpack_fields=unpack_fields)
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('coll', encoder=encoder)
+            coll.put({}, key=1)
+            eq(['x'], list(coll.values(fields=['a'])))
+            eq([('a',)], calls)
+
+
+@register()
+class ColumnarTest:
+    RECS = [{'name': u'n%d' % i, 'age': i - 3, 'score': i * 1.5}
+            for i in range(10)]
+    for i, rec in enumerate(RECS):
+        if i % 3 == 0:
+            rec['admin'] = bool(i % 2)
+    del i, rec
+
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        self.encoder = acid.encoders.make_schema_encoder([
+            (1, keylib.FIELD_STRING, 'name'),
+            (2, keylib.FIELD_INTEGER, 'age'),
+            (3, keylib.FIELD_DOUBLE, 'score'),
+            (4, keylib.FIELD_BOOL, 'admin')])
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('coll',
+                                                  encoder=self.encoder)
+            for i, rec in enumerate(self.RECS):
+                self.coll.put(rec, key=i)
+            self.coll.batch(max_recs=5, columnar=True,
+                            packer=acid.encoders.ZLIB)
+
+    def test_format(self):
+        prefix = self.coll.prefix
+        values = [v for k, v in self.store.engine.items
+                  if k.startswith(prefix)]
+        eq([acid.core.BATCH_COLUMNAR] * 2, [v[:2] for v in values])
+
+    def test_read(self):
+        with self.store.begin():
+            eq(self.RECS, list(self.coll.values()))
+            eq(self.RECS[::-1], list(self.coll.values(reverse=True)))
+            eq(self.RECS[4], self.coll.get(4))
+            eq([{'age': -3, 'admin': False}, {'age': -2}],
+               list(self.coll.values(hi=2, fields=['age', 'admin'])))
+
+    def test_aggregate(self):
+        with self.store.begin():
+            eq({'count': 10, 'sum': 15, 'min': -3, 'max': 6},
+               self.coll.aggregate('age'))
+            eq({'count': 5, 'sum': 30.0, 'min': 3.0, 'max': 9.0},
+               self.coll.aggregate('score', lo=2, hi=7))
+            eq({'count': 6, 'sum': 49.5, 'min': 4.5, 'max': 12.0},
+               self.coll.aggregate('score', lo=3, hi=8, include=True))
+            eq({'count': 10, 'sum': None, 'min': u'n0', 'max': u'n9'},
+               self.coll.aggregate('name'))
+            eq({'count': 4, 'sum': 2, 'min': False, 'max': True},
+               self.coll.aggregate('admin'))
+            eq({'count': 0, 'sum': 0, 'min': None, 'max': None},
+               self.coll.aggregate('age', lo=20))
+            self.assertRaises(ValueError, self.coll.aggregate, 'missing')
+
+    def test_aggregate_mixed(self):
+        with self.store.begin(write=True):
+            self.coll.put({'age': 100}, key=3)
+            self.coll.put({'age': -100}, key=20)
+            eq({'count': 11, 'sum': 15, 'min': -100, 'max': 100},
+               self.coll.aggregate('age'))
+            eq({'count': 3, 'sum': 100, 'min': -1, 'max': 100},
+               self.coll.aggregate('age', lo=2, hi=5))
+
+    def test_aggregate_prefix(self):
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('tuples', encoder=self.encoder)
+            for i in range(20):
+                coll.put({'age': i}, key=(i // 3, i))
+            # The batch containing (1, 3) begins with (0, 2).
+            coll.batch(max_recs=2, columnar=True)
+            eq({'count': 3, 'sum': 12, 'min': 3, 'max': 5},
+               coll.aggregate('age', prefix=1))
+
+    def test_update(self):
+        with self.store.begin(write=True):
+            self.coll.put({'name': u'x', 'age': 100}, key=3)
+            self.coll.delete(6)
+            recs = self.RECS[:]
+            recs[3] = {'name': u'x', 'age': 100}
+            del recs[6]
+            eq(recs, list(self.coll.values()))
+            eq({'count': 9, 'sum': 112, 'min': -3, 'max': 100},
+               self.coll.aggregate('age'))
+
+    def test_not_schema(self):
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('other')
+            coll.put({'a': 1})
+            self.assertRaises(ValueError, lambda: coll.batch(max_recs=2,
+                                                        columnar=True))
+            self.assertRaises(ValueError, lambda: coll.aggregate('a'))
+
+
+@register()
+class ZdictTest:
+    RECS = ['{"name":"user%d","age":%d,"email":"user%d@example.com",'
+            '"country":"gb","active":true}' % (i, i % 90, i)
+            for i in range(200)]
+
+    def setUp(self):
+        self.engine = acid.engines.ListEngine()
+        self.store = acid.Store(self.engine)
+
+    def test_train(self):
+        zdict = acid.encoders.train_zdict(self.RECS, size=64)
+        assert len(zdict) <= 64
+        assert '@example.com' in zdict
+
+    def test_compressor(self):
+        zdict = acid.encoders.train_zdict(self.RECS[:100])
+        packer = acid.encoders.make_zdict_compressor('x', zdict)
+        for rec in self.RECS[100:]:
+            packed = packer.pack(buffer(rec))
+            eq(rec, packer.unpack(buffer(packed)))
+            assert len(packed) < (len(zlib.compress(rec)) / 2)
+
+    def test_store(self):
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('coll1')
+            for i, rec in enumerate(self.RECS):
+                coll.put(rec, key=i)
+            packer = coll.train_compressor(max_recs=50)
+            eq('zdict:coll1:1', packer.name)
+            for i, rec in enumerate(self.RECS):
+                coll.put(rec, key=i, packer=packer)
+            packer2 = coll.train_compressor()
+            eq('zdict:coll1:2', packer2.name)
+            coll.put(self.RECS[0], key=0, packer=packer2)
+
+        store = acid.Store(self.engine)
+        with store.begin():
+            eq(self.RECS, list(store['coll1'].values()))
+            eq(packer2.name, store.get_zdict('coll1').name)
+            eq(packer.name, store.get_zdict('coll1', 1).name)
+            eq(None, store.get_zdict('coll1', 3))
+            eq(None, store.get_zdict('coll2'))
+
+
+@register()
+class CompressorsTest:
+    RECS = ZdictTest.RECS
+
+    def setUp(self):
+        self.engine = acid.engines.ListEngine()
+        self.store = acid.Store(self.engine)
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('coll')
+            for i, rec in enumerate(self.RECS):
+                self.coll.put(rec, key=i)
+
+    def test_optional(self):
+        names = ['lz4', 'snappy', 'zstd']
+        for name, packer in zip(names, [acid.encoders.LZ4,
+                                        acid.encoders.SNAPPY,
+                                        acid.encoders.ZSTD]):
+            if packer is None:
+                assert packer not in acid.encoders.COMPRESSORS
+                continue
+            eq(name, packer.name)
+            assert packer in acid.encoders.COMPRESSORS
+            with self.store.begin(write=True):
+                self.coll.put(self.RECS[0], key=0, packer=packer)
+                self.coll.batch(max_recs=10, packer=packer)
+            store = acid.Store(self.engine)
+            with store.begin():
+                eq(self.RECS, list(store['coll'].values()))
+
+    def test_missing(self):
+        # Value prefixed with the index of a missing optional compressor.
+        with self.store.begin(write=True):
+            self.engine.put(self.coll.prefix + keylib.packs('', (500,)),
+                            keylib.pack_int('', 5) + 'x')
+        if acid.encoders.LZ4 is None:
+            with self.store.begin():
+                self.assertRaises(acid.errors.ConfigError,
+                                  lambda: self.coll.get(500))
+
+    def test_choose(self):
+        with self.store.begin():
+            packer, results = self.coll.choose_packer(sample=50)
+            eq(len(acid.encoders.COMPRESSORS), len(results))
+            eq(results[0]['packer'], packer)
+            eq(1.0, [r['ratio'] for r in results
+                     if r['packer'] is acid.encoders.PLAIN][0])
+            ratios = [r['ratio'] for r in results]
+            eq(sorted(ratios, reverse=True), ratios)
+
+            packers = [acid.encoders.PLAIN, acid.encoders.ZLIB]
+            packer, results = self.coll.choose_packer(packers=packers,
+                                                      max_recs=10)
+            eq(acid.encoders.ZLIB, packer)
+            assert results[0]['ratio'] > 3
+            packer, _ = self.coll.choose_packer(packers=packers,
+                                                min_rate=1e15)
+            eq(acid.encoders.PLAIN, packer)
+
+    def test_choose_empty(self):
+        with self.store.begin(write=True):
+            eq((None, []), self.store.add_collection('empty').choose_packer())
+
+
+@register()
+class MigrateBatchesTest:
+    KEYS = [('a', 1), ('a', 2), ('b', 1)]
+
+    def _put_old_batch(self, items):
+        # Original format: physical key lists members in reverse.
+        prefix = self.store._encoder_prefix[acid.encoders.ZLIB]
+        phys = keylib.packs(self.coll.prefix, [k for k, _ in items[::-1]])
+        value = keylib.pack_int('', len(items))
+        for _, data in items:
+            value += keylib.pack_int('', len(data))
+        value += prefix + acid.encoders.ZLIB.pack(''.join(d for _, d in items))
+        self.store.engine.put(phys, value)
+
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('coll1')
+            self.store.add_encoder(acid.encoders.ZLIB)
+            pack = lambda i: self.coll.encoder.pack(i)
+            self._put_old_batch([(k, pack(i))
+                                 for i, k in enumerate(self.KEYS[:2])])
+            self._put_old_batch([(('c', i), pack(i)) for i in range(3)])
+            self.coll.put('x', key=('d',))
+
+    def test_migrate(self):
+        with self.store.begin(write=True):
+            before = list(self.coll.items())
+            eq(1, self.coll.migrate_batches(max_batches=1))
+            eq(1, self.coll.migrate_batches())
+            eq(0, self.coll.migrate_batches())
+            eq(before, list(self.coll.items()))
+            eq(3, len([k for k, v in self.store.engine.items
+                       if k.startswith(self.coll.prefix)]))
+
+    def test_get_old(self):
+        with self.store.begin():
+            eq(0, self.coll.get(('a', 1)))
+            eq(1, self.coll.get(('a', 2)))
+            eq(2, self.coll.get(('c', 2)))
+            eq(None, self.coll.get(('c', 3)))
+            eq('x', self.coll.get('d'))
+
+
+@register()
+class UtcOffsetKeyTest:
+    def test_get_delete(self):
+        store = acid.open('ListEngine')
+        utc = datetime.datetime(2014, 1, 1, 12, tzinfo=keylib.FixedOffsetZone(0))
+        plus1 = utc.astimezone(keylib.FixedOffsetZone(3600))
+        with store.begin(write=True):
+            coll = store.add_collection('coll1')
+            coll.put('A', key=(utc,))
+            coll.put('B', key=(plus1,))
+            eq('A', coll.get((utc,)))
+            eq('B', coll.get((plus1,)))
+            coll.delete((plus1,))
+            eq('A', coll.get((utc,)))
+            eq(None, coll.get((plus1,)))
+
+
+@register()
+class RekeyTest:
+    def naive(self, key):
+        return tuple(v.replace(tzinfo=None)
+                     if isinstance(v, datetime.datetime) else v
+                     for v in key)
+
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        self.tz = keylib.FixedOffsetZone(3600)
+        self.times = [datetime.datetime(2014, 1, 1, i) for i in range(4)]
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('coll1')
+            self.coll.add_index('rev', lambda obj: -obj)
+            # As written by the old C extension on a UTC+1 host.
+            for i, dt in enumerate(self.times, 1):
+                self.coll.put(i, key=(dt.replace(tzinfo=self.tz), 'x'))
+            self.coll.put(9, key=('y',))
+
+    def test_rekey(self):
+        with self.store.begin(write=True):
+            eq(None, self.coll.get((self.times[0], 'x')))
+            eq(1, self.coll.rekey(self.naive, max_recs=1))
+            eq(3, self.coll.rekey(self.naive))
+            eq(0, self.coll.rekey(self.naive))
+            for i, dt in enumerate(self.times, 1):
+                eq(i, self.coll.get((dt, 'x')))
+            eq(9, self.coll.get('y'))
+            eq([9, 4, 3, 2, 1], list(self.coll.indices['rev'].values()))
+            eq(5, len(list(self.coll.items())))
+
+
+@register()
+class ReencodeTest:
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        self.json = acid.encoders.make_json_encoder()
+        with self.store.begin(write=True):
+            self.coll = self.store.add_collection('coll')
+            self.coll.add_index('n', lambda rec: rec['n'])
+            for i in range(1, 21):
+                self.coll.put({'n': i})
+            self.coll.batch(lo=5, hi=15, max_recs=4,
+                            packer=acid.encoders.ZLIB)
+            self.recs = list(self.coll.items())
+
+    def values(self):
+        return [v for k, v in self.store.engine.items
+                if k.startswith(self.coll.prefix)]
+
+    def test_reencode(self):
+        with self.store.begin(write=True):
+            eq(3, self.coll.reencode(self.json, max_recs=3))
+            eq(self.recs, list(self.coll.items()))
+            eq({'n': 2}, self.coll.get(2))
+            eq({'n': 7}, self.coll.get(7))
+            eq(5, self.coll.reencode(self.json, max_recs=3))
+            eq(12, self.coll.reencode(self.json))
+            eq(0, self.coll.reencode(self.json))
+            eq(self.recs, list(self.coll.items()))
+            eq('json', self.coll.info['encoder'])
+            assert 'old_encoder' not in self.coll.info
+            eq('{"n":1}', self.coll.get(1, raw=True))
+        tag = acid.core.ENCODER_TAG
+        eq([tag] * 12, [v[:2] for v in self.values()])
+
+    def test_writes(self):
+        with self.store.begin(write=True):
+            eq(3, self.coll.reencode(self.json, max_recs=3))
+            self.coll.put({'n': 100}, key=20)
+            self.coll.put({'n': 101}, key=6)
+            self.coll.delete(10)
+            recs = [(k, {'n': 100} if k == (20,) else
+                        {'n': 101} if k == (6,) else v)
+                    for k, v in self.recs if k != (10,)]
+            eq(recs, list(self.coll.items()))
+            eq([(100,), (101,)], list(self.coll.indices['n'].tups(lo=100)))
+            while self.coll.reencode(self.json, max_recs=3) >= 3:
+                pass
+            eq(recs, list(self.coll.items()))
+            eq([(100,), (101,)], list(self.coll.indices['n'].tups(lo=100)))
+            # Writes after completion are untagged.
+            self.coll.put({'n': 1}, key=1)
+        eq(acid.core.ENCODER_TAG, self.values()[1][:2])
+        assert self.values()[0][:2] != acid.core.ENCODER_TAG
+
+    def test_reopen(self):
+        with self.store.begin(write=True):
+            self.coll.reencode(self.json, max_recs=3)
+        store = acid.Store(self.store.engine)
+        with store.begin():
+            coll = store.add_collection('coll', encoder=self.json)
+            eq(self.recs, list(coll.items()))
+            self.assertRaises(acid.errors.ConfigError,
+                lambda: store.add_collection('coll'))
+
+    def test_missing(self):
+        other = acid.encoders.RecordEncoder('other',
+            acid.encoders.PICKLE.unpack, acid.encoders.PICKLE.pack)
+        with self.store.begin(write=True):
+            coll = self.store.add_collection('coll2', encoder=other)
+            coll.put(1)
+            coll.reencode(self.json, max_recs=0)
+        store = acid.Store(self.store.engine)
+        with store.begin():
+            self.assertRaises(acid.errors.ConfigError,
+                lambda: store.add_collection('coll2', encoder=self.json))
+
+
+@register()
+class ThreadTest:
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        with self.store.begin(write=True):
+            self.store.add_collection('coll')
+
+    def run_threads(self, func, n=8):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func()))
+                   for i in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_mode(self):
+        ctx = self.store._txn_context
+        eq(None, ctx.mode())
+        with self.store.begin():
+            eq(False, ctx.mode())
+        with self.store.begin(write=True):
+            eq(True, ctx.mode())
+        eq(None, ctx.mode())
+
+    def test_in_txn_write(self):
+        modes = []
+        self.store.in_txn(lambda: modes.append(self.store._txn_context.mode()),
+                          write=True)
+        eq([True], modes)
+
+    def test_mode_per_thread(self):
+        ctx = self.store._txn_context
+        with self.store.begin(write=True):
+            eq([False], self.run_threads(lambda: self._read_mode(ctx), 1))
+            eq(True, ctx.mode())
+
+    def _in_txn(self, store, write, func):
+        with store.begin(write=write):
+            return func()
+
+    def _read_mode(self, ctx):
+        with self.store.begin():
+            return ctx.mode()
+
+    def test_collection_cache(self):
+        store = acid.Store(self.store.engine)
+        colls = self.run_threads(lambda: self._in_txn(store, False,
+                                                       lambda: store['coll']))
+        eq(1, len(set(map(id, colls))))
+
+    def test_add_encoder(self):
+        enc = acid.encoders.PICKLE
+        encoders = [acid.encoders.RecordEncoder('enc%d' % i, enc.unpack,
+                                                enc.pack)
+                    for i in range(8)]
+        it = iter(encoders)
+        prefixes = self.run_threads(lambda: self._in_txn(self.store, True,
+            lambda: self.store.add_encoder(next(it))))
+        eq(8, len(set(prefixes)))
+        for encoder, prefix in self.store._encoder_prefix.items():
+            eq(encoder, self.store._prefix_encoder[prefix])
+
+    def test_txn_reuse(self):
+        class Txn(acid.engines.ListEngine):
+            def __init__(self):
+                acid.engines.ListEngine.__init__(self)
+                self.begins = self.resets = self.renews = 0
+            def begin(self, write=False):
+                self.begins += 1
+                return self
+            def reset(self):
+                self.resets += 1
+            def renew(self):
+                self.renews += 1
+
+        engine = Txn()
+        store = acid.Store(engine)
+        for i in range(3):
+            with store.begin():
+                pass
+        eq((1, 3, 2), (engine.begins, engine.resets, engine.renews))
+        with store.begin(write=True):
+            pass
+        eq((2, 3, 2), (engine.begins, engine.resets, engine.renews))
+
+
 @register()
 class CountTest:
     def setUp(self):
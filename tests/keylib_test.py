@@ -1,5 +1,6 @@
 
 import cStringIO
+import decimal
 import operator
 import os
 import unittest
@@ -120,6 +121,44 @@ class KeysTest:
 
 
 
+@register()
+class ManyTest:
+    KEYS = [(1,), ('dave', 2), (u'x', None, True), (-1, 'y' * 300)]
+
+    def test_packs_many(self):
+        eq([keylib.packs('a', k) for k in self.KEYS],
+           keylib.packs_many('a', self.KEYS))
+
+    def test_packs_buffer(self):
+        s, offsets = keylib.packs_buffer('a', self.KEYS)
+        eq(len(self.KEYS) + 1, len(offsets))
+        eq(s, ''.join(keylib.packs_many('a', self.KEYS)))
+        for i, k in enumerate(self.KEYS):
+            eq([k], keylib.unpacks('a', s[offsets[i]:offsets[i+1]]))
+
+    def test_unpacks_many(self):
+        packed = keylib.packs_many('a', self.KEYS)
+        eq([[k] for k in self.KEYS], keylib.unpacks_many('a', packed))
+
+    def test_unpacks_many_offsets(self):
+        s, offsets = keylib.packs_buffer('a', self.KEYS)
+        eq([[k] for k in self.KEYS],
+           keylib.unpacks_many('a', s, offsets))
+
+    def test_unpacks_many_prefix_mismatch(self):
+        packed = [keylib.packs('b', self.KEYS[0]),
+                  keylib.packs('a', self.KEYS[1])]
+        eq([None, [self.KEYS[1]]], keylib.unpacks_many('a', packed))
+
+
+@register(python=True)
+class SameManyEncodingTest:
+    def test1(self):
+        native = _keylib.packs_buffer('a', ManyTest.KEYS)
+        python = keylib.packs_buffer('a', ManyTest.KEYS)
+        eq(native, python)
+
+
 @register()
 class StringEncodingTest:
     def do_test(self, k):
@@ -157,6 +196,218 @@ class KeyTest:
         eq(keylib.Key(""), keylib.Key(""))
 
 
+@register()
+class KeyElementTest:
+    KEY = (1, 'ab', None, True, -3, u'x')
+
+    def test_getitem(self):
+        key = keylib.Key(self.KEY)
+        for i in xrange(len(self.KEY)):
+            eq(self.KEY[i], key[i])
+            eq(self.KEY[-1 - i], key[-1 - i])
+
+    def test_getitem_from_raw(self):
+        raw = keylib.packs('pfx', self.KEY)
+        for i in xrange(len(self.KEY)):
+            eq(self.KEY[i], keylib.Key.from_raw('pfx', raw)[i])
+
+    def test_getitem_range(self):
+        key = keylib.Key(self.KEY)
+        self.assertRaises(IndexError, lambda: key[len(self.KEY)])
+        self.assertRaises(IndexError, lambda: key[-1 - len(self.KEY)])
+        self.assertRaises(IndexError, lambda: keylib.Key()[0])
+
+    def test_len(self):
+        eq(len(self.KEY), len(keylib.Key(self.KEY)))
+        eq(len(self.KEY), len(keylib.Key.from_raw('p',
+                                                  keylib.packs('p', self.KEY))))
+        eq(0, len(keylib.Key()))
+
+    def test_hash(self):
+        raw = keylib.packs('pfx', self.KEY)
+        eq(hash(keylib.Key(self.KEY)),
+           hash(keylib.Key.from_raw('pfx', raw)))
+        # Keys compare equal to tuples, so must hash equal to them.
+        eq(hash(self.KEY), hash(keylib.Key(self.KEY)))
+        eq(hash(self.KEY), hash(keylib.Key.from_raw('pfx', raw)))
+
+    def test_compare_types(self):
+        # (1,) == (True,), so encodings must not be confused.
+        key = keylib.Key(1)
+        assert key == (1,)
+        assert key != (True,)
+        assert key == (1,)
+        assert key < (True,)
+
+
+@register()
+class StartswithTest:
+    def test_tuple(self):
+        key = keylib.Key(1, 'ab', 2)
+        assert key.startswith(())
+        assert key.startswith((1,))
+        assert key.startswith((1, 'ab'))
+        assert key.startswith((1, 'ab', 2))
+        assert not key.startswith((1, 'ab', 2, 3))
+        assert not key.startswith((2,))
+
+    def test_scalar(self):
+        key = keylib.Key(1, 'ab')
+        assert key.startswith(1)
+        assert not key.startswith(2)
+        assert not keylib.Key('abc').startswith('ab')
+
+    def test_key(self):
+        key = keylib.Key.from_raw('pfx', keylib.packs('pfx', (1, 'ab', 2)))
+        assert key.startswith(keylib.Key(1, 'ab'))
+        assert not key.startswith(keylib.Key(1, 'ac'))
+
+    def test_partial_string(self):
+        # Encoding of 'ab' is a byte prefix of the encoding of 'ab\x01'.
+        key = keylib.Key('ab\x01')
+        assert keylib.packs('', key).startswith(keylib.packs('', 'ab'))
+        assert not key.startswith(('ab',))
+
+
+@register()
+class FromRawTest:
+    def test_str(self):
+        s = keylib.packs('ab', (1, 'x'))
+        eq(keylib.Key(1, 'x'), keylib.Key.from_raw('ab', s))
+
+    def test_prefix_mismatch(self):
+        s = keylib.packs('ab', (1, 'x'))
+        eq(None, keylib.Key.from_raw('ac', s))
+        eq(None, keylib.Key.from_raw('ac', buffer(s), keylib.Notifier()))
+
+    def test_buffer_no_notifier(self):
+        ba = bytearray(keylib.packs('ab', (1, 'x')))
+        key = keylib.Key.from_raw('ab', buffer(ba))
+        ba[3] = keylib.KIND_NULL
+        eq(keylib.Key(1, 'x'), key)
+
+    def test_notifier_expire(self):
+        ba = bytearray(keylib.packs('ab', (1, 'x')))
+        notifier = keylib.Notifier()
+        key = keylib.Key.from_raw('ab', buffer(ba), notifier)
+        key2 = keylib.Key.from_raw('ab', buffer(ba), notifier)
+        del key2
+        eq(keylib.Key(1, 'x'), key)
+        notifier.expire()
+        ba[3] = keylib.KIND_NULL
+        eq(keylib.Key(1, 'x'), key)
+
+    def test_notifier_dealloc(self):
+        ba = bytearray(keylib.packs('ab', (1, 'x')))
+        notifier = keylib.Notifier()
+        key = keylib.Key.from_raw('ab', buffer(ba), notifier)
+        del notifier
+        ba[3] = keylib.KIND_NULL
+        eq(keylib.Key(1, 'x'), key)
+
+
+@register()
+class KeyCacheTest:
+    def test_hit(self):
+        cache = keylib.KeyCache()
+        key, raw = cache.get('x', (1, 'a'))
+        eq(keylib.packs('x', (1, 'a')), raw)
+        eq(keylib.Key(1, 'a'), key)
+        eq((key, raw), cache.get('x', (1, 'a')))
+        eq(1, cache.hits)
+        eq(1, cache.misses)
+
+    def test_types(self):
+        cache = keylib.KeyCache()
+        eq(keylib.packs('', 1), cache.get('', 1)[1])
+        eq(keylib.packs('', True), cache.get('', True)[1])
+        eq(keylib.packs('', 1.0), cache.get('', (1.0,))[1])
+        eq(3, cache.misses)
+
+    def test_utcoffset(self):
+        cache = keylib.KeyCache()
+        utc = datetime(2014, 1, 1, 12, tzinfo=keylib.FixedOffsetZone(0))
+        plus1 = utc.astimezone(keylib.FixedOffsetZone(3600))
+        naive = utc.replace(tzinfo=None)
+        for dt in utc, plus1, naive, utc, plus1, naive:
+            eq(keylib.packs('', (dt,)), cache.get('', (dt,))[1])
+        eq((3, 3), (cache.hits, cache.misses))
+
+    def test_prefix(self):
+        cache = keylib.KeyCache()
+        eq(keylib.packs('a', 1), cache.get('a', 1)[1])
+        eq(keylib.packs('b', 1), cache.get('b', 1)[1])
+        eq(0, cache.hits)
+
+    def test_key(self):
+        cache = keylib.KeyCache()
+        key = keylib.Key(1)
+        eq((key, keylib.packs('x', 1)), cache.get('x', key))
+        eq(0, len(cache))
+
+    def test_bounded(self):
+        cache = keylib.KeyCache(size=8)
+        for i in xrange(100):
+            cache.get('', i)
+            cache.get('', 1)
+        assert len(cache) <= 8
+        eq((100, 100), (cache.hits, cache.misses))
+        cache.clear()
+        eq((0, 0, 0), (len(cache), cache.hits, cache.misses))
+
+
+@register()
+class KeyListTest:
+    def test_mismatch(self):
+        eq(None, keylib.KeyList.from_raw('x', keylib.packs('y', 1)))
+
+    def test_keys(self):
+        tups = [(1, 'a'), (), (u'b', None)]
+        kl = keylib.KeyList.from_raw('x', keylib.packs('x', tups))
+        eq(3, len(kl))
+        eq(map(keylib.Key, tups), list(kl))
+        eq(keylib.Key(u'b', None), kl[-1])
+        eq('x', kl[1].to_raw('x'))
+        self.assertRaises(IndexError, lambda: kl[3])
+
+    def test_buffer(self):
+        raw = keylib.packs('x', [(1,), (2,)])
+        kl = keylib.KeyList.from_raw('x', buffer(raw))
+        eq([keylib.Key(1), keylib.Key(2)], list(kl))
+        eq(keylib.packs('x', 2), kl[1].to_raw('x'))
+
+    def test_front(self):
+        keys = map(keylib.Key, [(1, 'abc'), (1, 'abd'), (2,), (2, None)])
+        s = keylib.encode_keys([k.to_raw('') for k in keys])
+        eq(keys, list(keylib.KeyList.from_front(s)))
+        eq(keys, list(keylib.KeyList.from_front(buffer('xx' + s, 2))))
+        eq(0, len(keylib.KeyList.from_front('')))
+
+    def test_front_corrupt(self):
+        self.assertRaises(ValueError, keylib.KeyList.from_front, '\x01\x01a')
+        self.assertRaises(ValueError, keylib.KeyList.from_front, '\x00\x05a')
+        self.assertRaises(ValueError, keylib.KeyList.from_front, '\x00')
+
+
+@register()
+class TupleOffsetsTest:
+    def test_mismatch(self):
+        eq(None, keylib.tuple_offsets('b', keylib.packs('a', 1)))
+
+    def test_offsets(self):
+        tups = [(1, 'x' * 20), (True, None, -500), (uuid.uuid4(), u'y')]
+        for i in xrange(1, len(tups) + 1):
+            s = keylib.packs('a', tups[:i])
+            offsets = keylib.tuple_offsets('a', s)
+            eq(i + 1, len(offsets))
+            for j in xrange(i):
+                eq(tups[j], keylib.unpack('', s[offsets[j]:offsets[j+1]-1]))
+
+    def test_buffer(self):
+        s = keylib.packs('a', [(1,), (2,)])
+        eq(keylib.tuple_offsets('a', s), keylib.tuple_offsets('a', buffer(s)))
+
+
 @register()
 class EncodeIntTest:
     INTS = [0, 1, 240, 241, 2286, 2287, 2288,
@@ -175,7 +426,8 @@ class EncodeIntTest:
 
 @register()
 class IntKeyTest:
-    INTS = [-1, -239, -240, -241, -2285, -2286, -2287, 0, 1, 0xfffff]
+    INTS = [-1, -239, -240, -241, -2285, -2286, -2287, 0, 1, 0xfffff,
+            -67823, -67824, -0xffffff, -0x1000000, -(1 << 62)]
 
     def test1(self):
         for i in self.INTS:
@@ -201,6 +453,206 @@ class SameIntEncodingTest:
                 raise
 
 
+@register(python=True)
+class SameStrEncodingTest:
+    def test1(self):
+        for i in xrange(64):
+            for s in chr(i) * i, chr(255 - i) * i, os.urandom(i):
+                native = _keylib.packs('', [(s,), (s.encode('hex'), s)])
+                python = keylib.packs('', [(s,), (s.encode('hex'), s)])
+                try:
+                    eq(native, python)
+                except:
+                    print 'failing str was %r' % (s,)
+                    raise
+
+
+@register(python=True)
+class SameNegIntEncodingTest:
+    def test1(self):
+        for i in EncodeIntTest.INTS:
+            native = _keylib.packs('', -i)
+            python = keylib.packs('', -i)
+            eq(native, python)
+            eq(_keylib.unpacks('', native), keylib.unpacks('', python))
+
+
+@register()
+class FloatTest:
+    FLOATS = [float('-inf'), -1e300, -2.5, -1.0, -1e-300, 0.0, 1e-300, 0.1,
+              1.0, 2.5, 1e300, float('inf')]
+
+    def test_roundtrip(self):
+        for f in self.FLOATS:
+            eq(f, keylib.unpack('', keylib.packs('', f))[0])
+
+    def test_order(self):
+        packed = [keylib.packs('', f) for f in self.FLOATS]
+        eq(packed, sorted(packed))
+
+    def test_neg_zero(self):
+        eq(keylib.packs('', 0.0), keylib.packs('', -0.0))
+
+    def test_after_ints(self):
+        assert keylib.packs('', 1 << 62) < keylib.packs('', -1e300)
+        assert keylib.packs('', 1e300) < keylib.packs('', False)
+
+    def test_decimal(self):
+        packed = keylib.packs('', [(decimal.Decimal('19.99'), 1.5)])
+        eq([(decimal.Decimal('19.99'), 1.5)], keylib.unpacks('', packed))
+        eq([(decimal.Decimal('19.99'), decimal.Decimal('1.5'))],
+           keylib.unpacks('', packed, number_factory=decimal.Decimal))
+        eq((decimal.Decimal('0.1'),),
+           keylib.unpack('', keylib.packs('', 0.1), decimal.Decimal))
+        eq([[(decimal.Decimal('0.1'),)]],
+           keylib.unpacks_many('', [keylib.packs('', 0.1)],
+                               number_factory=decimal.Decimal))
+
+    def test_key(self):
+        key = keylib.Key(1.5, 'a', 2.5)
+        eq(2.5, key[2])
+        eq([0, 22], keylib.tuple_offsets('', key.to_raw('')))
+
+
+@register()
+class DecimalTest:
+    DECIMALS = map(decimal.Decimal, [
+        '-1e300', '-123.456', '-19.990000000000000001', '-19.99', '-1',
+        '-0.101', '-0.1', '-0.0999', '-1e-300', '0', '1e-300', '0.0999', '0.1',
+        '0.101', '1', '19.99', '19.990000000000000001', '123.456', '1e300'])
+
+    def test_roundtrip(self):
+        for d in self.DECIMALS:
+            eq((d, 'x'), keylib.unpack('', keylib.packs('', (d, 'x'))))
+
+    def test_order(self):
+        packed = [keylib.packs('', d) for d in self.DECIMALS]
+        eq(packed, sorted(packed))
+
+    def test_distinct(self):
+        packed = set(keylib.packs('', d) for d in self.DECIMALS)
+        eq(len(self.DECIMALS), len(packed))
+
+    def test_normalized(self):
+        eq(keylib.packs('', decimal.Decimal('1')),
+           keylib.packs('', decimal.Decimal('1.000')))
+        eq(keylib.packs('', decimal.Decimal('0')),
+           keylib.packs('', decimal.Decimal('-0.00')))
+
+    def test_after_floats(self):
+        assert keylib.packs('', 1e300) < keylib.packs('', decimal.Decimal(-1))
+        assert keylib.packs('', decimal.Decimal(1)) < keylib.packs('', False)
+
+    def test_non_finite(self):
+        for s in 'nan', 'inf', '-inf':
+            self.assertRaises(ValueError,
+                              keylib.packs, '', decimal.Decimal(s))
+
+    def test_key(self):
+        key = keylib.Key(decimal.Decimal('1.5'), 'a')
+        eq('a', key[1])
+        eq(2, len(key))
+
+
+@register(python=True)
+class SameDecimalEncodingTest:
+    def test1(self):
+        for d in DecimalTest.DECIMALS:
+            native = _keylib.packs('', d)
+            python = keylib.packs('', d)
+            eq(native, python)
+            eq(_keylib.unpacks('', native), keylib.unpacks('', python))
+
+
+@register()
+class FieldsTest:
+    FIELDS = [(1, 1, 'age'), (2, 3, 'name'), (3, 0, 'ok'), (4, 2, 'score'),
+              (5, 4, 'when'), (300, 1, 'big')]
+    REC = {'age': -42, 'name': u'D\xe9ve', 'ok': True, 'score': 1.5,
+           'when': datetime(2014, 1, 2, 3, 4, 5, tzinfo=dateutil.tz.tzutc()),
+           'big': 1 << 62}
+
+    def _tags(self, fields):
+        return dict(((i << 3) | k, name) for i, k, name in fields)
+
+    def test_roundtrip(self):
+        packed = keylib.pack_fields(self.FIELDS, self.REC)
+        eq(self.REC, keylib.unpack_fields(self._tags(self.FIELDS), packed))
+        eq(self.REC, keylib.unpack_fields(self._tags(self.FIELDS),
+                                          buffer('x' + packed, 1)))
+
+    def test_missing(self):
+        packed = keylib.pack_fields(self.FIELDS, {'age': 1, 'name': None})
+        eq('\x09\x02', packed)
+        eq({'age': 1}, keylib.unpack_fields(self._tags(self.FIELDS), packed))
+        eq('', keylib.pack_fields(self.FIELDS, {}))
+
+    def test_integers(self):
+        fields = [(1, 1, 'i')]
+        for i in 0, 1, -1, 240, -241, (1 << 63) - 1, -(1 << 63):
+            packed = keylib.pack_fields(fields, {'i': i})
+            eq({'i': i}, keylib.unpack_fields(self._tags(fields), packed))
+        for i in 1 << 63, -(1 << 63) - 1:
+            self.assertRaises(ValueError, keylib.pack_fields, fields, {'i': i})
+
+    def test_str(self):
+        fields = [(1, 3, 's')]
+        packed = keylib.pack_fields(fields, {'s': 'abc'})
+        eq({'s': u'abc'}, keylib.unpack_fields(self._tags(fields), packed))
+        self.assertRaises(TypeError, keylib.pack_fields, fields, {'s': 1})
+
+    def test_unknown(self):
+        packed = keylib.pack_fields(self.FIELDS, self.REC)
+        old = self.FIELDS[:2]
+        rec = keylib.unpack_fields(self._tags(old), packed)
+        eq(set(['age', 'name', None]), set(rec))
+        rec['age'] = 7
+        rec = keylib.unpack_fields(self._tags(self.FIELDS),
+                                   keylib.pack_fields(old, rec))
+        eq(dict(self.REC, age=7), rec)
+
+    def test_skip_unknown(self):
+        packed = keylib.pack_fields(self.FIELDS, self.REC)
+        tags = self._tags([(2, 3, 'name'), (300, 1, 'big')])
+        eq({'name': self.REC['name'], 'big': self.REC['big']},
+           keylib.unpack_fields(tags, packed, False))
+
+    def test_kind_changed(self):
+        packed = keylib.pack_fields([(1, 3, 'age')], {'age': u'old'})
+        eq({None: packed},
+           keylib.unpack_fields(self._tags(self.FIELDS), packed))
+
+    def test_corrupt(self):
+        packed = keylib.pack_fields(self.FIELDS, self.REC)
+        for i in xrange(1, len(packed)):
+            try:
+                keylib.unpack_fields(self._tags(self.FIELDS), packed[:i])
+            except ValueError:
+                pass
+        self.assertRaises(ValueError, keylib.unpack_fields, {}, '\x0f')
+
+
+@register(python=True)
+class SameFieldsEncodingTest:
+    def test1(self):
+        tags = FieldsTest()._tags(FieldsTest.FIELDS)
+        native = _keylib.pack_fields(FieldsTest.FIELDS, FieldsTest.REC)
+        python = keylib.pack_fields(FieldsTest.FIELDS, FieldsTest.REC)
+        eq(native, python)
+        eq(_keylib.unpack_fields(tags, native),
+           keylib.unpack_fields(tags, python))
+
+
+@register(python=True)
+class SameFloatEncodingTest:
+    def test1(self):
+        for f in FloatTest.FLOATS:
+            native = _keylib.packs('', f)
+            python = keylib.packs('', f)
+            eq(native, python)
+            eq(_keylib.unpacks('', native), keylib.unpacks('', python))
+
+
 @register()
 class TupleTest:
     def assertOrder(self, tups):
@@ -286,6 +738,18 @@ class NativeTimeTest:
         dp = keylib.unpacks('', sp)
         eq(dn, dp)
 
+    def test_pre_epoch(self):
+        tz = dateutil.tz.gettz('Etc/GMT-1')
+        for dt in datetime(1969, 12, 31, 23, 59, 59, 999000), \
+                  datetime(1, 1, 2, 0, 0, 0, 1000, tz), \
+                  datetime(1900, 3, 1, 12, 30, 0, 0, tz):
+            sn = _keylib.packs('', dt)
+            sp = keylib.packs('', dt)
+            eq(sn, sp)
+            eq(_keylib.unpacks('', sn), keylib.unpacks('', sp))
+            eq(_keylib.unpacks('', sn, naive=True),
+               keylib.unpacks('', sp, naive=True))
+
 
 @register()
 class TimeTest:
@@ -320,6 +784,25 @@ class TimeTest:
         dt2, = keylib.unpack('', s)
         eq(dt, dt2)
 
+    def test_pre_epoch(self):
+        dt = datetime(1969, 12, 31, 23, 59, 59, 999000)
+        dt2, = keylib.unpack('', keylib.packs('', dt))
+        eq(dt, dt2.replace(tzinfo=None))
+        eq(datetime(1969, 12, 31, 23, 59, 59), dt2.replace(microsecond=0,
+                                                           tzinfo=None))
+
+    def test_exact_msec(self):
+        dt = datetime(2286, 11, 20, 17, 46, 39, 987000)
+        dt2, = keylib.unpack('', keylib.packs('', dt))
+        eq(dt, dt2.replace(tzinfo=None))
+
+    def test_naive_decode(self):
+        tz = dateutil.tz.gettz('Etc/GMT-1')
+        dt = datetime(2014, 1, 1, 12, 0, 0, 0, tz)
+        dt2, = keylib.unpack('', keylib.packs('', dt), naive=True)
+        eq(None, dt2.tzinfo)
+        eq(datetime(2014, 1, 1, 11, 0, 0), dt2)
+
 
 @register()
 class SortTest:
@@ -333,7 +816,9 @@ class SortTest:
         [(-2,), (-1,)],
         [(-2,), (-1,), (0,), (1,), (2,)],
         [datetime(1970, 1, 1), datetime(1970, 2, 1)],
-        [datetime(1969, 1, 1), datetime(1970, 1, 1)]
+        [datetime(1969, 1, 1), datetime(1970, 1, 1)],
+        [datetime(1969, 12, 31, 23, 59, 59, 998000),
+         datetime(1969, 12, 31, 23, 59, 59, 999000)]
     ]
 
     def test1(self):
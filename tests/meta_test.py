@@ -1,6 +1,9 @@
 
+import datetime
 import unittest
 
+import dateutil.tz
+
 import acid
 import acid.meta
 
@@ -17,6 +20,40 @@ class Model(acid.meta.Model):
         return self.name and self.name[0].isupper()
 
 
+class Person(acid.meta.Model):
+    name = acid.meta.String(1)
+    age = acid.meta.Integer(2)
+    admin = acid.meta.Bool(3)
+    score = acid.meta.Double(4)
+    born = acid.meta.Time(5)
+
+
+class LazyPerson(Person):
+    META_LAZY = True
+    META_COLLECTION_NAME = 'Person'
+
+
+class LazyModel(Model):
+    META_LAZY = True
+    META_COLLECTION_NAME = 'Model'
+
+
+class SlotPerson(acid.meta.Model):
+    META_SLOTS = True
+    META_COLLECTION_NAME = 'Person'
+    name = acid.meta.String(1)
+    age = acid.meta.Integer(2)
+
+    @acid.meta.index
+    def by_age(self):
+        return self.age
+
+
+class SlotModel(Model):
+    META_SLOTS = True
+    META_COLLECTION_NAME = 'Model'
+
+
 class TestBase:
     def setUp(self):
         self.store = acid.open('ListEngine')
@@ -54,5 +91,261 @@ class TestSave(TestBase, unittest.TestCase):
             assert len(list(Model.by_name.keys(u'Dave')))
 
 
+class Tracked(acid.meta.Model):
+    name = acid.meta.String()
+    age = acid.meta.Integer()
+
+    @acid.meta.index(depends=['age'])
+    def by_age(self):
+        self.calls.append('by_age')
+        return self.age
+
+    @acid.meta.index
+    def by_name(self):
+        self.calls.append('by_name')
+        return self.name
+
+    @acid.meta.on_update
+    def on_update(self):
+        self.calls.append(('on_update', self.dirty))
+
+    calls = []
+
+
+class TestDirty(unittest.TestCase):
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        Tracked.bind_store(self.store)
+        del Tracked.calls[:]
+
+    def test_dirty(self):
+        mod = Tracked(name=u'Dave')
+        assert mod.dirty == set(['name'])
+        with self.store.begin(write=True):
+            mod.save()
+        assert not mod.dirty
+        mod.age = 30
+        del mod.name
+        assert mod.dirty == set(['age', 'name'])
+        with self.store.begin(write=True):
+            assert not Tracked.get(mod.key).dirty
+
+    def test_skip_clean(self):
+        with self.store.begin(write=True):
+            mod = Tracked(name=u'Dave', age=30)
+            mod.save()
+            del Tracked.calls[:]
+            mod.save()
+            assert Tracked.calls == []
+            mod.save(force=True)
+            assert Tracked.calls[0] == ('on_update', frozenset())
+            assert Tracked.calls.count('by_age') == 2
+
+    def test_depends(self):
+        with self.store.begin(write=True):
+            mod = Tracked(name=u'Dave', age=30)
+            mod.save()
+            del Tracked.calls[:]
+            mod.name = u'David'
+            mod.save()
+            assert Tracked.calls == [('on_update', frozenset(['name'])),
+                                     'by_name', 'by_name']
+            assert list(Tracked.by_age.tups()) == [(30,)]
+            assert list(Tracked.by_name.tups()) == [(u'David',)]
+
+            del Tracked.calls[:]
+            mod.age = 31
+            mod.save()
+            assert Tracked.calls.count('by_age') == 2
+            assert list(Tracked.by_age.tups()) == [(31,)]
+
+
+class TestSchema(unittest.TestCase):
+    def setUp(self):
+        self.store = acid.open('ListEngine')
+        Person.bind_store(self.store)
+
+    def test_encoder(self):
+        assert Person.META_ENCODER.name == 'schema'
+        assert Model.META_ENCODER.name == 'json'
+
+    def test_roundtrip(self):
+        born = datetime.datetime(1980, 1, 2, tzinfo=dateutil.tz.tzutc())
+        with self.store.begin(write=True):
+            Person(name=u'Dave', age=34, admin=True, score=1.5,
+                   born=born).save()
+            Person(name=u'Jim').save()
+        with self.store.begin():
+            dave, jim = list(Person.iter())
+            assert (dave.name, dave.age, dave.admin, dave.score,
+                    dave.born) == (u'Dave', 34, True, 1.5, born)
+            assert (jim.name, jim.age) == (u'Jim', None)
+
+    def test_compact(self):
+        rec = {'name': u'Dave', 'age': 34, 'admin': True, 'score': 1.5}
+        schema = Person.META_ENCODER.pack(Person(**rec))
+        json = Model.META_ENCODER.pack(Model(rec))
+        assert len(schema) * 2 < len(json)
+
+    def test_evolve(self):
+        class Person2(acid.meta.Model):
+            META_COLLECTION_NAME = 'Person'
+            name = acid.meta.String(1)
+            email = acid.meta.String(6)
+
+        with self.store.begin(write=True):
+            Person(name=u'Dave', age=34).save()
+
+        # A newer version of the model, reading and updating old records.
+        Person2.bind_store(acid.Store(self.store.engine))
+        with Person2.META_STORE.begin(write=True):
+            dave = Person2.get(1)
+            assert dave.name == u'Dave'
+            assert dave.email is None
+            dave.email = u'dave@example.com'
+            dave.save()
+
+        # The old version still sees its fields.
+        Person.bind_store(acid.Store(self.store.engine))
+        with Person.META_STORE.begin():
+            dave = Person.get(1)
+            assert (dave.name, dave.age) == (u'Dave', 34)
+        with Person2.META_STORE.begin():
+            assert Person2.get(1).email == u'dave@example.com'
+
+    def test_iter_fields(self):
+        with self.store.begin(write=True):
+            Person(name=u'Dave', age=34, admin=True).save()
+            Person(name=u'Jim', age=40).save()
+            dave, jim = Person.iter(fields=['age'])
+            assert (dave.name, dave.age) == (None, 34)
+            assert jim.age == 40
+            dave.age = 35
+            dave.save()
+            dave = Person.get(1)
+            assert (dave.name, dave.age, dave.admin) == (u'Dave', 35, True)
+
+    def test_aggregate(self):
+        with self.store.begin(write=True):
+            for i, age in enumerate([34, 40, 28, None, 51]):
+                Person(name=u'P%d' % i, age=age).save()
+            Person.collection().batch(max_recs=2, columnar=True)
+            assert Person.aggregate('age') == {
+                'count': 4, 'sum': 153, 'min': 28, 'max': 51}
+            assert Person.aggregate('age', lo=2, hi=4)['sum'] == 68
+            assert Person.get(3).age == 28
+
+    def test_lazy(self):
+        with self.store.begin(write=True):
+            Person(name=u'Dave', age=34).save()
+        LazyPerson.bind_store(acid.Store(self.store.engine))
+        with LazyPerson.META_STORE.begin(write=True):
+            dave = LazyPerson.get(1)
+            assert dave._rec is None
+            assert dave.age == 34
+            assert dave.admin is None
+            assert dave._rec is None
+            assert dave._fields == {'age': 34, 'admin': None}
+            assert dave.name == u'Dave'
+
+            packed = dave._data
+            assert LazyPerson.META_ENCODER.pack(dave) is packed
+            dave.save()
+            dave.age = 35
+            assert dave._rec == {'name': u'Dave', 'age': 35}
+            dave.save()
+            assert LazyPerson.get(1).age == 35
+            del dave.name
+            dave.save()
+            assert LazyPerson.get(1).name is None
+
+    def test_lazy_json(self):
+        Model.bind_store(self.store)
+        with self.store.begin(write=True):
+            Model(name=u'Dave').save()
+        LazyModel.bind_store(acid.Store(self.store.engine))
+        with LazyModel.META_STORE.begin(write=True):
+            dave = LazyModel.get(1)
+            assert dave._rec is None
+            assert dave.name == u'Dave'
+            assert dave._rec == {'name': u'Dave'}
+            assert list(LazyModel.by_name.keys(u'Dave'))
+
+    def test_slots(self):
+        dave = SlotPerson(name=u'Dave')
+        assert not hasattr(dave, '__dict__')
+        assert (dave.name, dave.age) == (u'Dave', None)
+        assert dave._rec == {'name': u'Dave'}
+        assert dave.dirty == set(['name', 'age'])
+        self.assertRaises(AttributeError, setattr, dave, 'email', u'x')
+
+    def test_slots_store(self):
+        with self.store.begin(write=True):
+            Person(name=u'Dave', age=34, admin=True).save()
+        SlotPerson.bind_store(acid.Store(self.store.engine))
+        with SlotPerson.META_STORE.begin(write=True):
+            dave = SlotPerson.get(1)
+            assert (dave.name, dave.age) == (u'Dave', 34)
+            dave.age = 35
+            dave.save()
+            assert list(SlotPerson.by_age.tups()) == [(35,)]
+            jim = SlotPerson(name=u'Jim', age=40)
+            jim.save()
+            assert jim.key == (2,)
+
+            dave, = SlotPerson.iter(fields=['age'], max=1)
+            assert (dave.name, dave.age) == (None, 35)
+            dave.age = 36
+            dave.save()
+
+        # Fields unknown to the slotted model survive its saves.
+        Person.bind_store(acid.Store(self.store.engine))
+        with Person.META_STORE.begin():
+            dave = Person.get(1)
+            assert (dave.name, dave.age, dave.admin) == (u'Dave', 36, True)
+
+    def test_slots_json(self):
+        with self.store.begin(write=True):
+            Model.bind_store(self.store)
+            Model({'name': u'Dave', 'other': 1}).save()
+        SlotModel.bind_store(acid.Store(self.store.engine))
+        with SlotModel.META_STORE.begin(write=True):
+            dave = SlotModel.get(1)
+            assert dave.name == u'Dave'
+            dave.name = u'David'
+            dave.save()
+            assert SlotModel.get(1)._rec == {'name': u'David', 'other': 1}
+            assert list(SlotModel.by_name.keys(u'David'))
+
+    def test_slots_bad(self):
+        def lazy():
+            class Bad(acid.meta.Model):
+                META_SLOTS = True
+                META_LAZY = True
+        self.assertRaises(TypeError, lazy)
+
+        class Sub(SlotPerson):
+            score = acid.meta.Double(4)
+        sub = Sub(name=u'Dave', score=1.5)
+        assert not hasattr(sub, '__dict__')
+        assert sub._rec == {'name': u'Dave', 'score': 1.5}
+
+    def test_bad_fields(self):
+        def partial():
+            class Bad(acid.meta.Model):
+                a = acid.meta.String(1)
+                b = acid.meta.String()
+        def duplicate():
+            class Bad(acid.meta.Model):
+                a = acid.meta.String(1)
+                b = acid.meta.String(1)
+        def subclass():
+            class Bad(Person):
+                c = acid.meta.String()
+        for func in partial, duplicate, subclass:
+            self.assertRaises(TypeError, func)
+        self.assertRaises(ValueError, acid.meta.String, 0)
+
+
 if __name__ == '__main__':
     unittest.main()